@@ -0,0 +1,315 @@
+# asyncio serving mode (SERVE_MODE=asyncio): the paho client is driven by the event loop's
+# socket callbacks instead of its own network thread, the web API is an ASGI (Quart) app
+# served by hypercorn on the same loop, and the control loop is a coroutine. Everything
+# runs on one thread, so the controller globals in main.py are never touched concurrently.
+import asyncio
+import concurrent.futures
+import logging
+import signal
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from quart import Quart, Response, jsonify, render_template, request
+
+log = logging.getLogger('hvac')
+
+
+class AsyncioMQTT:
+    # Hooks a paho client into an asyncio loop (same approach as paho's loop_asyncio example).
+    # paho calls the socket callbacks on the thread that uses the client: connect() runs in an
+    # executor so DNS and the TCP handshake do not block the loop, and those calls are handed
+    # over to the loop.
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.thread = threading.get_ident()
+        self.client = client
+        self.misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_loop(self, function, *args):
+        if threading.get_ident() == self.thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.on_loop(self.opened, client, sock)
+
+    def opened(self, client, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.on_loop(self.closed, sock)
+
+    def closed(self, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.on_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.on_loop(self.loop.remove_writer, sock)
+
+    async def misc_loop(self):
+        # Keepalive pings and retries
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class AsyncController:
+    def __init__(self, core):
+        # core is the main module: its globals and functions are the controller
+        self.core = core
+        self.wake = asyncio.Event()
+        self.state_changed = asyncio.Condition()
+        self.disconnected = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+
+    def on_message(self, client, userdata, msg):
+        self.core.on_message(client, userdata, msg)
+        self.wake.set()
+
+    def on_disconnect(self, client, userdata, rc):
+        self.core.on_disconnect(client, userdata, rc)
+        self.disconnected.set()
+
+    def submit_input(self, key, value):
+        # Replaces main.submit_input: the deadline scheduler thread must wake the loop
+        self.core.control_inputs.put(key, value)
+        self.loop.call_soon_threadsafe(self.wake.set)
+
+    def run_on_loop(self, function, *args):
+        # Replaces main.run_on_controller: calls from other threads (the supervisor commands)
+        # run on the loop, which owns the MQTT client's sockets, and are waited for
+        future = concurrent.futures.Future()
+
+        def call():
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(call)
+        return future.result()
+
+    async def control_loop(self):
+        # Coroutine version of control_loop.ControlLoop
+        core = self.core
+        loop_stats = core.control_loop
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            remaining = loop_stats.last_evaluation + loop_stats.sample_time - time.time()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            values = core.control_inputs.take()
+            if not values:
+                continue
+            started = time.time()
+            try:
+                core.process_inputs(values)
+            except Exception:
+                log.exception("Control loop evaluation failed")
+            loop_stats.last_evaluation = started
+            loop_stats.last_duration = time.time() - started
+            loop_stats.evaluations += 1
+            async with self.state_changed:
+                self.state_changed.notify_all()
+
+    async def mqtt_session(self):
+        # Coroutine version of mqtt_session.MQTTSession, with the same jittered backoff
+        core = self.core
+        client = core.mqtt_client
+        while True:
+            try:
+                self.disconnected.clear()
+                await self.loop.run_in_executor(None, client.connect, core.mqtt_broker, core.mqtt_port, 60)
+                await self.disconnected.wait()
+            except OSError as e:
+                log.warning("MQTT connect to %s:%s failed: %s", core.mqtt_broker, core.mqtt_port, e)
+            await asyncio.sleep(core.mqtt_backoff.next())
+
+    async def heartbeat(self):
+        publisher = self.core.relay_publisher
+        while publisher.heartbeat_interval:
+            await asyncio.sleep(publisher.heartbeat_interval / 2)
+            publisher.heartbeat()
+
+    async def journal_sync(self):
+        # The flusher thread's job: fsync and compaction, off the loop since both block on disk
+        journal = self.core.state_journal
+        while journal is not None:
+            await asyncio.sleep(journal.fsync_interval)
+            try:
+                await asyncio.to_thread(journal.maintain)
+            except OSError as e:
+                log.warning("State journal maintenance failed: %s", e)
+
+    async def events(self):
+        # Async Server-Sent Events stream over the shared StateBroadcaster: an idle client
+        # is a suspended coroutine, not a thread
+        broadcaster = self.core.state_broadcaster
+        version = broadcaster.version
+        yield ('retry: 5000\nid: %d\ndata: %s\n\n' % (version, broadcaster.state_payload)).encode()
+        while True:
+            async with self.state_changed:
+                try:
+                    await asyncio.wait_for(self.state_changed.wait_for(lambda: broadcaster.version != version),
+                                           broadcaster.keepalive)
+                except asyncio.TimeoutError:
+                    payload = None
+                else:
+                    payload = broadcaster.delta_payload if broadcaster.version == version + 1 \
+                        else broadcaster.state_payload
+                    version = broadcaster.version
+            if payload is None:
+                yield b': keep-alive\n\n'
+            else:
+                yield ('id: %d\ndata: %s\n\n' % (version, payload)).encode()
+
+
+def create_app(core, controller):
+    # Thin adapters over the request handling in main.py, shared with the Flask routes.
+    # Handlers that queue control inputs are followed by controller.wake.set().
+    app = Quart(__name__, template_folder=core.app.template_folder, root_path=core.app.root_path)
+
+    @app.route('/set_temperature', methods=['POST'])
+    async def set_temp():
+        body, status = core.set_temperature_request((await request.form).get('set_temperature'))
+        controller.wake.set()
+        return jsonify(body), status
+
+    @app.route('/pid_gains', methods=['GET', 'POST'])
+    async def pid_gains():
+        body, status = core.pid_gains_request(request.method, await request.get_json(silent=True))
+        controller.wake.set()
+        return jsonify(body), status
+
+    @app.route('/')
+    async def index():
+        return await render_template('index.html', **dict(core.dashboard_context(), stream=True))
+
+    @app.route('/get_hvac_state')
+    async def get_hvac_state():
+        return jsonify(core.hvac_state())
+
+    @app.route('/get_pid_calculation')
+    async def get_pid_calculation():
+        return jsonify({'pid_calculation': core.pid.get_pid_value()})
+
+    @app.route('/history')
+    async def history():
+        body, status = core.history_request(request.args)
+        return jsonify(body), status
+
+    @app.route('/metrics')
+    async def get_metrics():
+        return Response(core.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/get_control_stats')
+    async def get_control_stats():
+        return jsonify(core.control_stats())
+
+    @app.route('/stream')
+    async def stream():
+        response = Response(controller.events(), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        response.timeout = None
+        return response
+
+    @app.route('/get_current_temperature')
+    async def get_current_temperature():
+        return jsonify({'current_temperature': core.current_temperature})
+
+    @app.route('/api/state')
+    async def get_api_state():
+        status, body, headers = core.api_state_response(request.headers.get('If-None-Match'),
+                                                        request.headers.get('Accept-Encoding'))
+        return Response(body, status=status, headers=headers)
+
+    @app.route('/api/zones', methods=['GET', 'POST'])
+    async def api_zones():
+        if request.method == 'POST':
+            body, status = core.api_setpoints(await request.get_json(silent=True))
+            controller.wake.set()
+            return jsonify(body), status
+        status, body, headers = core.api_zones_response(request.args.get('ids'), request.headers.get('If-None-Match'),
+                                                        request.headers.get('Accept-Encoding'))
+        return Response(body, status=status, headers=headers)
+
+    @app.route('/schedules')
+    async def get_schedules():
+        return jsonify(core.schedules_state())
+
+    @app.route('/schedules/<zone_id>', methods=['GET', 'PUT', 'DELETE'])
+    async def zone_schedule(zone_id):
+        body, status = core.schedule_request(request.method, zone_id, await request.get_json(silent=True))
+        return jsonify(body), status
+
+    @app.route('/schedules/<zone_id>/override', methods=['POST', 'DELETE'])
+    async def zone_override(zone_id):
+        body, status = core.schedule_request(request.method, zone_id, await request.get_json(silent=True),
+                                             override=True)
+        return jsonify(body), status
+
+    @app.route('/get_zone_state/<zone_id>')
+    async def get_zone_state(zone_id):
+        body, status = core.zone_state_request(zone_id)
+        return jsonify(body), status
+
+    return app
+
+
+async def serve(core, host='0.0.0.0', port=5000):
+    loop = asyncio.get_running_loop()
+    controller = AsyncController(core)
+    client = core.mqtt_client
+    client.on_connect = core.on_connect
+    client.on_message = controller.on_message
+    client.on_disconnect = controller.on_disconnect
+    AsyncioMQTT(loop, client)
+    core.submit_input = controller.submit_input
+    # Schedule changes publish to MQTT, which must happen on the loop that drives the client
+    core.schedule_engine.apply = lambda zone_id, value: loop.call_soon_threadsafe(
+        core.apply_scheduled_setpoint, zone_id, value)
+    core.run_on_controller = controller.run_on_loop
+    core.deadline_scheduler.start()
+    if core.supervised:
+        threading.Thread(target=core.supervisor_commands, name='supervisor-commands', daemon=True).start()
+    app = create_app(core, controller)
+    # One shutdown for everything: hypercorn gets the trigger instead of its own signal
+    # handlers, so SIGTERM/SIGINT stop MQTT and the control loop along with HTTP
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    tasks = [loop.create_task(controller.mqtt_session()), loop.create_task(controller.control_loop()),
+             loop.create_task(stopping.wait())]
+    if core.relay_publisher.heartbeat_interval:
+        tasks.append(loop.create_task(controller.heartbeat()))
+    if core.state_journal is not None:
+        tasks.append(loop.create_task(controller.journal_sync()))
+    server = loop.create_task(app.run_task(host=host, port=port, shutdown_trigger=stopping.wait))
+    done, pending = await asyncio.wait(tasks + [server], return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+        if not task.cancelled() and task.exception() is not None:
+            log.error("%s stopped", task.get_coro().__qualname__, exc_info=task.exception())
+    log.info("Shutting down")
+    stopping.set()
+    for task in pending:
+        if task is not server:
+            task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    client.disconnect()
+    if core.state_journal is not None:
+        core.state_journal.sync()
+
+
+def run(core, host='0.0.0.0', port=5000):
+    asyncio.run(serve(core, host, port))
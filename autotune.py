@@ -0,0 +1,269 @@
+# Offline PID auto-tuning from recorded history (HISTORY_DIR). Fits a first-order-plus-dead-time
+# model of the house to the recorded temperature and relay history, then simulates the
+# controller against it for a grid of (Kp, Ki, Kd, windup_guard) and ranks the gain sets.
+#
+#   python autotune.py --history /var/lib/hvac/history --days 14
+#   python autotune.py --history /var/lib/hvac/history --kp 0.05,0.1,0.3 --output tuned.json
+#   python autotune.py --history /var/lib/hvac/history --apply http://localhost:5000
+#
+# Every candidate chunk is simulated as one set of NumPy arrays (batch_pid.BatchController runs
+# the same decision rules as the live controller) and the chunks run in a process pool.
+import argparse
+import itertools
+import json
+import os
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from batch_pid import BatchController
+from history import HistoryStore
+
+DAY = 86400.0
+
+DEFAULT_KP = [0.03, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0]
+DEFAULT_KI = [0.0, 0.0001, 0.0003, 0.001, 0.003]
+DEFAULT_KD = [0.0, 30.0, 300.0, 3000.0]
+DEFAULT_WINDUP = [5.0, 20.0, 60.0]
+
+
+def load_history(directory, days, now=None):
+    # Raw history rows of the last days days
+    if now is None:
+        now = time.time()
+    store = HistoryStore(directory, capacity=1, readonly=True, peers=os.path.join(directory, 'shard-*'))
+    return store.rows(now - days * DAY, now)
+
+
+def resample(rows, period):
+    # Mean of every column per period seconds. Empty periods are NaN.
+    times = rows[:, 0]
+    start = times[0]
+    bucket = ((times - start) // period).astype(np.intp)
+    count = np.bincount(bucket)
+    result = np.full((len(count), rows.shape[1]), np.nan)
+    present = count > 0
+    for column in range(1, rows.shape[1]):
+        result[present, column] = np.bincount(bucket, weights=rows[:, column])[present] / count[present]
+    result[:, 0] = start + period * np.arange(len(count))
+    return result
+
+
+def fit_fopdt(samples, period, max_dead_time=1800.0):
+    # Least squares fit of
+    #   dT/dt = (T_out - T) / time_constant + heating_gain * heating(t - dead_time)
+    #           - cooling_gain * cooling(t - dead_time) + offset
+    # with heating/cooling the relay duty cycles, trying every dead time up to max_dead_time.
+    temperature = samples[:, 1]
+    outdoor = samples[:, 2]
+    heating = samples[:, 7]
+    cooling = samples[:, 6]
+    best = None
+    for delay in range(int(max_dead_time // period) + 1):
+        k = np.arange(delay, len(samples) - 1)
+        rate = (temperature[k + 1] - temperature[k]) / period
+        X = np.column_stack((outdoor[k] - temperature[k], heating[k - delay], -cooling[k - delay],
+                             np.ones(len(k))))
+        valid = ~np.isnan(rate) & ~np.isnan(X).any(axis=1)
+        if valid.sum() < 10:
+            continue
+        coefficients, residual, rank, singular = np.linalg.lstsq(X[valid], rate[valid], rcond=None)
+        rms = float(np.sqrt(np.mean((X[valid] @ coefficients - rate[valid]) ** 2)))
+        if best is None or rms < best[0]:
+            best = (rms, delay, coefficients, int(valid.sum()))
+    if best is None:
+        raise ValueError("not enough history to fit a model")
+    rms, delay, (leak, heating_gain, cooling_gain, offset), used = best
+    return {
+        'time_constant': 1 / leak if leak > 0 else float('inf'),
+        'leak': float(leak),
+        'heating_gain': float(heating_gain),
+        'cooling_gain': float(cooling_gain),
+        'offset': float(offset),
+        'dead_time': delay * period,
+        'dead_time_steps': delay,
+        'period': period,
+        'rms_residual': rms,
+        'samples': used,
+    }
+
+
+def simulate_gains(model, outdoor, set_temperature, initial_temperature, gains, min_off_time=0.0):
+    # Simulate one controller per row of gains (Kp, Ki, Kd, windup_guard) against the model,
+    # with outdoor[k] the outdoor temperature of step k. Returns a dict of per-candidate arrays.
+    n = len(gains)
+    period = model['period']
+    controller = BatchController(n, set_temperature, now=0.0, min_off_time=min_off_time)
+    for i in range(n):
+        controller.add_zone(i)
+    pid = controller.pid
+    pid.Kp[:], pid.Ki[:], pid.Kd[:], pid.windup_guard[:] = gains.T
+    controller.avg_external_temperature[:] = np.nanmean(outdoor)
+    index = np.arange(n)
+
+    delay = model['dead_time_steps']
+    heating_history = np.zeros((delay + 1, n), dtype=bool)
+    cooling_history = np.zeros((delay + 1, n), dtype=bool)
+    temperature = np.full(n, initial_temperature, dtype=np.float64)
+    direction = 1.0 if initial_temperature >= set_temperature else -1.0
+    crossed = np.zeros(n, dtype=bool)
+    overshoot = np.zeros(n)
+    abs_error = np.zeros(n)
+    squared_error = np.zeros(n)
+    cycles = np.zeros(n, dtype=np.int64)
+    heating_steps = np.zeros(n, dtype=np.int64)
+    cooling_steps = np.zeros(n, dtype=np.int64)
+    heating = np.zeros(n, dtype=bool)
+    cooling = np.zeros(n, dtype=bool)
+
+    for k, out in enumerate(outdoor):
+        controller.current_temperature[:] = temperature
+        controller.external_temperature[:] = out
+        controller.step(k * period, index)
+        cycles += (controller.heating_state & ~heating) + (controller.cooling_state & ~cooling)
+        heating = controller.heating_state.copy()
+        cooling = controller.cooling_state.copy()
+        heating_steps += heating
+        cooling_steps += cooling
+        heating_history[k % (delay + 1)] = heating
+        cooling_history[k % (delay + 1)] = cooling
+
+        error = temperature - set_temperature
+        abs_error += np.abs(error)
+        squared_error += error * error
+        # Overshoot: furthest excursion past the setpoint once it has been crossed
+        crossed |= direction * error < 0
+        overshoot = np.where(crossed, np.maximum(overshoot, -direction * error), overshoot)
+
+        slot = (k - delay) % (delay + 1)
+        temperature = temperature + period * (model['leak'] * (out - temperature) + model['offset'] +
+                                              model['heating_gain'] * heating_history[slot] -
+                                              model['cooling_gain'] * cooling_history[slot])
+
+    steps = len(outdoor)
+    days = steps * period / DAY
+    return {
+        'mean_abs_error': abs_error / steps,
+        'rms_error': np.sqrt(squared_error / steps),
+        'overshoot': overshoot,
+        'cycles_per_day': cycles / days,
+        'heating_hours_per_day': heating_steps * period / 3600 / days,
+        'cooling_hours_per_day': cooling_steps * period / 3600 / days,
+    }
+
+
+def simulate_chunk(args):
+    return simulate_gains(*args)
+
+
+def search(model, outdoor, set_temperature, initial_temperature, gains, workers=None, chunk_size=64,
+           cycle_penalty=0.05, min_off_time=0.0):
+    # Simulate every gain set (chunks in parallel) and rank them by
+    # rms error + cycle_penalty * cycles per day, best first
+    chunks = [gains[i:i + chunk_size] for i in range(0, len(gains), chunk_size)]
+    jobs = [(model, outdoor, set_temperature, initial_temperature, chunk, min_off_time) for chunk in chunks]
+    if len(jobs) == 1:
+        parts = [simulate_chunk(jobs[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(simulate_chunk, jobs))
+    metrics = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    score = metrics['rms_error'] + cycle_penalty * metrics['cycles_per_day']
+    results = []
+    for i in np.argsort(score, kind='stable'):
+        result = {
+            'Kp': float(gains[i, 0]), 'Ki': float(gains[i, 1]), 'Kd': float(gains[i, 2]),
+            'windup_guard': float(gains[i, 3]), 'score': float(score[i]),
+        }
+        for name, values in metrics.items():
+            result[name] = float(values[i])
+        results.append(result)
+    return results
+
+
+def apply_gains(url, result):
+    # POST the gains to a running controller's /pid_gains route
+    body = json.dumps({key: result[key] for key in ('Kp', 'Ki', 'Kd', 'windup_guard')}).encode()
+    request = urllib.request.Request(url.rstrip('/') + '/pid_gains', data=body,
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def parse_values(text):
+    return [float(value) for value in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune the PID gains against a model fitted to recorded history')
+    parser.add_argument('--history', required=True, help='HISTORY_DIR of the controller (with a supervisor, its shard-<n> directories are included)')
+    parser.add_argument('--days', type=float, default=14.0, help='how much history to use')
+    parser.add_argument('--period', type=float, default=60.0, help='model and simulation step in seconds')
+    parser.add_argument('--max-dead-time', type=float, default=1800.0, help='longest dead time to try, seconds')
+    parser.add_argument('--set-temperature', type=float, help='default: the mean recorded setpoint')
+    parser.add_argument('--kp', type=parse_values, default=DEFAULT_KP, help='comma separated list')
+    parser.add_argument('--ki', type=parse_values, default=DEFAULT_KI, help='comma separated list')
+    parser.add_argument('--kd', type=parse_values, default=DEFAULT_KD, help='comma separated list')
+    parser.add_argument('--windup', type=parse_values, default=DEFAULT_WINDUP, help='comma separated list')
+    parser.add_argument('--cycle-penalty', type=float, default=0.05,
+                        help='score = rms error + cycle_penalty * relay cycles per day')
+    parser.add_argument('--min-off-time', type=float, default=float(os.environ.get('MIN_OFF_TIME', 0)),
+                        help='MIN_OFF_TIME of the controller, seconds')
+    parser.add_argument('--workers', type=int, default=None, help='process pool size (default: CPU count)')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--output', help='write the model and ranked results as JSON to this file')
+    parser.add_argument('--apply', metavar='URL', help='load the best gains into the controller at URL')
+    args = parser.parse_args()
+
+    rows = load_history(args.history, args.days)
+    if not len(rows):
+        parser.error('no history in %s' % args.history)
+    samples = resample(rows, args.period)
+    model = fit_fopdt(samples, args.period, args.max_dead_time)
+    print('model: time_constant=%.1fh heating=%.2f/h cooling=%.2f/h offset=%.2f/h dead_time=%.0fs '
+          'rms_residual=%.3g/h (%d samples)' % (
+              model['time_constant'] / 3600, model['heating_gain'] * 3600, model['cooling_gain'] * 3600,
+              model['offset'] * 3600, model['dead_time'], model['rms_residual'] * 3600, model['samples']))
+    if model['leak'] <= 0 or model['heating_gain'] < 0 or model['cooling_gain'] < 0:
+        print('warning: implausible model, the recorded history may not exercise the relays enough')
+
+    outdoor = samples[:, 2].copy()
+    # Hold the last outdoor reading over gaps in the record
+    missing = np.isnan(outdoor)
+    if missing.all():
+        parser.error('no outdoor temperatures in the history')
+    last = np.where(~missing, np.arange(len(outdoor)), 0)
+    np.maximum.accumulate(last, out=last)
+    outdoor = outdoor[last]
+    outdoor[:np.argmax(~missing)] = outdoor[np.argmax(~missing)]
+    set_temperature = args.set_temperature
+    if set_temperature is None:
+        set_temperature = float(np.nanmean(samples[:, 3]))
+    initial_temperature = float(samples[np.argmax(~np.isnan(samples[:, 1])), 1])
+
+    gains = np.array(list(itertools.product(args.kp, args.ki, args.kd, args.windup)), dtype=np.float64)
+    started = time.perf_counter()
+    results = search(model, outdoor, set_temperature, initial_temperature, gains, args.workers,
+                     cycle_penalty=args.cycle_penalty, min_off_time=args.min_off_time)
+    elapsed = time.perf_counter() - started
+
+    print('%4s %8s %8s %8s %7s %7s %7s %9s %10s %9s %9s' % (
+        'rank', 'Kp', 'Ki', 'Kd', 'windup', 'score', 'rms', 'overshoot', 'cycles/day', 'heat h/d', 'cool h/d'))
+    for rank, result in enumerate(results[:args.top], 1):
+        print('%4d %8g %8g %8g %7g %7.3f %7.3f %9.2f %10.1f %9.1f %9.1f' % (
+            rank, result['Kp'], result['Ki'], result['Kd'], result['windup_guard'], result['score'],
+            result['rms_error'], result['overshoot'], result['cycles_per_day'], result['heating_hours_per_day'],
+            result['cooling_hours_per_day']))
+    print('%d gain sets x %.1f simulated days in %.2f s' % (len(gains), len(outdoor) * args.period / DAY, elapsed))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'model': model, 'set_temperature': set_temperature, 'results': results}, f, indent=2)
+    if args.apply:
+        print(apply_gains(args.apply, results[0]))
+
+
+if __name__ == '__main__':
+    main()
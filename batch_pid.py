@@ -0,0 +1,173 @@
+# Offline/simulation engine: autotune.py and benchmarks/batch_pid.py evaluate whole fleets of
+# zones at once with it. The running controller does not use it; process_inputs() steps the
+# zones of the live ZoneRegistry one at a time with Zone.update_hvac_control().
+import time
+
+import numpy as np
+
+from zones import relay_decision
+
+
+class BatchPID:
+    # Same maths as pid.PID, but every controller is one slot in a set of NumPy arrays
+    def __init__(self, size, P=0.1, I=0.0, D=0.0, now=None):
+        if now is None:
+            now = time.time()
+        self.Kp = np.full(size, P, dtype=np.float64)
+        self.Ki = np.full(size, I, dtype=np.float64)
+        self.Kd = np.full(size, D, dtype=np.float64)
+        self.sample_time = np.zeros(size, dtype=np.float64)
+        self.windup_guard = np.full(size, 20.0, dtype=np.float64)
+        self.SetPoint = np.zeros(size, dtype=np.float64)
+        self.PTerm = np.zeros(size, dtype=np.float64)
+        self.ITerm = np.zeros(size, dtype=np.float64)
+        self.DTerm = np.zeros(size, dtype=np.float64)
+        self.last_error = np.zeros(size, dtype=np.float64)
+        self.last_time = np.full(size, now, dtype=np.float64)
+        self.output = np.zeros(size, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.Kp)
+
+    def resize(self, size, P=0.1, I=0.0, D=0.0, now=None):
+        # Grow (or shrink) every array, new slots start out like a fresh PID()
+        if now is None:
+            now = time.time()
+        old = len(self)
+        fill = {'Kp': P, 'Ki': I, 'Kd': D, 'windup_guard': 20.0, 'last_time': now}
+        for name in ('Kp', 'Ki', 'Kd', 'sample_time', 'windup_guard', 'SetPoint', 'PTerm', 'ITerm', 'DTerm',
+                     'last_error', 'last_time', 'output'):
+            array = np.empty(size, dtype=np.float64)
+            keep = min(old, size)
+            array[:keep] = getattr(self, name)[:keep]
+            array[keep:] = fill.get(name, 0.0)
+            setattr(self, name, array)
+
+    def update(self, feedback, now=None, index=None):
+        # feedback holds one reading per controller in index (all controllers if index is None).
+        # Returns the indices of the controllers that were due and got a new output.
+        if now is None:
+            now = time.time()
+        if index is None:
+            index = np.arange(len(self))
+        else:
+            index = np.asarray(index, dtype=np.intp)
+        feedback = np.asarray(feedback, dtype=np.float64)
+
+        error = self.SetPoint[index] - feedback
+        delta_time = now - self.last_time[index]
+        due = delta_time >= self.sample_time[index]
+        index = index[due]
+        error = error[due]
+        delta_time = delta_time[due]
+        delta_error = error - self.last_error[index]
+
+        p_term = self.Kp[index] * error
+        guard = self.windup_guard[index]
+        i_term = np.clip(self.ITerm[index] + error * delta_time, -guard, guard)
+        d_term = np.divide(delta_error, delta_time, out=np.zeros_like(delta_error), where=delta_time > 0)
+
+        self.PTerm[index] = p_term
+        self.ITerm[index] = i_term
+        self.DTerm[index] = d_term
+        self.last_time[index] = now
+        self.last_error[index] = error
+        self.output[index] = p_term + self.Ki[index] * i_term + self.Kd[index] * d_term
+        return index
+
+
+class BatchController:
+    # Vectorized version of Zone.update_hvac_control() for a whole fleet of simulated zones
+    def __init__(self, capacity=1024, set_temperature=70, now=None, min_off_time=0):
+        self.zone_ids = []
+        # Anti-short-cycle: cooling/heating stay off at least min_off_time seconds once stopped
+        self.min_off_time = min_off_time
+        self.index = {}
+        self.pid = BatchPID(capacity, now=now)
+        self.default_set_temperature = set_temperature
+        self.current_temperature = np.zeros(capacity, dtype=np.float64)
+        self.external_temperature = np.zeros(capacity, dtype=np.float64)
+        self.avg_external_temperature = np.zeros(capacity, dtype=np.float64)
+        self.set_temperature = np.full(capacity, set_temperature, dtype=np.float64)
+        self.fan_state = np.zeros(capacity, dtype=bool)
+        self.cooling_state = np.zeros(capacity, dtype=bool)
+        self.heating_state = np.zeros(capacity, dtype=bool)
+        self.fan_start_time = np.zeros(capacity, dtype=np.float64)
+        self.cooling_start_time = np.zeros(capacity, dtype=np.float64)
+        self.heating_start_time = np.zeros(capacity, dtype=np.float64)
+        self.cooling_stop_time = np.zeros(capacity, dtype=np.float64)
+        self.heating_stop_time = np.zeros(capacity, dtype=np.float64)
+        # Zones with a new reading since the last step
+        self.dirty = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return len(self.zone_ids)
+
+    def _grow(self, capacity):
+        self.pid.resize(capacity)
+        for name in ('current_temperature', 'external_temperature', 'avg_external_temperature', 'set_temperature',
+                     'fan_state', 'cooling_state', 'heating_state', 'fan_start_time', 'cooling_start_time',
+                     'heating_start_time', 'cooling_stop_time', 'heating_stop_time', 'dirty'):
+            old = getattr(self, name)
+            array = np.zeros(capacity, dtype=old.dtype)
+            array[:len(old)] = old
+            if name == 'set_temperature':
+                array[len(old):] = self.default_set_temperature
+            setattr(self, name, array)
+
+    def add_zone(self, zone_id):
+        i = self.index.get(zone_id)
+        if i is not None:
+            return i
+        i = len(self.zone_ids)
+        if i == len(self.current_temperature):
+            self._grow(max(2 * i, 1))
+        self.zone_ids.append(zone_id)
+        self.index[zone_id] = i
+        return i
+
+    def set_value(self, zone_id, attribute, value):
+        # attribute is one of the zones.ZONE_TOPICS attribute names
+        i = self.add_zone(zone_id)
+        getattr(self, attribute)[i] = value
+        self.dirty[i] = True
+
+    def step(self, now=None, index=None):
+        # Evaluate the zones in index (default: every zone with a new reading).
+        # Returns the indices whose relay state changed and need a command published.
+        if now is None:
+            now = time.time()
+        if index is None:
+            index = np.flatnonzero(self.dirty[:len(self.zone_ids)])
+        else:
+            index = np.asarray(index, dtype=np.intp)
+        self.dirty[index] = False
+        if not len(index):
+            return index
+
+        current = self.current_temperature[index]
+        setpoint = self.set_temperature[index]
+        self.pid.SetPoint[index] = setpoint
+        self.pid.update(current, now, index)
+        pid_value = self.pid.output[index]
+
+        fan = self.fan_state[index]
+        cooling = self.cooling_state[index]
+        heating = self.heating_state[index]
+        heat, cool, fan_only, new_fan, new_cooling, new_heating = relay_decision(
+            pid_value, current, setpoint, self.external_temperature[index], self.avg_external_temperature[index],
+            fan, cooling, heating, self.fan_start_time[index], self.cooling_start_time[index],
+            self.heating_start_time[index], self.cooling_stop_time[index], self.heating_stop_time[index],
+            self.min_off_time, now)
+
+        self.heating_start_time[index[heat]] = now
+        self.cooling_start_time[index[cool]] = now
+        self.fan_start_time[index[cool | fan_only]] = now
+        self.fan_state[index] = new_fan
+        self.cooling_state[index] = new_cooling
+        self.heating_state[index] = new_heating
+        self.cooling_stop_time[index[cooling & ~new_cooling]] = now
+        self.heating_stop_time[index[heating & ~new_heating]] = now
+
+        changed = (new_fan != fan) | (new_cooling != cooling) | (new_heating != heating)
+        return index[changed]
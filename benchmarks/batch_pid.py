@@ -0,0 +1,118 @@
+# Controller updates per second: scalar PID/Zone objects vs. the vectorized BatchController.
+#
+#   python benchmarks/batch_pid.py --zones 10000 --steps 50
+import argparse
+import os
+import sys
+import time
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from batch_pid import BatchController  # noqa: E402
+from zones import Zone  # noqa: E402
+
+
+def random_inputs(rng, zones, steps):
+    current = rng.normal(70, 4, size=(steps, zones))
+    external = rng.normal(60, 20, size=(steps, zones))
+    avg_external = rng.normal(60, 10, size=zones)
+    setpoint = rng.normal(70, 2, size=zones)
+    return current, external, avg_external, setpoint
+
+
+def check_equivalence(zones=500, steps=40, seed=1, min_off_time=0):
+    # Drive scalar zones and the batch engine with the same readings and the same clock
+    rng = np.random.default_rng(seed)
+    current, external, avg_external, setpoint = random_inputs(rng, zones, steps)
+    start = 1_700_000_000.0
+    clock = mock.Mock(return_value=start)
+    with mock.patch('pid.time.time', clock), mock.patch('zones.time.time', clock):
+        scalar = [Zone(i, None, clock=clock, min_off_time=min_off_time) for i in range(zones)]
+        batch = BatchController(zones, now=start, min_off_time=min_off_time)
+        for i, zone in enumerate(scalar):
+            zone.pid.Kp, zone.pid.Ki, zone.pid.Kd = 0.4, 0.02, 1.5
+            zone.set_temperature = setpoint[i]
+            zone.avg_external_temperature = avg_external[i]
+            batch.add_zone(i)
+        batch.pid.Kp[:], batch.pid.Ki[:], batch.pid.Kd[:] = 0.4, 0.02, 1.5
+        batch.set_temperature[:zones] = setpoint
+        batch.avg_external_temperature[:zones] = avg_external
+        for step in range(steps):
+            now = start + 37.0 * (step + 1)
+            clock.return_value = now
+            for i, zone in enumerate(scalar):
+                zone.current_temperature = current[step, i]
+                zone.external_temperature = external[step, i]
+                zone.update_hvac_control()
+            batch.current_temperature[:zones] = current[step]
+            batch.external_temperature[:zones] = external[step]
+            batch.step(now, np.arange(zones))
+
+    max_error = 0.0
+    for i, zone in enumerate(scalar):
+        for name in ('PTerm', 'ITerm', 'DTerm', 'last_error', 'last_time', 'output'):
+            max_error = max(max_error, abs(getattr(zone.pid, name) - getattr(batch.pid, name)[i]))
+        if (zone.fan_state, zone.cooling_state, zone.heating_state) != \
+                (batch.fan_state[i], batch.cooling_state[i], batch.heating_state[i]):
+            raise AssertionError('relay state differs for zone %d' % i)
+    if max_error > 1e-9:
+        raise AssertionError('PID state differs by %g' % max_error)
+    return max_error
+
+
+def bench_scalar(zones, steps, seed=0):
+    rng = np.random.default_rng(seed)
+    current, external, avg_external, setpoint = random_inputs(rng, zones, steps)
+    current, external = current.tolist(), external.tolist()
+    scalar = [Zone(i, None) for i in range(zones)]
+    for i, zone in enumerate(scalar):
+        zone.set_temperature = float(setpoint[i])
+        zone.avg_external_temperature = float(avg_external[i])
+    started = time.perf_counter()
+    for step in range(steps):
+        row, ext = current[step], external[step]
+        for i, zone in enumerate(scalar):
+            zone.current_temperature = row[i]
+            zone.external_temperature = ext[i]
+            zone.update_hvac_control()
+    return zones * steps / (time.perf_counter() - started)
+
+
+def bench_batch(zones, steps, seed=0):
+    rng = np.random.default_rng(seed)
+    current, external, avg_external, setpoint = random_inputs(rng, zones, steps)
+    batch = BatchController(zones)
+    for i in range(zones):
+        batch.add_zone(i)
+    batch.set_temperature[:] = setpoint
+    batch.avg_external_temperature[:] = avg_external
+    every_zone = np.arange(zones)
+    started = time.perf_counter()
+    for step in range(steps):
+        batch.current_temperature[:] = current[step]
+        batch.external_temperature[:] = external[step]
+        batch.step(index=every_zone)
+    return zones * steps / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--zones', type=int, default=10000)
+    parser.add_argument('--steps', type=int, default=50)
+    args = parser.parse_args()
+
+    print('equivalence check: max abs difference %.3g' % check_equivalence())
+    # Longer than the 37 s step so lockouts span several evaluations
+    print('equivalence check with MIN_OFF_TIME=120: max abs difference %.3g' % check_equivalence(min_off_time=120))
+    scalar = bench_scalar(args.zones, args.steps)
+    batch = bench_batch(args.zones, args.steps)
+    print('zones=%d steps=%d' % (args.zones, args.steps))
+    print('scalar Zone.update_hvac_control: %12.0f updates/s' % scalar)
+    print('BatchController.step:            %12.0f updates/s (%.1fx)' % (batch, batch / scalar))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+# Benchmarks for the message -> decision -> publish hot path of main.py, driven with a
+# stub MQTT client so no broker is needed.
+#
+#   python benchmarks/hot_path.py                        # writes benchmarks/results/<commit>.json
+#   python benchmarks/hot_path.py --compare benchmarks/results/<older commit>.json
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+# main.py reads its configuration at import time
+for name, value in (('MQTT_USER', 'bench'), ('MQTT_PASSWORD', 'bench'), ('AC_CONTROL_TOPIC', 'bench/ac_control'),
+                    ('TEMPERATURE_TOPIC', 'bench/temperature'),
+                    ('EXTERNAL_TEMPERATURE_TOPIC', 'bench/external_temperature'),
+                    ('AVERAGE_TEMPERATURE_TOPIC', 'bench/average_temperature'),
+                    ('SET_TEMPERATURE_TOPIC', 'set_temperature'), ('TEMP_THRESHOLD', '0.15'),
+                    ('ZONE_TOPIC_PREFIX', 'bench/zones')):
+    os.environ.setdefault(name, value)
+os.environ.pop('HISTORY_DIR', None)
+os.environ['STATE_JOURNAL'] = ''
+
+import main  # noqa: E402
+
+# Warnings about the invalid payload case would otherwise land on stderr
+main.log.addHandler(logging.NullHandler())
+main.log.propagate = False
+from payloads import pack_batch  # noqa: E402
+from pid import PID  # noqa: E402
+
+
+class StubMQTTClient:
+    # Stands in for paho's Client: publish() only counts
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+
+class Message:
+    # Same attributes paho hands to on_message
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class StepClock:
+    # Advances one control period per call so every PID.update is due
+    def __init__(self, step):
+        self.now = 1_700_000_000.0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+def hot_path_cases():
+    zone_topic = main.zone_registry.prefix + '/bench/temperature' if main.zone_registry else None
+    cases = {
+        'temperature_steady': [Message(main.temperature_topic, b'70.0')],
+        'temperature_relay_flip': [Message(main.temperature_topic, b'60.0'),
+                                   Message(main.temperature_topic, b'80.0')],
+        'external_temperature': [Message(main.external_temperature_topic, b'55.5')],
+        'average_temperature': [Message(main.average_temperature_topic, b'60.0')],
+        'set_temperature': [Message(main.set_temperature_topic, b'71.0'),
+                            Message(main.set_temperature_topic, b'72.0')],
+        'temperature_batch_16': [Message(main.temperature_topic,
+                                         pack_batch((i, 69.0 + i / 16) for i in range(16)))],
+        'invalid_payload': [Message(main.temperature_topic, b'not a number')],
+    }
+    if zone_topic:
+        cases['zone_temperature_relay_flip'] = [Message(zone_topic, b'60.0'), Message(zone_topic, b'80.0')]
+    return cases
+
+
+def handle(msg):
+    # One message through the whole path: parse, coalesce, evaluate, publish
+    main.on_message(None, None, msg)
+    values = main.control_inputs.take()
+    if values:
+        main.process_inputs(values)
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def bench_case(messages, count):
+    stub = main.mqtt_client
+    for i in range(min(count, 1000)):
+        handle(messages[i % len(messages)])
+
+    published = stub.published
+    latencies = []
+    perf_counter_ns = time.perf_counter_ns
+    started = perf_counter_ns()
+    for i in range(count):
+        before = perf_counter_ns()
+        handle(messages[i % len(messages)])
+        latencies.append(perf_counter_ns() - before)
+    elapsed = (perf_counter_ns() - started) / 1e9
+    published = stub.published - published
+    latencies.sort()
+
+    # Allocations: transient peak per message and blocks still alive afterwards
+    sample = min(count, 2000)
+    tracemalloc.start()
+    first = tracemalloc.take_snapshot()
+    peak_total = 0
+    for i in range(sample):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        handle(messages[i % len(messages)])
+        peak_total += tracemalloc.get_traced_memory()[1] - current
+    last = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = last.compare_to(first, 'filename')
+
+    return {
+        'messages': count,
+        'messages_per_second': count / elapsed,
+        'p50_us': percentile(latencies, 0.50) / 1000,
+        'p99_us': percentile(latencies, 0.99) / 1000,
+        'max_us': latencies[-1] / 1000,
+        'publishes_per_message': published / count,
+        'peak_bytes_per_message': peak_total / sample,
+        'retained_blocks_per_message': sum(stat.count_diff for stat in retained) / sample,
+    }
+
+
+def bench_pid_update(count):
+    clock = StepClock(1.0)
+    pid = PID(P=0.5, I=0.01, D=2.0, clock=clock)
+    pid.SetPoint = 70.0
+    update = pid.update
+    seconds = min(timeit.repeat(lambda: update(69.5), number=count, repeat=5))
+    return {'calls': count, 'ns_per_call': seconds / count * 1e9, 'calls_per_second': count / seconds}
+
+
+def run(count):
+    stub = StubMQTTClient()
+    main.mqtt_client = stub
+    main.relay_publisher.client = stub
+    # Relay commands are held back until the broker connection is up
+    main.relay_publisher.connected = True
+    clock = StepClock(main.control_sample_time or 1.0)
+    main.clock = clock
+    main.pid.clock = clock
+    main.pid.last_time = clock.now
+    if main.zone_registry is not None:
+        main.zone_registry.clock = clock
+
+    results = {}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        # Outdoor readings that let the relay_flip cases switch between heating and cooling
+        for msg in (Message(main.external_temperature_topic, b'60.0'),
+                    Message(main.average_temperature_topic, b'60.0')):
+            handle(msg)
+        if main.zone_registry is not None:
+            for suffix in ('external_temperature', 'average_temperature'):
+                handle(Message('%s/bench/%s' % (main.zone_registry.prefix, suffix), b'60.0'))
+        for name, messages in hot_path_cases().items():
+            results[name] = bench_case(messages, count)
+    results['pid_update'] = bench_pid_update(count * 10)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(current, baseline, threshold):
+    # Print metric ratios against an older run; returns the number of regressions
+    higher_is_better = ('messages_per_second', 'calls_per_second')
+    regressions = 0
+    for case, metrics in current['results'].items():
+        old = baseline['results'].get(case)
+        if old is None:
+            continue
+        for metric, value in metrics.items():
+            if metric not in old or not old[metric] or metric in ('messages', 'calls'):
+                continue
+            ratio = value / old[metric]
+            worse = ratio < 1 - threshold if metric in higher_is_better else ratio > 1 + threshold
+            if worse and metric != 'max_us':
+                regressions += 1
+            print('%-24s %-28s %12.3f -> %12.3f  %6.2fx%s' % (
+                case, metric, old[metric], value, ratio, '  REGRESSION' if worse else ''))
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Benchmark the MQTT message hot path')
+    parser.add_argument('--messages', type=int, default=20000, help='messages per case')
+    parser.add_argument('--output', help='JSON result file (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='earlier JSON result file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative change reported as regression')
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': run(args.messages),
+    }
+    for case, metrics in report['results'].items():
+        print('%-24s %s' % (case, ' '.join('%s=%.3g' % item for item in metrics.items())))
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', '%s.json' % report['commit'])
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to', output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,537 @@
+# Synthetic sensor fleet for capacity planning. N thermostats (zones <prefix>/th<i>/...) publish
+# temperature readings that alternate between heating and cooling demand, so every reading the
+# controller evaluates flips that zone's relays and produces a command on <prefix>/th<i>/control
+# (relay commands are only published on change). The time from publishing a reading to
+# receiving its command is the end-to-end control latency. The total reading rate is raised
+# step by step until the latency SLO or delivery breaks; the last good step is the maximum
+# sustainable rate, and the report turns it into a fleet size per instance.
+#
+#   python benchmarks/load_generator.py --thermostats 500                  # in-process, no broker
+#   python benchmarks/load_generator.py --target broker --thermostats 2000  # main.py + local minibroker
+#   python benchmarks/load_generator.py --target broker --broker 10.0.0.105:1883 --workers 4
+#   python benchmarks/load_generator.py --rate 200 --pattern burst --burst-interval 5
+#
+# --target inprocess calls main.on_message directly (as paho's network thread would) with a
+# fake client capturing the relay commands: it measures the controller alone, and the
+# generator shares its CPU. --target broker runs main.py (SUPERVISOR_WORKERS=--workers when
+# above 1) as a separate process against --broker, or against minibroker.py in another process.
+# minibroker is far slower than a production broker, so size with --broker pointing at one.
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from time import perf_counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+PREFIX = 'load/zones'
+# Outdoor readings and setpoint of every thermostat: 60 asks for heating, 80 for cooling
+OUTDOOR = b'60.0'
+HEATING_READING = b'60.0'
+COOLING_READING = b'80.0'
+
+
+def controller_env(broker_host, broker_port, sample_time):
+    # Configuration of main.py for a run: zones under PREFIX, no persistence, no heartbeat
+    env = {
+        'MQTT_BROKER': broker_host,
+        'MQTT_PORT': str(broker_port),
+        'MQTT_USER': os.environ.get('MQTT_USER', 'load'),
+        'MQTT_PASSWORD': os.environ.get('MQTT_PASSWORD', 'load'),
+        'MQTT_CLIENT_ID': 'load-controller',
+        'MQTT_CLEAN_SESSION': '1',
+        'MQTT_RECONNECT_MIN': '0.2',
+        'AC_CONTROL_TOPIC': 'load/ac_control',
+        'TEMPERATURE_TOPIC': 'load/temperature',
+        'EXTERNAL_TEMPERATURE_TOPIC': 'load/external_temperature',
+        'AVERAGE_TEMPERATURE_TOPIC': 'load/average_temperature',
+        'SET_TEMPERATURE_TOPIC': 'load/set_temperature',
+        'TEMP_THRESHOLD': '0.15',
+        'ZONE_TOPIC_PREFIX': PREFIX,
+        'STATE_JOURNAL': '',
+        'CONTROL_HEARTBEAT': '0',
+        'CONTROL_SAMPLE_TIME': str(sample_time),
+        'LOG_LEVEL': 'WARNING',
+    }
+    return env
+
+
+class LatencyCollector:
+    # Matches each relay command to the reading that caused it: the latest reading of that
+    # zone asking for the commanded state and published before the command arrived. Readings
+    # before it were superseded (coalesced by the control loop before being evaluated).
+    def __init__(self, count):
+        self.lock = threading.Lock()
+        # Per thermostat: (time published, heating wanted) not matched yet
+        self.pending = [collections.deque() for _ in range(count)]
+        # Per thermostat: heating state of the last command, None before the first
+        self.commanded = [None] * count
+        self.latencies = []
+        self.superseded = 0
+        self.unexpected = 0
+
+    def sent(self, index, heating, at):
+        with self.lock:
+            self.pending[index].append((at, heating))
+
+    def command(self, index, heating, at):
+        with self.lock:
+            self.commanded[index] = heating
+            pending = self.pending[index]
+            match = None
+            for i, (sent, wanted) in enumerate(pending):
+                if sent > at:
+                    break
+                if wanted == heating:
+                    match = i
+            if match is None:
+                self.unexpected += 1
+                return
+            self.latencies.append(at - pending[match][0])
+            self.superseded += match
+            for _ in range(match + 1):
+                pending.popleft()
+
+    def unanswered(self):
+        # Zones whose latest reading still waits for its command. Earlier readings of a zone
+        # never get one if the control loop coalesced them, and a reading asking for the state
+        # the relays already have needs none.
+        count = 0
+        for pending, commanded in zip(self.pending, self.commanded):
+            if pending and pending[-1][1] != commanded:
+                count += 1
+        return count
+
+    def drain(self, timeout):
+        # Wait until every zone's latest reading got its command, or the timeout
+        deadline = perf_counter() + timeout
+        while perf_counter() < deadline:
+            with self.lock:
+                if not self.unanswered():
+                    return
+            time.sleep(0.05)
+
+    def take(self):
+        # Results since the last take(): a zone's unanswered latest reading counts as lost, the
+        # readings before it as superseded
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            superseded, self.superseded = self.superseded, 0
+            unexpected, self.unexpected = self.unexpected, 0
+            lost = self.unanswered()
+            for pending in self.pending:
+                superseded += len(pending)
+                pending.clear()
+            superseded -= lost
+        return latencies, superseded, lost, unexpected
+
+
+class Fleet:
+    # The thermostats: which reading each sends next, and the topics
+    def __init__(self, count, collector, publish):
+        self.count = count
+        self.collector = collector
+        self.publish = publish
+        self.heating = [False] * count
+        self.temperature_topics = ['%s/th%d/temperature' % (PREFIX, i) for i in range(count)]
+        self.control_topics = {'%s/th%d/control' % (PREFIX, i): i for i in range(count)}
+
+    def send_outdoor(self, retain):
+        for i in range(self.count):
+            for suffix in ('external_temperature', 'average_temperature'):
+                self.publish('%s/th%d/%s' % (PREFIX, i, suffix), OUTDOOR, retain)
+
+    def send(self, index):
+        heating = self.heating[index] = not self.heating[index]
+        self.collector.sent(index, heating, perf_counter())
+        self.publish(self.temperature_topics[index], HEATING_READING if heating else COOLING_READING, False)
+
+    def on_command(self, topic, payload):
+        index = self.control_topics.get(topic)
+        if index is not None:
+            self.collector.command(index, json.loads(payload)['heating'] == 'heating_on', perf_counter())
+
+
+def arrival_times(pattern, rate, duration, burst_interval, rng):
+    # Offsets in seconds of one step's readings, `rate` per second on average
+    if pattern == 'steady':
+        return [i / rate for i in range(int(rate * duration))]
+    if pattern == 'poisson':
+        times = []
+        t = rng.expovariate(rate)
+        while t < duration:
+            times.append(t)
+            t += rng.expovariate(rate)
+        return times
+    # burst: a whole interval's readings at once every burst_interval seconds, like a fleet
+    # of sensors reporting on the same clock
+    per_burst = max(1, int(round(rate * burst_interval)))
+    return [k * burst_interval for k in range(max(1, int(duration / burst_interval))) for _ in range(per_burst)]
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class InProcessTarget:
+    # main.py imported here, MQTT replaced by direct on_message calls and a capturing client
+    name = 'inprocess'
+
+    def __init__(self, sample_time):
+        os.environ.update(controller_env('127.0.0.1', 1883, sample_time))
+        os.environ.pop('HISTORY_DIR', None)
+        import logging
+        import main
+        main.log.addHandler(logging.NullHandler())
+        main.log.propagate = False
+        self.main = main
+        self.fleet = None
+
+    def start(self, fleet):
+        main = self.main
+        self.fleet = fleet
+
+        class CapturingClient:
+            def publish(self, topic, payload=None, qos=0, retain=False):
+                fleet.on_command(topic, payload)
+
+            def subscribe(self, topic, qos=0):
+                pass
+
+        class Message:
+            __slots__ = ('topic', 'payload')
+
+            def __init__(self, topic, payload):
+                self.topic = topic
+                self.payload = payload
+
+        main.mqtt_client = main.relay_publisher.client = CapturingClient()
+        main.relay_publisher.connected = True
+        main.control_loop.start()
+        on_message = main.on_message
+        fleet.publish = lambda topic, payload, retain: on_message(None, None, Message(topic, payload))
+
+    def cpu_seconds(self):
+        # Includes the generator, which runs in the same process
+        return time.process_time()
+
+    def stop(self):
+        self.main.control_loop.stop()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), 0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+class BrokerTarget:
+    # main.py in its own process (a supervisor with `workers` workers when above 1) and a paho
+    # client per direction in this one
+    name = 'broker'
+
+    def __init__(self, sample_time, broker, workers, qos, exact_subscriptions):
+        import paho.mqtt.client as mqtt
+        self.mqtt = mqtt
+        self.sample_time = sample_time
+        self.workers = workers
+        self.qos = qos
+        self.exact_subscriptions = exact_subscriptions
+        self.broker_process = None
+        if broker:
+            host, _, port = broker.partition(':')
+            self.host, self.port = host, int(port or 1883)
+            self.broker_name = broker
+        else:
+            self.host, self.port = '127.0.0.1', free_port()
+            self.broker_process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'minibroker.py'),
+                                                    '--port', str(self.port)])
+            self.broker_name = 'minibroker'
+            if not wait_for_port(self.host, self.port):
+                raise SystemExit('minibroker did not start')
+        self.controller = None
+        self.clients = []
+
+    def client(self, client_id):
+        client = self.mqtt.Client(client_id=client_id)
+        client.username_pw_set(os.environ.get('MQTT_USER', 'load'), os.environ.get('MQTT_PASSWORD', 'load'))
+        client.max_inflight_messages_set(1000)
+        client.max_queued_messages_set(0)
+        client.connect(self.host, self.port)
+        client.loop_start()
+        self.clients.append(client)
+        return client
+
+    def start(self, fleet):
+        env = dict(os.environ)
+        env.update(controller_env(self.host, self.port, self.sample_time))
+        env['WEB_PORT'] = str(free_port())
+        if self.workers > 1:
+            env['SUPERVISOR_WORKERS'] = str(self.workers)
+            env['SHARD_WEB_PORT'] = str(random.randrange(20000, 60000 - self.workers))
+        if self.exact_subscriptions:
+            env['ZONE_IDS'] = ','.join('th%d' % i for i in range(fleet.count))
+        self.controller = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')], env=env)
+
+        watcher = self.client('load-watcher')
+        watcher.on_message = lambda client, userdata, msg: fleet.on_command(msg.topic, msg.payload)
+        watcher.subscribe('%s/+/control' % PREFIX, self.qos)
+        sensors = self.client('load-sensors')
+        qos = self.qos
+        fleet.publish = lambda topic, payload, retain: sensors.publish(topic, payload, qos, retain)
+
+    def cpu_seconds(self):
+        # Controller process and its workers, from /proc (None where that does not exist)
+        pids = {self.controller.pid}
+        try:
+            for entry in os.listdir('/proc'):
+                if entry.isdigit():
+                    with open('/proc/%s/stat' % entry) as f:
+                        fields = f.read().rsplit(')', 1)[1].split()
+                    if int(fields[1]) in pids or int(fields[1]) == self.controller.pid:
+                        pids.add(int(entry))
+            total = 0
+            for pid in pids:
+                with open('/proc/%d/stat' % pid) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                total += int(fields[11]) + int(fields[12])
+            return total / os.sysconf('SC_CLK_TCK')
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def stop(self):
+        for client in self.clients:
+            client.loop_stop()
+            client.disconnect()
+        for process in (self.controller, self.broker_process):
+            if process is not None:
+                process.terminate()
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+
+def warm_up(fleet, collector, timeout, rounds=2):
+    # Outdoor readings, then a few readings per thermostat: creates every zone, proves the
+    # whole path works and lets start-up work (subscriptions, retained messages) finish before
+    # measuring. Returns the number of thermostats that answered.
+    fleet.send_outdoor(retain=True)
+    time.sleep(0.5)
+    for _ in range(rounds):
+        for i in range(fleet.count):
+            fleet.send(i)
+        collector.drain(timeout)
+    answered = sum(1 for heating in collector.commanded if heating is not None)
+    collector.take()
+    return answered
+
+
+def run_step(fleet, collector, target, rate, args, rng):
+    times = arrival_times(args.pattern, rate, args.step_seconds, args.burst_interval, rng)
+    cpu_before = target.cpu_seconds()
+    index = 0
+    lag = 0.0
+    start = perf_counter()
+    for offset in times:
+        due = start + offset
+        now = perf_counter()
+        if due - now > 0.0005:
+            time.sleep(due - now)
+        elif now - due > lag:
+            lag = now - due
+        fleet.send(index)
+        index = (index + 1) % fleet.count
+    sending = perf_counter() - start
+    collector.drain(args.drain)
+    cpu_after = target.cpu_seconds()
+    elapsed = perf_counter() - start
+    latencies, superseded, lost, unexpected = collector.take()
+    latencies.sort()
+    sent = len(times)
+    step = {
+        'offered_rate': rate,
+        'sent': sent,
+        'send_rate': sent / sending if sending > 0 else 0.0,
+        'generator_lag_s': lag,
+        'commands': len(latencies),
+        'superseded': superseded,
+        'lost': lost,
+        'unexpected_commands': unexpected,
+        'cpu_percent': None if cpu_before is None or cpu_after is None else 100 * (cpu_after - cpu_before) / elapsed,
+    }
+    if latencies:
+        step.update({
+            'p50_ms': 1000 * percentile(latencies, 0.50),
+            'p95_ms': 1000 * percentile(latencies, 0.95),
+            'p99_ms': 1000 * percentile(latencies, 0.99),
+            'max_ms': 1000 * latencies[-1],
+        })
+    # Sustained: commands kept up within the SLO and (almost) no zone was left without one
+    step['generator_limited'] = step['send_rate'] < 0.95 * rate and args.pattern != 'burst'
+    step['sustained'] = bool(latencies) and step['p99_ms'] <= args.slo_ms and \
+        lost <= args.max_loss * min(sent, fleet.count)
+    return step
+
+
+def print_step(step):
+    print('%9.1f/s sent=%-7d send_rate=%9.1f/s commands=%-7d superseded=%-6d lost=%-6d p50=%s p99=%s max=%s cpu=%s%s' % (
+        step['offered_rate'], step['sent'], step['send_rate'], step['commands'], step['superseded'], step['lost'],
+        *('%.1fms' % step[key] if key in step else '-' for key in ('p50_ms', 'p99_ms', 'max_ms')),
+        '-' if step['cpu_percent'] is None else '%.0f%%' % step['cpu_percent'],
+        '' if step['sustained'] else '  OVER SLO' if step['commands'] else '  NO COMMANDS'))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def sizing(steps, args):
+    # The highest sustained rate, and how many thermostats that serves at the given reading interval
+    sustained = [step for step in steps if step['sustained']]
+    if not sustained:
+        return {'max_sustainable_rate': None}
+    best = max(sustained, key=lambda step: step['send_rate'])
+    rate = min(best['offered_rate'], best['send_rate'])
+    return {
+        'max_sustainable_rate': rate,
+        'p99_ms_at_max': best['p99_ms'],
+        'cpu_percent_at_max': best['cpu_percent'],
+        'lower_bound': best['generator_limited'] or best is steps[-1],
+        'reading_interval_s': args.reading_interval,
+        'headroom': args.headroom,
+        'thermostats_per_instance': int(rate * args.reading_interval * args.headroom),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Emulate a fleet of thermostats and find the sustainable message rate')
+    parser.add_argument('--target', choices=('inprocess', 'broker'), default='inprocess')
+    parser.add_argument('--broker', help='host:port of the broker for --target broker (default: start minibroker)')
+    parser.add_argument('--workers', type=int, default=1, help='controller worker processes (supervisor mode)')
+    parser.add_argument('--exact-subscriptions', action='store_true',
+                        help='pass the zone ids as ZONE_IDS so workers subscribe to their own zones only')
+    parser.add_argument('--qos', type=int, default=1, choices=(0, 1))
+    parser.add_argument('--thermostats', type=int, default=2000)
+    parser.add_argument('--pattern', choices=('steady', 'poisson', 'burst'), default='steady')
+    parser.add_argument('--burst-interval', type=float, default=5.0, help='seconds between bursts')
+    parser.add_argument('--rate', type=float, help='one step at this total rate (readings/s) instead of a ramp')
+    parser.add_argument('--start-rate', type=float, default=50.0)
+    parser.add_argument('--factor', type=float, default=1.5, help='rate multiplier between ramp steps')
+    parser.add_argument('--max-rate', type=float, default=100000.0)
+    parser.add_argument('--step-seconds', type=float, default=10.0)
+    parser.add_argument('--sample-time', type=float, default=float(os.environ.get('CONTROL_SAMPLE_TIME', 1.0)),
+                        help='CONTROL_SAMPLE_TIME of the controller')
+    parser.add_argument('--slo-ms', type=float, help='p99 latency limit (default: 2 x sample time + 250 ms)')
+    parser.add_argument('--max-loss', type=float, default=0.01, help='fraction of readings allowed without a command')
+    parser.add_argument('--drain', type=float, help='seconds to wait for commands after a step (default: SLO + 1 s)')
+    parser.add_argument('--reading-interval', type=float, default=60.0,
+                        help='seconds between readings of one real thermostat, for the sizing')
+    parser.add_argument('--headroom', type=float, default=0.7, help='fraction of the maximum rate to plan for')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='JSON report (default: benchmarks/results/load_<target>_<commit>.json)')
+    args = parser.parse_args()
+    if args.slo_ms is None:
+        args.slo_ms = 2000 * args.sample_time + 250
+    if args.drain is None:
+        args.drain = args.slo_ms / 1000 + 1
+
+    collector = LatencyCollector(args.thermostats)
+    fleet = Fleet(args.thermostats, collector, None)
+    if args.target == 'inprocess':
+        target = InProcessTarget(args.sample_time)
+    else:
+        target = BrokerTarget(args.sample_time, args.broker, args.workers, args.qos, args.exact_subscriptions)
+    rng = random.Random(args.seed)
+    steps = []
+    try:
+        target.start(fleet)
+        answered = warm_up(fleet, collector, timeout=60)
+        print('%d/%d thermostats answered the warm-up reading' % (answered, args.thermostats))
+        if not answered:
+            raise SystemExit('no relay commands received, is the controller running?')
+        # Beyond this a thermostat sends more than one reading per two control periods, so the
+        # control loop coalesces them (by design) and the extra rate does not load it
+        fleet_limit = args.thermostats / (2 * args.sample_time)
+        if args.rate and args.rate > fleet_limit:
+            print('warning: %.1f readings/s per thermostat exceeds half the control rate, readings will be '
+                  'coalesced; use more --thermostats' % (args.rate / args.thermostats))
+        rate = args.rate or args.start_rate
+        while rate <= min(args.max_rate, fleet_limit) or (args.rate and not steps):
+            step = run_step(fleet, collector, target, rate, args, rng)
+            steps.append(step)
+            print_step(step)
+            if args.rate or not step['sustained'] or step['generator_limited']:
+                break
+            if rate < fleet_limit < rate * args.factor:
+                rate = fleet_limit
+            else:
+                rate *= args.factor
+        if steps and steps[-1]['sustained'] and not args.rate and steps[-1]['offered_rate'] >= fleet_limit:
+            print('ramp stopped at the fleet limit (%d thermostats / 2 control periods); '
+                  'use more --thermostats to go higher' % args.thermostats)
+    finally:
+        target.stop()
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'config': {
+            'target': target.name,
+            'broker': getattr(target, 'broker_name', None),
+            'workers': args.workers,
+            'qos': args.qos,
+            'thermostats': args.thermostats,
+            'pattern': args.pattern,
+            'burst_interval': args.burst_interval,
+            'sample_time': args.sample_time,
+            'slo_ms': args.slo_ms,
+            'max_loss': args.max_loss,
+        },
+        'steps': steps,
+        'sizing': sizing(steps, args),
+    }
+    summary = report['sizing']
+    if summary['max_sustainable_rate'] is None:
+        print('no step met the SLO (p99 <= %.0f ms, loss <= %.1f%%)' % (args.slo_ms, 100 * args.max_loss))
+    else:
+        print('max sustainable rate: %.0f readings/s%s, p99 %.1f ms' % (
+            summary['max_sustainable_rate'], ' or more (lower bound)' if summary['lower_bound'] else '',
+            summary['p99_ms_at_max']))
+        print('at one reading per %.0f s per thermostat and %.0f%% headroom: %d thermostats per instance' % (
+            args.reading_interval, 100 * args.headroom, summary['thermostats_per_instance']))
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', 'load_%s_%s.json' % (target.name, report['commit']))
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('report written to', output)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,156 @@
+# Recovery time of the controller's MQTT session after a broker restart, against the local
+# minibroker stand-in. Each cycle stops the broker, changes the relay state while it is down
+# (the command is held back), restarts it and measures:
+#   reconnect_s  restart -> controller connected again (CONNACK)
+#   flush_s      restart -> the held back relay command reaches a subscriber
+#   control_s    restart -> fresh sensor readings produce a relay command at the subscriber
+#
+#   python benchmarks/mqtt_recovery.py --cycles 5 --outage 2
+#   python benchmarks/mqtt_recovery.py --forget-sessions   # failover to a node without our session
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import paho.mqtt.client as mqtt  # noqa: E402
+
+from minibroker import BrokerThread  # noqa: E402
+
+broker = BrokerThread().start()
+
+for name, value in (('MQTT_USER', 'bench'), ('MQTT_PASSWORD', 'bench'), ('AC_CONTROL_TOPIC', 'bench/ac_control'),
+                    ('TEMPERATURE_TOPIC', 'bench/temperature'),
+                    ('EXTERNAL_TEMPERATURE_TOPIC', 'bench/external_temperature'),
+                    ('AVERAGE_TEMPERATURE_TOPIC', 'bench/average_temperature'),
+                    ('SET_TEMPERATURE_TOPIC', 'bench/set_temperature'), ('TEMP_THRESHOLD', '0.15'),
+                    ('MQTT_RECONNECT_MIN', '0.2'), ('MQTT_RECONNECT_MAX', '2'), ('CONTROL_SAMPLE_TIME', '0.05')):
+    os.environ.setdefault(name, value)
+os.environ['MQTT_BROKER'] = '127.0.0.1'
+os.environ['MQTT_PORT'] = str(broker.port)
+os.environ.pop('HISTORY_DIR', None)
+os.environ.pop('ZONE_TOPIC_PREFIX', None)
+os.environ['STATE_JOURNAL'] = ''
+
+import main  # noqa: E402
+
+main.log.addHandler(logging.NullHandler())
+main.log.propagate = False
+
+
+class Watcher:
+    # Subscriber on the relay command topic, records when each command arrives
+    def __init__(self, port):
+        self.commands = []
+        self.arrived = threading.Condition()
+        self.client = mqtt.Client(client_id='recovery-watcher', clean_session=False)
+        self.client.reconnect_delay_set(0.05, 0.2)
+        self.client.on_connect = lambda client, userdata, flags, rc: client.subscribe(main.ac_control_topic, 1)
+        self.client.on_message = self.on_message
+        self.client.connect('127.0.0.1', port)
+        self.client.loop_start()
+
+    def on_message(self, client, userdata, msg):
+        with self.arrived:
+            self.commands.append((time.perf_counter(), json.loads(msg.payload)))
+            self.arrived.notify_all()
+
+    def wait_for(self, heating, since, timeout=30):
+        # Time of the first command after since with the given heating state
+        deadline = time.perf_counter() + timeout
+        with self.arrived:
+            while True:
+                for arrived, command in self.commands:
+                    if arrived >= since and (command['heating'] == 'heating_on') == heating:
+                        return arrived
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                self.arrived.wait(remaining)
+
+
+def wait_until(condition, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return None
+        time.sleep(0.005)
+    return time.perf_counter()
+
+
+def run(cycles, outage, forget_sessions):
+    main.control_loop.start()
+    main.mqtt_thread()
+    if wait_until(lambda: main.mqtt_monitor.connected) is None:
+        raise SystemExit('controller did not connect')
+    watcher = Watcher(broker.port)
+    sensor = mqtt.Client(client_id='recovery-sensor')
+    sensor.reconnect_delay_set(0.05, 0.2)
+    sensor.connect('127.0.0.1', broker.port)
+    sensor.loop_start()
+    wait_until(sensor.is_connected)
+    # Outdoor readings are retained, so they are delivered again whenever the controller resubscribes
+    for topic in (main.external_temperature_topic, main.average_temperature_topic):
+        sensor.publish(topic, '60.0', qos=1, retain=True)
+    wait_until(lambda: main.external_temperature == 60.0)
+
+    results = []
+    heating = True
+    for cycle in range(cycles):
+        broker.stop(forget_sessions)
+        wait_until(lambda: not main.mqtt_monitor.connected)
+        # Flip the relays while the broker is down: the command must be held back
+        heating = not heating
+        main.control_inputs.put('current_temperature', 60.0 if heating else 80.0)
+        time.sleep(outage)
+        restarted = time.perf_counter()
+        broker.start()
+        connected = wait_until(lambda: main.mqtt_monitor.connected)
+        flushed = watcher.wait_for(heating, restarted)
+        # And fresh readings after the restart, repeated like a sensor reporting periodically:
+        # without a stored session, readings before the controller has resubscribed are lost
+        heating = not heating
+        wait_until(sensor.is_connected)
+        controlled = None
+        give_up = time.perf_counter() + 30
+        while controlled is None and time.perf_counter() < give_up:
+            sent = time.perf_counter()
+            sensor.publish(main.temperature_topic, '60.0' if heating else '80.0', qos=1)
+            controlled = watcher.wait_for(heating, sent, timeout=0.1)
+        result = {
+            'reconnect_s': None if connected is None else connected - restarted,
+            'flush_s': None if flushed is None else flushed - restarted,
+            'control_s': None if controlled is None else controlled - restarted,
+            'monitor_recovery_s': main.mqtt_monitor.last_recovery,
+        }
+        results.append(result)
+        print('cycle %d: %s' % (cycle + 1, ' '.join(
+            '%s=%s' % (key, 'timeout' if value is None else '%.3f' % value) for key, value in result.items())))
+
+    for key in ('reconnect_s', 'flush_s', 'control_s'):
+        values = [result[key] for result in results if result[key] is not None]
+        if values:
+            print('%-12s min=%.3f median=%.3f max=%.3f (%d/%d recovered)' % (
+                key, min(values), statistics.median(values), max(values), len(values), len(results)))
+    print('relay commands held back while disconnected: %d' % main.relay_publisher.buffered)
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Measure MQTT recovery time after broker restarts')
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--outage', type=float, default=2.0, help='seconds the broker stays down')
+    parser.add_argument('--forget-sessions', action='store_true',
+                        help='restart without session state, like failing over to another node')
+    args = parser.parse_args()
+    run(args.cycles, args.outage, args.forget_sessions)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger('hvac')
+
+
+class LatestValues:
+    # Latest-value-wins input slots. Writers (the MQTT network thread, HTTP handlers)
+    # only store a value; the control loop takes everything that arrived since its last tick.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.values = {}
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.values:
+                # The previous value for this key was never evaluated
+                self.coalesced += 1
+            self.values[key] = value
+            self.received += 1
+        self.pending.set()
+
+    def drop(self):
+        # Count a message that was rejected before reaching a slot (bad payload etc.)
+        with self.lock:
+            self.dropped += 1
+
+    def take(self):
+        with self.lock:
+            values, self.values = self.values, {}
+            self.pending.clear()
+        return values
+
+
+class ControlLoop(threading.Thread):
+    # Runs process(values) at most once every sample_time seconds, and only when new
+    # input arrived, so a burst of sensor messages costs one control evaluation.
+    def __init__(self, inputs, process, sample_time):
+        super().__init__(name='control-loop', daemon=True)
+        self.inputs = inputs
+        self.process = process
+        self.sample_time = sample_time
+        self.stopping = threading.Event()
+        self.evaluations = 0
+        self.last_evaluation = 0.0
+        self.last_duration = 0.0
+
+    def stop(self):
+        self.stopping.set()
+        self.inputs.pending.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.inputs.pending.wait()
+            # Wall clock, the same time source as the PID's default clock
+            deadline = self.last_evaluation + self.sample_time
+            remaining = deadline - time.time()
+            while remaining > 0 and not self.stopping.is_set():
+                self.stopping.wait(remaining)
+                remaining = deadline - time.time()
+            if self.stopping.is_set():
+                break
+            values = self.inputs.take()
+            if not values:
+                continue
+            started = time.time()
+            try:
+                self.process(values)
+            except Exception:
+                log.exception("Control loop evaluation failed")
+            self.last_evaluation = started
+            self.last_duration = time.time() - started
+            self.evaluations += 1
+
+    def stats(self):
+        return {
+            'sample_time': self.sample_time,
+            'received': self.inputs.received,
+            'coalesced': self.inputs.coalesced,
+            'dropped': self.inputs.dropped,
+            'evaluations': self.evaluations,
+            'last_evaluation': self.last_evaluation,
+            'last_duration': self.last_duration
+        }
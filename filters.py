@@ -0,0 +1,152 @@
+import bisect
+import math
+import time
+from array import array
+
+
+class EMA:
+    # Exponential moving average, O(1) per sample
+    __slots__ = ('alpha', 'value')
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, x):
+        if self.value is None:
+            self.value = x
+        else:
+            self.value += self.alpha * (x - self.value)
+        return self.value
+
+
+class RollingMedian:
+    # Median of the last window samples: a preallocated ring for arrival order plus a
+    # sorted copy kept with bisect (O(log n) search, small memmove for the window)
+    __slots__ = ('window', 'ring', 'sorted', 'count')
+
+    def __init__(self, window):
+        self.window = window
+        self.ring = array('d', bytes(8 * window))
+        self.sorted = []
+        self.count = 0
+
+    def update(self, x):
+        if self.count >= self.window:
+            old = self.ring[self.count % self.window]
+            del self.sorted[bisect.bisect_left(self.sorted, old)]
+        self.ring[self.count % self.window] = x
+        bisect.insort(self.sorted, x)
+        self.count += 1
+        n = len(self.sorted)
+        if n & 1:
+            return self.sorted[n // 2]
+        return (self.sorted[n // 2 - 1] + self.sorted[n // 2]) / 2
+
+
+class OutlierRejector:
+    # Rejects samples more than sigma standard deviations (and at least min_deviation) away
+    # from the mean of the last window samples. Running sums make it O(1). Rejected samples
+    # stay in the window, so a real step change is accepted once it fills the window.
+    __slots__ = ('window', 'sigma', 'min_deviation', 'min_samples', 'ring', 'count', 'total', 'total_sq',
+                 'rejected')
+
+    def __init__(self, window, sigma=3.0, min_deviation=0.5, min_samples=5):
+        self.window = window
+        self.sigma = sigma
+        self.min_deviation = min_deviation
+        self.min_samples = min(min_samples, window)
+        self.ring = array('d', bytes(8 * window))
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.rejected = 0
+
+    def accept(self, x):
+        n = min(self.count, self.window)
+        accepted = True
+        if n >= self.min_samples:
+            mean = self.total / n
+            variance = max(self.total_sq / n - mean * mean, 0.0)
+            if abs(x - mean) > max(self.sigma * math.sqrt(variance), self.min_deviation):
+                self.rejected += 1
+                accepted = False
+        slot = self.count % self.window
+        if self.count >= self.window:
+            old = self.ring[slot]
+            self.total -= old
+            self.total_sq -= old * old
+        self.ring[slot] = x
+        self.total += x
+        self.total_sq += x * x
+        self.count += 1
+        return accepted
+
+
+class SensorFilter:
+    # Outlier rejection -> rolling median -> EMA for one sensor; each stage is optional
+    __slots__ = ('outliers', 'median', 'ema')
+
+    def __init__(self, ema_alpha=0.0, median_window=0, outlier_window=0, outlier_sigma=3.0,
+                 outlier_min_deviation=0.5):
+        self.outliers = OutlierRejector(outlier_window, outlier_sigma, outlier_min_deviation) \
+            if outlier_window else None
+        self.median = RollingMedian(median_window) if median_window else None
+        self.ema = EMA(ema_alpha) if ema_alpha else None
+
+    def update(self, x):
+        # Filtered value, or None if x was rejected as an outlier
+        if self.outliers is not None and not self.outliers.accept(x):
+            return None
+        if self.median is not None:
+            x = self.median.update(x)
+        if self.ema is not None:
+            x = self.ema.update(x)
+        return x
+
+
+class TemperatureFilter:
+    # Filters each sensor of a zone, averages the sensors heard from within max_age seconds
+    # and only lets a value through when it moved at least deadband since the last one
+    def __init__(self, ema_alpha=0.0, median_window=0, outlier_window=0, outlier_sigma=3.0,
+                 outlier_min_deviation=0.5, deadband=0.0, max_age=600.0, clock=time.time):
+        self.settings = (ema_alpha, median_window, outlier_window, outlier_sigma, outlier_min_deviation)
+        self.deadband = deadband
+        self.max_age = max_age
+        self.clock = clock
+        # sensor -> [SensorFilter, last filtered value, time of last value]
+        self.sensors = {}
+        self.last_value = None
+        self.skipped = 0
+
+    def update(self, sensor, values):
+        # Feed a sensor's readings (oldest first). Returns the new zone temperature, or None
+        # if nothing changed by more than the deadband.
+        entry = self.sensors.get(sensor)
+        if entry is None:
+            entry = self.sensors[sensor] = [SensorFilter(*self.settings), None, 0.0]
+        sensor_filter = entry[0]
+        filtered = None
+        for x in values:
+            result = sensor_filter.update(x)
+            if result is not None:
+                filtered = result
+        if filtered is None:
+            return None
+        now = self.clock()
+        entry[1] = filtered
+        entry[2] = now
+
+        if len(self.sensors) == 1:
+            value = filtered
+        else:
+            fresh = [v for f, v, t in self.sensors.values() if v is not None and now - t <= self.max_age]
+            value = sum(fresh) / len(fresh)
+        if self.last_value is not None and abs(value - self.last_value) < self.deadband:
+            self.skipped += 1
+            return None
+        self.last_value = value
+        return value
+
+    def rejected(self):
+        return sum(f.outliers.rejected for f, v, t in self.sensors.values() if f.outliers is not None)
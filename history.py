@@ -0,0 +1,227 @@
+import glob
+import os
+import threading
+import time
+
+import numpy as np
+
+# Columns of every sample; relay states are stored as 0.0/1.0 so their mean is the duty cycle
+HISTORY_FIELDS = ('time', 'current_temperature', 'external_temperature', 'set_temperature', 'pid_output',
+                  'fan', 'cooling', 'heating')
+VALUE_FIELDS = HISTORY_FIELDS[1:]
+COLUMNS = len(HISTORY_FIELDS)
+
+# Upper bound on the number of buckets a single query may return
+MAX_BUCKETS = 10000
+
+
+class HistoryStore:
+    # Fixed-size in-memory ring of recent samples, flushed to fixed-size memory-mapped
+    # segment files. Memory use is capacity rows plus at most one open segment, and disk
+    # use is max_segments segments, no matter how long the service runs. A readonly store
+    # only reads the segments already in directory (offline tools on a live controller's files).
+    # peers is a glob of other stores' directories (a supervisor's shards) whose flushed segments
+    # are read along with this store's own on every query.
+    def __init__(self, directory=None, capacity=86400, segment_rows=16384, max_segments=64, flush_interval=60.0,
+                 readonly=False, peers=None):
+        self.directory = directory
+        self.readonly = readonly
+        self.peers = peers
+        self.capacity = capacity
+        self.segment_rows = segment_rows
+        self.max_segments = max_segments
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.ring = np.full((capacity, COLUMNS), np.nan, dtype=np.float64)
+        # Samples ever recorded / samples written to disk (absolute row numbers)
+        self.total = 0
+        self.flushed = 0
+        self.last_flush = 0.0
+        # [sequence, path, first time, last time] of every complete or open segment, oldest first
+        self.segments = []
+        self.segment = None
+        self.segment_fill = 0
+        if directory and readonly:
+            if os.path.isdir(directory):
+                self._scan_segments()
+        elif directory:
+            os.makedirs(directory, exist_ok=True)
+            self._scan_segments()
+
+    def _scan_segments(self):
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.seg'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                times = self._open_segment(path)[:, 0]
+            except (OSError, ValueError):
+                # Removed or just created by the process writing this directory
+                if self.readonly:
+                    continue
+                raise
+            valid = np.flatnonzero(~np.isnan(times))
+            if len(valid):
+                self.segments.append([int(name[:-4]), path, times[valid[0]], times[valid[-1]]])
+            elif not self.readonly:
+                os.remove(path)
+
+    def _open_segment(self, path, mode='r'):
+        rows = os.path.getsize(path) // (COLUMNS * 8)
+        return np.memmap(path, dtype=np.float64, mode=mode, shape=(rows, COLUMNS))
+
+    def record(self, current_temperature, external_temperature, set_temperature, pid_output,
+               fan, cooling, heating, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            row = self.ring[self.total % self.capacity]
+            row[0] = now
+            row[1] = current_temperature
+            row[2] = external_temperature
+            row[3] = set_temperature
+            row[4] = pid_output
+            row[5] = fan
+            row[6] = cooling
+            row[7] = heating
+            self.total += 1
+            if self.directory and not self.readonly and (now - self.last_flush >= self.flush_interval or
+                                   self.total - self.flushed >= self.capacity):
+                self.last_flush = now
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            if self.directory and not self.readonly:
+                self._flush()
+
+    def _ring_rows(self, start, stop):
+        # Copy of absolute rows [start, stop) that are still in the ring
+        start = max(start, self.total - self.capacity)
+        if start >= stop:
+            return self.ring[:0].copy()
+        a, b = start % self.capacity, stop % self.capacity
+        if a < b or b == 0:
+            return self.ring[a:b or self.capacity].copy()
+        return np.concatenate((self.ring[a:], self.ring[:b]))
+
+    def _flush(self):
+        pending = self._ring_rows(self.flushed, self.total)
+        self.flushed = self.total
+        while len(pending):
+            if self.segment is None:
+                self._new_segment()
+            count = min(len(pending), self.segment_rows - self.segment_fill)
+            self.segment[self.segment_fill:self.segment_fill + count] = pending[:count]
+            self.segment_fill += count
+            if self.segment_fill == count:
+                self.segments[-1][2] = pending[0, 0]
+            self.segments[-1][3] = pending[count - 1, 0]
+            pending = pending[count:]
+            if self.segment_fill == self.segment_rows:
+                self.segment.flush()
+                self.segment = None
+        if self.segment is not None:
+            self.segment.flush()
+
+    def _new_segment(self):
+        sequence = self.segments[-1][0] + 1 if self.segments else 0
+        path = os.path.join(self.directory, '%012d.seg' % sequence)
+        segment = np.memmap(path, dtype=np.float64, mode='w+', shape=(self.segment_rows, COLUMNS))
+        segment[:] = np.nan
+        self.segment = segment
+        self.segment_fill = 0
+        self.segments.append([sequence, path, np.inf, -np.inf])
+        while len(self.segments) > self.max_segments:
+            os.remove(self.segments.pop(0)[1])
+
+    def _peer_stores(self):
+        # Read-only views of the peer directories, scanned afresh since their writers keep adding segments
+        if not self.peers:
+            return []
+        own = os.path.abspath(self.directory) if self.directory else None
+        return [HistoryStore(directory, capacity=0, readonly=True)
+                for directory in sorted(glob.glob(self.peers)) if os.path.abspath(directory) != own]
+
+    def _visit(self, start, stop, visit):
+        # Call visit(rows) for every segment overlapping [start, stop), then for the unflushed
+        # part of the ring, then the same for every peer; rows are time ordered within a call,
+        # and across the calls of one store
+        with self.lock:
+            if self.directory:
+                segments = [s for s in self.segments if s[3] >= start and s[2] < stop]
+                for sequence, path, first, last in segments:
+                    # Unwritten rows are NaN, which searchsorted treats as past the end
+                    if self.segment is not None and path == self.segments[-1][1]:
+                        visit(self.segment)
+                    else:
+                        visit(self._open_segment(path))
+                recent = self._ring_rows(self.flushed, self.total)
+            else:
+                recent = self._ring_rows(0, self.total)
+        visit(recent)
+        for peer in self._peer_stores():
+            peer._visit(start, stop, visit)
+
+    def rows(self, start, stop):
+        # Raw samples with start <= time < stop, oldest first, as an (n, COLUMNS) array
+        parts = []
+
+        def collect(rows):
+            a, b = np.searchsorted(rows[:, 0], (start, stop))
+            if a < b:
+                parts.append(np.array(rows[a:b]))
+
+        self._visit(start, stop, collect)
+        if not parts:
+            return np.empty((0, COLUMNS))
+        rows = np.concatenate(parts)
+        if self.peers:
+            rows = rows[np.argsort(rows[:, 0], kind='stable')]
+        return rows
+
+    def query(self, start, stop, step):
+        # Downsample [start, stop) into step-second buckets. Returns bucket start times,
+        # sample counts and (min, mean, max) arrays per value field, empty buckets removed.
+        buckets = np.ceil((stop - start) / step)
+        if buckets <= 0:
+            raise ValueError("empty time range")
+        if buckets > MAX_BUCKETS:
+            raise ValueError("too many buckets, increase step")
+        buckets = int(buckets)
+        count = np.zeros(buckets, dtype=np.int64)
+        total = np.zeros((buckets, COLUMNS - 1))
+        low = np.full((buckets, COLUMNS - 1), np.inf)
+        high = np.full((buckets, COLUMNS - 1), -np.inf)
+
+        def accumulate(rows):
+            times = rows[:, 0]
+            a, b = np.searchsorted(times, (start, stop))
+            if a >= b:
+                return
+            rows = np.asarray(rows[a:b])
+            bucket = ((rows[:, 0] - start) // step).astype(np.intp)
+            edges = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+            index = bucket[edges]
+            values = rows[:, 1:]
+            count[index] += np.diff(np.r_[edges, len(rows)])
+            total[index] += np.add.reduceat(values, edges)
+            low[index] = np.minimum(low[index], np.minimum.reduceat(values, edges))
+            high[index] = np.maximum(high[index], np.maximum.reduceat(values, edges))
+
+        self._visit(start, stop, accumulate)
+
+        present = count > 0
+        result = {
+            'time': (start + step * np.flatnonzero(present)).tolist(),
+            'count': count[present].tolist(),
+        }
+        mean = total[present] / count[present][:, None]
+        for i, field in enumerate(VALUE_FIELDS):
+            result[field] = {
+                'min': low[present, i].tolist(),
+                'mean': mean[:, i].tolist(),
+                'max': high[present, i].tolist(),
+            }
+        return result
+
@@ -0,0 +1,69 @@
+import gzip
+import json
+import threading
+
+# Responses smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+
+def etag_for(version):
+    return '"%d"' % version
+
+
+def etag_matches(etag, if_none_match):
+    # If-None-Match is "*" or a comma separated list of (possibly weak) entity tags
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag == etag or tag == 'W/' + etag:
+            return True
+    return False
+
+
+def accepts_gzip(accept_encoding):
+    return 'gzip' in (accept_encoding or '')
+
+
+class VersionedPayload:
+    # JSON body (and its gzip encoding, made on first request) of the state at one version.
+    # Rebuilt only when the version moves, so repeated polling costs a dictionary lookup.
+    def __init__(self, build):
+        self.build = build
+        self.lock = threading.Lock()
+        self.version = None
+        self.body = None
+        self.gzipped = None
+
+    def get(self, version, gzip_ok):
+        with self.lock:
+            if version != self.version:
+                self.body = json.dumps(self.build(), separators=(',', ':')).encode()
+                self.gzipped = None
+                self.version = version
+            if gzip_ok and len(self.body) >= GZIP_MIN_SIZE:
+                if self.gzipped is None:
+                    self.gzipped = gzip.compress(self.body, 5)
+                return self.gzipped, True
+            return self.body, False
+
+
+def json_response_parts(body, etag, gzipped):
+    # (status, body, headers) of a 200 JSON response
+    headers = {'Content-Type': 'application/json', 'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    if gzipped:
+        headers['Content-Encoding'] = 'gzip'
+    return 200, body, headers
+
+
+def not_modified(etag):
+    return 304, b'', {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+
+
+def encode(document, accept_encoding, etag):
+    # (status, body, headers) for a document that is not cached
+    body = json.dumps(document, separators=(',', ':')).encode()
+    gzipped = accepts_gzip(accept_encoding) and len(body) >= GZIP_MIN_SIZE
+    if gzipped:
+        body = gzip.compress(body, 5)
+    return json_response_parts(body, etag, gzipped)
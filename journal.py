@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+import time
+
+
+def read_journal(path):
+    # (latest state per key, time it was recorded) of a journal file; a torn last line from a
+    # crash is ignored, lines without a time (older journals) count as time 0
+    latest = {}
+    saved = {}
+    try:
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    latest[entry['k']] = entry['s']
+                    saved[entry['k']] = entry.get('t', 0)
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    continue
+    except FileNotFoundError:
+        pass
+    return latest, saved
+
+
+def merge_journals(paths):
+    # Latest state per key across several journals (the shards of a supervisor), newest record wins
+    merged = {}
+    newest = {}
+    for path in paths:
+        latest, saved = read_journal(path)
+        for key, state in latest.items():
+            if key not in merged or saved[key] > newest[key]:
+                merged[key] = state
+                newest[key] = saved[key]
+    return merged
+
+
+class StateJournal:
+    # Append-only log of controller state. Each line is {"k": key, "s": state, "t": time}; the
+    # last line per key wins on replay. Writes go straight to the OS, a background thread fsyncs
+    # them at most every fsync_interval seconds. Once the log is past compact_bytes and twice the
+    # size of its last compaction, that thread rewrites it with only the latest state per key
+    # (write temp file + rename), so record() never waits for a rewrite or an fsync.
+    def __init__(self, path, fsync_interval=5.0, compact_bytes=1 << 20):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_bytes = compact_bytes
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.saved = {}
+        self.dirty = False
+        # Size of the file right after the last compaction, and the lines recorded while one runs
+        self.live_size = 0
+        self.tail = None
+        self.stopping = threading.Event()
+        self.wake = threading.Event()
+        self.flusher = None
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.replay()
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+
+    def replay(self):
+        # Load the latest state per key
+        self.latest, self.saved = read_journal(self.path)
+        return self.latest
+
+    def get(self, key, default=None):
+        return self.latest.get(key, default)
+
+    def record(self, key, state):
+        now = time.time()
+        line = (json.dumps({'k': key, 's': state, 't': now}, separators=(',', ':')) + '\n').encode()
+        with self.lock:
+            self.latest[key] = state
+            self.saved[key] = now
+            os.write(self.fd, line)
+            self.size += len(line)
+            self.dirty = True
+            if self.tail is not None:
+                self.tail.append(line)
+            elif self._compact_due():
+                self.wake.set()
+
+    def _compact_due(self):
+        return self.size > max(self.compact_bytes, 2 * self.live_size)
+
+    def compact(self):
+        # The snapshot is written and fsynced without the lock; records made meanwhile still go
+        # to the old file and are copied after the snapshot just before the rename
+        temp = self.path + '.tmp'
+        with self.lock:
+            entries = [(key, state, self.saved.get(key, 0)) for key, state in self.latest.items()]
+            self.tail = []
+        data = b''.join((json.dumps({'k': key, 's': state, 't': saved}, separators=(',', ':')) + '\n').encode()
+                        for key, state, saved in entries)
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+            except OSError:
+                with self.lock:
+                    self.tail = None
+                raise
+            with self.lock:
+                tail = b''.join(self.tail)
+                self.tail = None
+                os.write(fd, tail)
+                os.replace(temp, self.path)
+                os.close(self.fd)
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+                self.live_size = len(data)
+                self.size = len(data) + len(tail)
+                self.dirty = bool(tail)
+        finally:
+            os.close(fd)
+        self._fsync_directory()
+
+    def _fsync_directory(self):
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def sync(self):
+        with self.lock:
+            if self.dirty:
+                os.fsync(self.fd)
+                self.dirty = False
+
+    def maintain(self):
+        # Compact if the log has grown enough, then fsync. Runs on the flusher thread, or is
+        # called periodically by whoever drives the journal without start() (asyncio mode).
+        with self.lock:
+            due = self._compact_due()
+        if due:
+            self.compact()
+        self.sync()
+
+    def start(self):
+        self.flusher = threading.Thread(target=self._flush_loop, name='state-journal', daemon=True)
+        self.flusher.start()
+
+    def _flush_loop(self):
+        while not self.stopping.is_set():
+            self.wake.wait(self.fsync_interval)
+            self.wake.clear()
+            if self.stopping.is_set():
+                break
+            try:
+                self.maintain()
+            except OSError:
+                # Keep appending to the current file; the next wakeup tries again
+                continue
+
+    def close(self):
+        self.stopping.set()
+        self.wake.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.sync()
+        with self.lock:
+            os.close(self.fd)
@@ -0,0 +1,39 @@
+import logging
+import threading
+import time
+
+
+class RateLimitFilter(logging.Filter):
+    # Lets at most burst records per message template through every interval seconds;
+    # the first record of the next window reports how many were suppressed.
+    def __init__(self, interval=60.0, burst=5):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.lock = threading.Lock()
+        # (logger name, message template) -> [window start, records passed, records suppressed]
+        self.windows = {}
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self.windows[key] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+                return True
+            else:
+                window[2] += 1
+                return False
+        if suppressed and isinstance(record.args, tuple):
+            record.msg = '%s (%%d similar messages suppressed)' % record.msg
+            record.args = record.args + (suppressed,)
+        return True
+
+
+def configure_logging(level='INFO'):
+    logging.basicConfig(level=getattr(logging, str(level).upper(), logging.INFO),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
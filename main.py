@@ -1,56 +1,42 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
+import atexit
+import glob
 import json
 import paho.mqtt.client as mqtt
 import os
+import socket
+import struct
+import sys
 import threading
 from datetime import datetime
 import time
+import logging
+import math
+from time import perf_counter
 
-class PID:
-    def __init__(self, P=0.1, I=0.0, D=0.0):
-        self.Kp = P
-        self.Ki = I
-        self.Kd = D
-        self.sample_time = 0.00
-        self.current_time = time.time()
-        self.last_time = self.current_time
-        self.clear()
-
-    def clear(self):
-        self.SetPoint = 0.0
-        self.PTerm = 0.0
-        self.ITerm = 0.0
-        self.DTerm = 0.0
-        self.last_error = 0.0
-        # Windup Guard
-        self.int_error = 0.0
-        self.windup_guard = 20.0
-        self.output = 0.0
-
-    def update(self, feedback_value):
-        error = self.SetPoint - feedback_value
-        self.current_time = time.time()
-        delta_time = self.current_time - self.last_time
-        delta_error = error - self.last_error
-        if (delta_time >= self.sample_time):
-            self.PTerm = self.Kp * error
-            self.ITerm += error * delta_time
-            if (self.ITerm < -self.windup_guard):
-                self.ITerm = -self.windup_guard
-            elif (self.ITerm > self.windup_guard):
-                self.ITerm = self.windup_guard
-            self.DTerm = 0.0
-            if delta_time > 0:
-                self.DTerm = delta_error / delta_time
-            # Remember last time and last error for next calculation
-            self.last_time = self.current_time
-            self.last_error = error
-            self.output = self.PTerm + (self.Ki * self.ITerm) + (self.Kd * self.DTerm)
-
-    def get_pid_value(self):
-        return self.output
+from control_loop import ControlLoop, LatestValues
+from filters import TemperatureFilter
+from history import HistoryStore
+from http_cache import VersionedPayload, accepts_gzip, encode, etag_for, etag_matches, json_response_parts, not_modified
+from journal import StateJournal, merge_journals
+from log_config import RateLimitFilter, configure_logging
+from metrics import Registry
+from mqtt_session import Backoff, ConnectionMonitor, MQTTSession
+from payloads import parse_reading, parse_values
+from pid import PID
+from shm_state import SnapshotWriter
+from publisher import RelayPublisher
+from scheduler import DeadlineScheduler
+from schedules import ScheduleEngine
+from sharding import HashRing
+from stream import StateBroadcaster
+from web_workers import WebWorkers
+from zones import ZoneRegistry, hold_expiry, next_deadline, parse_temperature, relay_decision
 
 app = Flask(__name__)
+log = logging.getLogger('hvac')
+log.addFilter(RateLimitFilter(interval=float(os.environ.get('LOG_RATE_INTERVAL', 60)),
+                              burst=int(os.environ.get('LOG_RATE_BURST', 5))))
 mqtt_broker = os.environ.get('MQTT_BROKER', '10.0.0.105')
 mqtt_port = int(os.environ.get('MQTT_PORT', 1883))
 mqtt_user = os.environ['MQTT_USER']
@@ -61,6 +47,26 @@ external_temperature_topic = os.environ['EXTERNAL_TEMPERATURE_TOPIC']
 average_temperature_topic = os.environ['AVERAGE_TEMPERATURE_TOPIC']
 set_temperature_topic = os.environ['SET_TEMPERATURE_TOPIC']
 threshold_percentage = os.environ['TEMP_THRESHOLD']
+# Optional multi-zone mode: zones are addressed as <prefix>/<zone_id>/temperature etc.
+zone_topic_prefix = os.environ.get('ZONE_TOPIC_PREFIX')
+# Known zones (comma separated) are subscribed to by their exact topics instead of <prefix>/+/...
+zone_ids = [zone_id for zone_id in os.environ.get('ZONE_IDS', '').split(',') if zone_id]
+web_port = int(os.environ.get('WEB_PORT', 5000))
+
+# Supervisor mode: SUPERVISOR_WORKERS=N runs N worker processes of this script (supervisor.py).
+# A worker controls the zones that hash to its SHARD_INDEX out of SHARD_COUNT shards, the
+# single zone controller included as zone 'main'.
+supervisor_workers = int(os.environ.get('SUPERVISOR_WORKERS', 0))
+supervised = 'SHARD_INDEX' in os.environ
+shard_index = int(os.environ.get('SHARD_INDEX', 0))
+shard_ring = HashRing(int(os.environ.get('SHARD_COUNT', 1)))
+# Glob of every shard's journal, read when zones move to this worker
+shard_journals = os.environ.get('SHARD_JOURNALS')
+# Pipe on which the worker tells the supervisor it released the zones of a resize
+supervisor_ack_fd = int(os.environ['SUPERVISOR_ACK_FD']) if 'SUPERVISOR_ACK_FD' in os.environ else None
+
+def owns_zone(zone_id):
+    return shard_ring.shard_for(zone_id) == shard_index
 
 # Set initial values for temperature and set temperature
 current_temperature = 0.0
@@ -68,183 +74,861 @@ external_temperature = 0.0
 set_temperature = 70
 avg_external_temperature = 0.0
 fan_start_time = 0
-
-# Relay control command constants
-COOLING_ON = "cooling_on"
-COOLING_OFF = "cooling_off"
-HEATING_ON = "heating_on"
-HEATING_OFF = "heating_off"
-FAN_ON = "fan_on"
-FAN_OFF = "fan_off"
+cooling_start_time = 0
+heating_start_time = 0
+cooling_stop_time = 0
+heating_stop_time = 0
+# Anti-short-cycle: cooling/heating stay off at least MIN_OFF_TIME seconds once stopped
+min_off_time = float(os.environ.get('MIN_OFF_TIME', 0))
 
 # HVAC control variables
 fan_state = False
 cooling_state = False
 heating_state = False
 
-# MQTT client initialization
-mqtt_client = mqtt.Client()
+# MQTT client initialization: a persistent session (fixed client id, clean_session=False) and
+# QoS 1 subscriptions, so the broker keeps our subscriptions and queued readings while we are away
+mqtt_client_id = os.environ.get('MQTT_CLIENT_ID', 'hvac-%s' % socket.gethostname())
+mqtt_qos = int(os.environ.get('MQTT_QOS', 1))
+mqtt_client = mqtt.Client(client_id=mqtt_client_id, clean_session=os.environ.get('MQTT_CLEAN_SESSION', '0') == '1')
 mqtt_client.username_pw_set(mqtt_user, mqtt_password)
+# Bounds the client's own queue of other messages (setpoint echoes etc.) while disconnected
+mqtt_client.max_queued_messages_set(int(os.environ.get('MQTT_MAX_QUEUED', 1000)))
+mqtt_backoff = Backoff(base=float(os.environ.get('MQTT_RECONNECT_MIN', 1)),
+                       cap=float(os.environ.get('MQTT_RECONNECT_MAX', 60)))
+mqtt_monitor = ConnectionMonitor()
+mqtt_session = MQTTSession(mqtt_client, mqtt_broker, mqtt_port, 60, mqtt_backoff)
+
+# Relay commands are only published on change, plus a periodic heartbeat. Until the first
+# connection (and while disconnected) they are held back, latest state per topic.
+relay_publisher = RelayPublisher(mqtt_client, qos=int(os.environ.get('CONTROL_QOS', mqtt_qos)),
+                                 retain=os.environ.get('CONTROL_RETAIN', '1') == '1',
+                                 heartbeat=float(os.environ.get('CONTROL_HEARTBEAT', 60)), connected=False)
 
 # Lock for concurrent access to shared variables
 data_lock = threading.Lock()
 
-# PID controller initialization
-pid = PID()
+# Time source of the control core
+clock = time.time
+
+# PID controller initialization. The control loop period is the only sample time gate: PID.update
+# keeps sample_time 0 and runs on every evaluation, so loop jitter cannot make it skip one
+pid = PID(clock=clock)
+control_sample_time = float(os.environ.get('CONTROL_SAMPLE_TIME', 1.0))
+
+# Gains that can be replaced at runtime through /pid_gains
+PID_GAINS = ('Kp', 'Ki', 'Kd', 'windup_guard')
+
+# Sensor values waiting for the next control loop tick
+control_inputs = LatestValues()
+
+# Recent samples in memory, older ones in memory-mapped segments under HISTORY_DIR (if set).
+# Supervisor workers each write their own HISTORY_DIR and query all of SHARD_HISTORY_DIRS.
+history_store = HistoryStore(os.environ.get('HISTORY_DIR'), capacity=int(os.environ.get('HISTORY_CAPACITY', 86400)),
+                             max_segments=int(os.environ.get('HISTORY_MAX_SEGMENTS', 64)),
+                             flush_interval=float(os.environ.get('HISTORY_FLUSH_INTERVAL', 60)),
+                             peers=os.environ.get('SHARD_HISTORY_DIRS'))
+
+# Append-only journal of controller state, opened and replayed at startup
+state_journal_path = os.environ.get('STATE_JOURNAL', '/etc/hvac/pid-state.journal')
+state_journal = None
+
+# Shared-memory state snapshot for WEB_WORKERS read-only web worker processes
+web_workers_count = int(os.environ.get('WEB_WORKERS', 0))
+state_snapshot = SnapshotWriter() if web_workers_count else None
+
+# Bumped after every evaluation; the ETag of /api/state and /api/zones
+state_version = 0
+
+# Pushes state changes to dashboard clients over /stream (SERVE_MODE=asyncio only)
+state_broadcaster = StateBroadcaster(keepalive=float(os.environ.get('SSE_KEEPALIVE', 15)))
+
+# Zone registry for multi-zone mode
+zone_registry = ZoneRegistry(zone_topic_prefix, clock=clock, min_off_time=min_off_time,
+                             owns=owns_zone if supervised else None, zone_ids=zone_ids) if zone_topic_prefix else None
+
+# Re-evaluates the controller and zones when a hold or lockout ends, without waiting for a message
+deadline_scheduler = DeadlineScheduler(clock)
+
+# Optional temperature filtering between ingest and the PID: outlier rejection, rolling median
+# and EMA per sensor, then the average of all sensors of a zone. Changes smaller than
+# FILTER_DEADBAND do not trigger an evaluation.
+filter_settings = {
+    'ema_alpha': float(os.environ.get('FILTER_EMA_ALPHA', 0)),
+    'median_window': int(os.environ.get('FILTER_MEDIAN_WINDOW', 0)),
+    'outlier_window': int(os.environ.get('FILTER_OUTLIER_WINDOW', 0)),
+    'outlier_sigma': float(os.environ.get('FILTER_OUTLIER_SIGMA', 3)),
+    'outlier_min_deviation': float(os.environ.get('FILTER_OUTLIER_MIN_DEVIATION', 0.5)),
+    'deadband': float(os.environ.get('FILTER_DEADBAND', 0)),
+    'max_age': float(os.environ.get('FILTER_SENSOR_MAX_AGE', 600)),
+}
+# Extra temperature sensors averaged with TEMPERATURE_TOPIC
+temperature_sensor_topics = [topic for topic in os.environ.get('TEMPERATURE_SENSOR_TOPICS', '').split(',') if topic]
+filtered_temperature_topic = os.environ.get('FILTERED_TEMPERATURE_TOPIC')
+filtering_enabled = bool(filter_settings['ema_alpha'] or filter_settings['median_window'] or
+                         filter_settings['outlier_window'] or filter_settings['deadband'] or temperature_sensor_topics)
+temperature_filter = TemperatureFilter(clock=clock, **filter_settings) if filtering_enabled else None
+# Zone -> TemperatureFilter, created on the zone's first reading
+zone_filters = {}
 
 def on_connect(client, userdata, flags, rc):
-    # MQTT topic to subscribe to for hvac_control
-    mqtt_client.subscribe(temperature_topic)
-    mqtt_client.subscribe(external_temperature_topic)
-    mqtt_client.subscribe(average_temperature_topic)
-    mqtt_client.subscribe(set_temperature_topic)
+    if rc != 0:
+        log.warning("MQTT connection refused: %s", mqtt.connack_string(rc))
+        return
+    recovery = mqtt_monitor.on_connected(flags.get('session present'))
+    mqtt_backoff.reset()
+    if recovery is not None:
+        mqtt_recovery_seconds.observe(recovery)
+    log.info("MQTT connected to %s:%s (session present: %s, recovered after %s s)", mqtt_broker, mqtt_port,
+             mqtt_monitor.session_present, 'n/a' if recovery is None else '%.1f' % recovery)
+    # Subscribe every time: after a failover the broker may not have our session
+    mqtt_client.subscribe([(topic, mqtt_qos) for topic in subscription_topics()])
+    # Commands held back while we were disconnected, then everything else devices may have missed
+    relay_publisher.resync()
 
+def subscription_topics():
+    # The single zone controller's topics if this shard owns it, then the zones'
+    topics = []
+    if controller_owned:
+        topics = [temperature_topic, external_temperature_topic, average_temperature_topic, set_temperature_topic]
+        topics.extend(temperature_sensor_topics)
+    if zone_registry is not None:
+        topics.extend(zone_registry.subscriptions())
+    return topics
+
+def on_disconnect(client, userdata, rc):
+    mqtt_monitor.on_disconnected()
+    relay_publisher.disconnected()
+    if rc != 0:
+        log.warning("MQTT connection lost (rc=%s)", rc)
 
-def update_hvac_control():
-    global fan_state, cooling_state, heating_state, set_temperature, current_temperature, external_temperature, pid, avg_external_temperature, fan_start_time, cooling_start_time, heating_start_time  # Added heating_start_time
 
-    # Process the temperature difference and determine the HVAC control states
-    temperature_difference = current_temperature - set_temperature
+def update_hvac_control():
+    global fan_state, cooling_state, heating_state, set_temperature, current_temperature, external_temperature, pid, avg_external_temperature, fan_start_time, cooling_start_time, heating_start_time, cooling_stop_time, heating_stop_time
 
     pid.SetPoint = set_temperature
+    started = perf_counter()
     pid.update(current_temperature)
+    pid_update_seconds.observe(perf_counter() - started)
     pid_value = pid.get_pid_value()
+    now = clock()
+    was_cooling, was_heating = cooling_state, heating_state
 
-    # Set the thresholds based on a percentage of the average external temperature
-    threshold_percentage = 0.15 
-    cooling_threshold = avg_external_temperature * (1 - threshold_percentage)
-    heating_threshold = avg_external_temperature * (1 + threshold_percentage)
-
-    # thresholds for heating
-    if pid_value > 0.25 and external_temperature < heating_threshold and current_temperature < set_temperature:
-        cooling_state = False
-        heating_state = True
-        fan_state = True
-        heating_start_time = time.time()  # Start counting the heating duration
-    # Thresholds for cooling
-    elif pid_value < -0.25 and external_temperature > cooling_threshold and current_temperature > set_temperature:
-        cooling_state = True
-        heating_state = False
-        fan_state = True
-        fan_start_time = time.time()
-        cooling_start_time = time.time()  # Start counting the cooling duration
-    elif abs(pid_value) > .5:
-        cooling_state = False
-        heating_state = False
-        fan_state = True
-        fan_start_time = time.time()
-    else:
-        if fan_state and time.time() - fan_start_time < 300:
-            pass  # Keep the fan on
-        elif cooling_state and time.time() - cooling_start_time < 300:
-            pass  # Keep the cooling on
-        elif heating_state and time.time() - heating_start_time < 300: 
-            pass  # Keep the heating on
-        else:
-            cooling_state = False
-            heating_state = False
-            fan_state = False
+    # The same rules as every zone (zones.relay_decision)
+    heat, cool, fan_only, fan_state, cooling_state, heating_state = relay_decision(
+        pid_value, current_temperature, set_temperature, external_temperature, avg_external_temperature,
+        fan_state, cooling_state, heating_state, fan_start_time, cooling_start_time, heating_start_time,
+        cooling_stop_time, heating_stop_time, min_off_time, now)
+    if heat:
+        heating_start_time = now  # Start counting the heating duration
+    if cool:
+        cooling_start_time = now  # Start counting the cooling duration
+    if cool or fan_only:
+        fan_start_time = now
+    if was_cooling and not cooling_state:
+        cooling_stop_time = now
+    if was_heating and not heating_state:
+        heating_stop_time = now
 
     publish_control_command()
+    history_store.record(current_temperature, external_temperature, set_temperature, pid_value,
+                         fan_state, cooling_state, heating_state, now)
+    if state_snapshot is not None:
+        state_snapshot.write(current_temperature, external_temperature, avg_external_temperature, set_temperature,
+                             pid_value, fan_state, cooling_state, heating_state)
+    state_broadcaster.publish(current_state())
+
+
+def controller_deadline():
+    # When the single zone controller needs to be evaluated again even without new readings
+    hold = hold_expiry(fan_state, cooling_state, heating_state, fan_start_time, cooling_start_time,
+                       heating_start_time)
+    lockouts = (cooling_stop_time + min_off_time, heating_stop_time + min_off_time) if min_off_time else ()
+    return next_deadline(clock(), hold, lockouts)
 
+def schedule_evaluation(key, deadline):
+    # key is the control input that triggers the evaluation: 'reevaluate' or (zone, None)
+    if deadline is None:
+        deadline_scheduler.cancel(key)
+    else:
+        deadline_scheduler.schedule(key, deadline, request_evaluation, key)
+
+def request_evaluation(key):
+    # Runs on the scheduler thread; the control loop does the evaluation
+    submit_input(key, True)
+
+def submit_input(key, value):
+    # Control inputs from other threads than MQTT/HTTP (replaced in asyncio mode to wake the loop)
+    control_inputs.put(key, value)
+
+def apply_scheduled_setpoint(zone_id, value):
+    # Setpoint change from a schedule or override, applied like /set_temperature
+    log.info("Scheduled setpoint for %s: %s", zone_id, value)
+    if zone_id == MAIN_ZONE:
+        submit_input('set_temperature', value)
+        mqtt_client.publish(set_temperature_topic, str(value))
+    elif zone_registry is not None:
+        submit_input((zone_registry.get_zone(zone_id), 'set_temperature'), value)
 
+def zone_temperature(zone_id):
+    # Runs on the scheduler thread: look the zone up without creating it; None if unknown
+    if zone_id == MAIN_ZONE:
+        return current_temperature
+    zone = zone_registry.zones.get(zone_id) if zone_registry is not None else None
+    return zone.current_temperature if zone is not None else None
+
+# Weekly setpoint schedules and away/hold overrides; the single zone controller is zone 'main'
+MAIN_ZONE = 'main'
+controller_owned = owns_zone(MAIN_ZONE)
+schedule_engine = ScheduleEngine(deadline_scheduler, apply_scheduled_setpoint, zone_temperature, clock=clock,
+                                 max_lead=float(os.environ.get('SCHEDULE_MAX_LEAD', 7200)))
+
+def current_state():
+    return {
+        'current_temperature': current_temperature,
+        'external_temperature': external_temperature,
+        'avg_external_temperature': avg_external_temperature,
+        'set_temperature': set_temperature,
+        'pid_calculation': pid.get_pid_value(),
+        'fan_state': 'ON' if fan_state else 'OFF',
+        'cooling_state': 'ON' if cooling_state else 'OFF',
+        'heating_state': 'ON' if heating_state else 'OFF'
+    }
+
+state_broadcaster.publish(current_state())
+
+
+# MQTT topic -> (metric label, control input, payload parser); every payload may also be a batch
+topic_handlers = {
+    temperature_topic: ('temperature', 'current_temperature', parse_temperature),
+    set_temperature_topic: ('set_temperature', 'set_temperature', float),
+    external_temperature_topic: ('external_temperature', 'external_temperature', float),
+    average_temperature_topic: ('average_temperature', 'avg_external_temperature', float),
+}
+for topic in temperature_sensor_topics:
+    topic_handlers[topic] = ('temperature', 'current_temperature', parse_temperature)
 
 def on_message(client, userdata, msg):
-    global current_temperature, set_temperature, external_temperature, avg_external_temperature
-    if msg.topic == temperature_topic:
-        # Update current temperature
-        try:
-            payload = json.loads(msg.payload.decode())
-            current_temperature = float(payload)
-            print("Current temperature updated:", current_temperature)
-            update_hvac_control()
-        except (ValueError, TypeError):
-            print("Invalid temperature payload received:", msg.payload)
-    elif msg.topic == 'set_temperature':
-        # Update set temperature
-        try:
-            set_temperature = float(msg.payload)
-            print("Received set temperature from MQTT:", set_temperature)
+    # Runs on the paho network thread: parse and store only, the control loop evaluates
+    started = perf_counter()
+    handle_message(msg)
+    message_seconds.observe(perf_counter() - started)
+
+def handle_message(msg):
+    handler = topic_handlers.get(msg.topic)
+    if handler is None:
+        if zone_registry is None or not on_zone_message(msg):
+            message_counters['unknown'].inc()
+        return
+    kind, key, parser = handler
+    message_counters[kind].inc()
+    filtered = key == 'current_temperature' and temperature_filter is not None
+    try:
+        if filtered:
+            value, readings = filter_readings(temperature_filter, msg, parser)
+        else:
+            value, readings = parse_reading(msg.payload, parser)
+    except (ValueError, TypeError, struct.error):
+        control_inputs.drop()
+        invalid_counters[kind].inc()
+        log.warning("Invalid %s payload received: %r", kind, msg.payload)
+        return
+    if readings > 1:
+        batch_readings.inc(readings)
+    if value is None:
+        # Rejected as an outlier or within the deadband: nothing to evaluate
+        return
+    if filtered and filtered_temperature_topic:
+        mqtt_client.publish(filtered_temperature_topic, str(value))
+    control_inputs.put(key, value)
+    log.debug("Received %s: %s", kind, value)
+
+def filter_readings(temperature_filter, msg, parser):
+    # Every reading of the payload goes through the filter, not only the latest one.
+    # Returns (filtered value or None, number of readings).
+    values = parse_values(msg.payload, parser)
+    return temperature_filter.update(msg.topic, values), len(values)
+
+def on_zone_message(msg):
+    # Route a message to its zone by topic; returns False if it is not a zone topic
+    route = zone_registry.route(msg.topic)
+    if route is None:
+        # A zone of another shard (counted by the registry) is not an unknown topic
+        return msg.topic in zone_registry.routes
+    zone, attribute, parser = route
+    message_counters['zone'].inc()
+    filtered = attribute == 'current_temperature' and filtering_enabled
+    try:
+        if filtered:
+            zone_filter = zone_filters.get(zone)
+            if zone_filter is None:
+                zone_filter = zone_filters[zone] = TemperatureFilter(clock=clock, **filter_settings)
+            value, readings = filter_readings(zone_filter, msg, parser)
+        else:
+            value, readings = parse_reading(msg.payload, parser)
+    except (ValueError, TypeError, struct.error):
+        control_inputs.drop()
+        invalid_counters['zone'].inc()
+        log.warning("Invalid zone payload received on %s: %r", msg.topic, msg.payload)
+        return True
+    if readings > 1:
+        batch_readings.inc(readings)
+    if value is None:
+        return True
+    if filtered:
+        mqtt_client.publish('%s/%s/filtered_temperature' % (zone_registry.prefix, zone.zone_id), str(value))
+    control_inputs.put((zone, attribute), value)
+    return True
+
+def process_inputs(values):
+    # Control loop tick: apply every value that arrived since the last tick, then
+    # evaluate the single zone controller and each touched zone once
+    global current_temperature, set_temperature, external_temperature, avg_external_temperature, state_version
+    zones = set()
+    with data_lock:
+        for key, value in values.items():
+            if key.__class__ is tuple:
+                zone, attribute = key
+                if attribute is not None:
+                    setattr(zone, attribute, value)
+                zones.add(zone)
+            elif key == 'current_temperature':
+                current_temperature = value
+            elif key == 'set_temperature':
+                set_temperature = value
+            elif key == 'external_temperature':
+                external_temperature = value
+            elif key == 'avg_external_temperature':
+                avg_external_temperature = value
+            elif key == 'pid_gains':
+                # New gains (e.g. from autotune.py) go through the same path as a restore
+                pid.load_state(dict(pid.get_state(), **value))
+                log.info("Loaded PID gains %s", value)
+        evaluate_controller = len(zones) != len(values) and controller_owned
+        if evaluate_controller:
             update_hvac_control()
-        except (ValueError, TypeError):
-            print("Invalid set temperature value received from MQTT:", msg.payload)
-    elif msg.topic == external_temperature_topic:
-        # Update external temperature
+            schedule_evaluation('reevaluate', controller_deadline())
+            schedule_engine.observe(MAIN_ZONE, current_temperature, heating_state, cooling_state, clock())
+        for zone in zones:
+            if zone_registry.zones.get(zone.zone_id) is not zone:
+                continue  # Handed over to another shard while its inputs were queued
+            zone.update_hvac_control()
+            relay_publisher.publish(zone.control_topic, zone.fan_state, zone.cooling_state, zone.heating_state)
+            schedule_evaluation((zone, None), zone.next_deadline())
+            schedule_engine.observe(zone.zone_id, zone.current_temperature, zone.heating_state,
+                                    zone.cooling_state, zone.clock())
+        if state_journal is not None:
+            if evaluate_controller:
+                state_journal.record('controller', controller_state())
+            for zone in zones:
+                if zone_registry.zones.get(zone.zone_id) is zone:
+                    state_journal.record('zone/%s' % zone.zone_id, zone.get_state())
+        state_version += 1
+
+def controller_state():
+    # What the journal keeps of the single zone controller
+    return {
+        'pid': pid.get_state(),
+        'set_temperature': set_temperature,
+        'fan_state': fan_state,
+        'cooling_state': cooling_state,
+        'heating_state': heating_state,
+        'fan_start_time': fan_start_time,
+        'cooling_start_time': cooling_start_time,
+        'heating_start_time': heating_start_time,
+        'cooling_stop_time': cooling_stop_time,
+        'heating_stop_time': heating_stop_time
+    }
+
+def open_state_journal():
+    # Returns None (no persistence) if STATE_JOURNAL is empty or not writable
+    if not state_journal_path:
+        return None
+    try:
+        return StateJournal(state_journal_path, fsync_interval=float(os.environ.get('STATE_JOURNAL_FSYNC', 5)),
+                            compact_bytes=int(os.environ.get('STATE_JOURNAL_COMPACT_BYTES', 1 << 20)))
+    except OSError as e:
+        log.warning("State journal disabled: %s", e)
+        return None
+
+def journal_states():
+    # Latest state per key: this process's journal, or for a supervisor's worker the newest
+    # entry across every shard's journal, since zones move between shards
+    if shard_journals:
+        return merge_journals(sorted(glob.glob(shard_journals)))
+    return dict(state_journal.latest)
+
+def restore_state(states, restore_controller=True):
+    # Resume the controller (if restore_controller) and the zones not loaded yet, as far as
+    # this shard owns them, from journal states
+    global set_temperature, fan_state, cooling_state, heating_state, fan_start_time, cooling_start_time, heating_start_time, cooling_stop_time, heating_stop_time
+    state = states.get('controller') if restore_controller and controller_owned else None
+    if state:
+        pid.load_state(state.get('pid', {}))
+        set_temperature = state.get('set_temperature', set_temperature)
+        fan_state = state.get('fan_state', False)
+        cooling_state = state.get('cooling_state', False)
+        heating_state = state.get('heating_state', False)
+        fan_start_time = state.get('fan_start_time', 0)
+        cooling_start_time = state.get('cooling_start_time', 0)
+        heating_start_time = state.get('heating_start_time', 0)
+        cooling_stop_time = state.get('cooling_stop_time', 0)
+        heating_stop_time = state.get('heating_stop_time', 0)
+        schedule_evaluation('reevaluate', controller_deadline())
+        log.info("Restored controller state from %s", state_journal_path)
+    if zone_registry is not None:
+        for key, zone_state in states.items():
+            if key.startswith('zone/') and key[5:] not in zone_registry.zones and owns_zone(key[5:]):
+                zone = zone_registry.get_zone(key[5:])
+                zone.load_state(zone_state)
+                schedule_evaluation((zone, None), zone.next_deadline())
+
+def api_state():
+    # Everything the dashboard shows, for /api/state
+    with data_lock:
+        return {
+            'version': state_version,
+            'controller': current_state(),
+            'zones': [zone.state() for zone in list(zone_registry.zones.values())] if zone_registry else []
+        }
+
+api_state_payload = VersionedPayload(api_state)
+
+def api_state_response(if_none_match, accept_encoding):
+    # (status, body, headers) for /api/state; an unchanged state is a 304 without serializing
+    version = state_version
+    etag = etag_for(version)
+    if etag_matches(etag, if_none_match):
+        return not_modified(etag)
+    body, gzipped = api_state_payload.get(version, accepts_gzip(accept_encoding))
+    return json_response_parts(body, etag, gzipped)
+
+def api_zones_response(ids, if_none_match, accept_encoding):
+    # (status, body, headers) for /api/zones?ids=a,b,c (all zones without ids)
+    etag = etag_for(state_version)
+    if etag_matches(etag, if_none_match):
+        return not_modified(etag)
+    known = zone_registry.zones if zone_registry is not None else {}
+    if ids:
+        ids = [zone_id for zone_id in ids.split(',') if zone_id]
+    else:
+        ids = [MAIN_ZONE] + list(known)
+    zones = []
+    missing = []
+    with data_lock:
+        for zone_id in ids:
+            if zone_id == MAIN_ZONE:
+                zones.append(dict(current_state(), zone_id=MAIN_ZONE))
+            elif zone_id in known:
+                zones.append(known[zone_id].state())
+            else:
+                missing.append(zone_id)
+    return encode({'version': state_version, 'zones': zones, 'missing': missing}, accept_encoding, etag)
+
+def api_setpoints(data):
+    # Bulk setpoint change, {"<zone_id>": set_temperature, ...}; returns (JSON body, HTTP status)
+    if not isinstance(data, dict) or not data:
+        return {"message": "Expected a JSON object of zone_id: set_temperature"}, 400
+    accepted = {}
+    rejected = {}
+    for zone_id, value in data.items():
         try:
-            external_temperature = float(msg.payload)
-            print("Received external temperature from MQTT:", external_temperature)
-            update_hvac_control()
+            value = float(value)
         except (ValueError, TypeError):
-            print("Invalid external temperature value received from MQTT:", msg.payload)
-    elif msg.topic == average_temperature_topic:
-        # Update average external temperature
+            rejected[zone_id] = 'invalid temperature'
+            continue
+        if not math.isfinite(value):
+            rejected[zone_id] = 'invalid temperature'
+        elif zone_id == MAIN_ZONE:
+            control_inputs.put('set_temperature', value)
+            mqtt_client.publish(set_temperature_topic, str(value))
+            accepted[zone_id] = value
+        elif zone_registry is not None and zone_id in zone_registry.zones:
+            control_inputs.put((zone_registry.zones[zone_id], 'set_temperature'), value)
+            accepted[zone_id] = value
+        else:
+            rejected[zone_id] = 'unknown zone'
+    return {'accepted': accepted, 'rejected': rejected}, 200 if accepted else 400
+
+def load_schedules(states):
+    # Schedules saved in the journal (the latest API changes) first, then SCHEDULE_FILE
+    # ({"<zone_id>": schedule, ...}) for the zones the journal does not know; only the zones
+    # this shard owns and that are not loaded yet
+    restored = set(schedule_engine.zone_ids())
+    if state_journal is not None:
+        schedule_engine.journal = state_journal
+        for key, state in states.items():
+            if key.startswith('schedule/') and key[9:] not in restored and owns_zone(key[9:]):
+                try:
+                    schedule_engine.load_state(key[9:], state)
+                except (ValueError, TypeError, KeyError, AttributeError, IndexError) as e:
+                    log.error("Invalid journaled schedule for %s: %s", key[9:], e)
+                    schedule_engine.forget(key[9:])
+                    continue
+                restored.add(key[9:])
+    path = os.environ.get('SCHEDULE_FILE')
+    if not path:
+        return
+    with open(path) as f:
+        schedules = json.load(f)
+    for zone_id, schedule in schedules.items():
+        if zone_id in restored or not owns_zone(zone_id):
+            continue
         try:
-            avg_external_temperature = float(msg.payload)
-            print("Received average external temperature from MQTT:", avg_external_temperature)
-            update_hvac_control()
-        except (ValueError, TypeError):
-            print("Invalid average external temperature value received from MQTT:", msg.payload)
+            schedule_engine.set_schedule(zone_id, schedule)
+        except (ValueError, TypeError, KeyError, AttributeError, IndexError) as e:
+            log.error("Invalid schedule for %s in %s: %s", zone_id, path, e)
+
+def schedule_request(method, zone_id, data=None, override=False):
+    # Shared by the Flask and asyncio /schedules routes; returns (JSON body, HTTP status)
+    if zone_id != MAIN_ZONE and zone_registry is None:
+        return {"message": "Unknown zone"}, 404
+    if not owns_zone(zone_id):
+        return {"message": "Zone %s is controlled by worker %d" % (zone_id, shard_ring.shard_for(zone_id))}, 421
+    if zone_id != MAIN_ZONE and zone_id not in zone_registry.zones:
+        return {"message": "Unknown zone"}, 404
+    try:
+        if override and method == 'POST':
+            if not isinstance(data, dict):
+                raise ValueError("expected a JSON object")
+            schedule_engine.set_override(zone_id, data.get('mode'), data.get('set_temperature'), data.get('until'))
+        elif override and method == 'DELETE':
+            schedule_engine.clear_override(zone_id)
+        elif method == 'PUT':
+            schedule_engine.set_schedule(zone_id, data)
+        elif method == 'DELETE':
+            schedule_engine.remove_schedule(zone_id)
+    except (ValueError, TypeError) as e:
+        return {"message": "Invalid schedule request: %s" % e}, 400
+    return schedule_engine.state(zone_id), 200
+
+control_loop = ControlLoop(control_inputs, process_inputs, control_sample_time)
+
+# Prometheus metrics served at /metrics. Hot path updates are single attribute increments;
+# everything that already has a counter elsewhere is read at scrape time.
+metrics = Registry()
+messages_total = metrics.counter('hvac_messages_total', 'MQTT messages received by topic', ('topic',))
+invalid_payloads_total = metrics.counter('hvac_invalid_payloads_total', 'Payloads that failed to parse', ('topic',))
+message_counters = {kind: messages_total.labels(kind) for kind in
+                    ('temperature', 'set_temperature', 'external_temperature', 'average_temperature', 'zone', 'unknown')}
+invalid_counters = {kind: invalid_payloads_total.labels(kind) for kind in message_counters}
+batch_readings = metrics.counter('hvac_batch_readings_total', 'Readings received in batched payloads').labels()
+message_seconds = metrics.histogram('hvac_on_message_seconds', 'Time spent handling one MQTT message').labels()
+pid_update_seconds = metrics.histogram('hvac_pid_update_seconds', 'Time spent in PID.update').labels()
+publish_seconds = metrics.histogram('hvac_publish_seconds', 'Time spent publishing a relay command').labels()
+metrics.counter('hvac_publishes_total', 'Relay commands published', function=lambda: relay_publisher.publishes)
+metrics.counter('hvac_publishes_suppressed_total', 'Relay commands skipped because nothing changed',
+                function=lambda: relay_publisher.suppressed)
+metrics.counter('hvac_relay_transitions_total', 'Relay state changes', function=lambda: relay_publisher.transitions)
+metrics.counter('hvac_coalesced_total', 'Inputs overwritten before evaluation', function=lambda: control_inputs.coalesced)
+metrics.counter('hvac_evaluations_total', 'Control loop evaluations', function=lambda: control_loop.evaluations)
+metrics.counter('hvac_filter_rejected_total', 'Temperature readings rejected as outliers',
+                function=lambda: sum(f.rejected() for f in all_filters()))
+metrics.counter('hvac_filter_skipped_total', 'Filtered temperatures within the deadband, not evaluated',
+                function=lambda: sum(f.skipped for f in all_filters()))
+metrics.counter('hvac_deadline_evaluations_total', 'Evaluations triggered by an expired hold or lockout',
+                function=lambda: deadline_scheduler.fired)
+metrics.gauge('hvac_scheduled_deadlines', 'Pending hold/lockout deadlines',
+              function=lambda: len(deadline_scheduler.entries))
+mqtt_recovery_seconds = metrics.histogram('hvac_mqtt_recovery_seconds', 'Time from losing the broker to reconnecting',
+                                          buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)).labels()
+metrics.counter('hvac_mqtt_disconnects_total', 'Broker connections lost', function=lambda: mqtt_monitor.disconnects)
+metrics.gauge('hvac_mqtt_connected', '1 while connected to the broker', function=lambda: int(mqtt_monitor.connected))
+metrics.counter('hvac_relay_commands_buffered_total', 'Relay commands held back while disconnected',
+                function=lambda: relay_publisher.buffered)
+metrics.gauge('hvac_shard_zones', 'Zones controlled by this process',
+              function=lambda: len(zone_registry.zones) if zone_registry is not None else 0)
+metrics.counter('hvac_zone_messages_other_shard_total', 'Zone messages ignored because another worker owns the zone',
+                function=lambda: zone_registry.foreign if zone_registry is not None else 0)
+metrics.gauge('hvac_queue_depth', 'Inputs waiting for the next control loop tick',
+              function=lambda: len(control_inputs.values))
+metrics.gauge('hvac_pid_p_term', 'Proportional term of the PID controller', function=lambda: pid.PTerm)
+metrics.gauge('hvac_pid_i_term', 'Integral term of the PID controller', function=lambda: pid.ITerm)
+metrics.gauge('hvac_pid_d_term', 'Derivative term of the PID controller', function=lambda: pid.DTerm)
+metrics.gauge('hvac_pid_output', 'Output of the PID controller', function=lambda: pid.output)
+
+def all_filters():
+    filters = list(zone_filters.values())
+    if temperature_filter is not None:
+        filters.append(temperature_filter)
+    return filters
 
 def publish_control_command():
-    # Publish the control command to the MQTT topic
-    command = {
-        "fan": FAN_ON if fan_state else FAN_OFF,
-        "cooling": COOLING_ON if cooling_state else COOLING_OFF,
-        "heating": HEATING_ON if heating_state else HEATING_OFF
+    # Publish the control command to the MQTT topic if the relay state changed
+    started = perf_counter()
+    if relay_publisher.publish(ac_control_topic, fan_state, cooling_state, heating_state):
+        publish_seconds.observe(perf_counter() - started)
+        log.info("Published control command: fan=%s cooling=%s heating=%s", fan_state, cooling_state, heating_state)
+
+# Request handling shared by the Flask routes below and the asyncio (Quart) routes in
+# aio_server.py; each returns (JSON body, HTTP status) and the routes only adapt the request
+
+def set_temperature_request(data):
+    # Non-finite values would reach the PID and the journal, like in api_setpoints
+    try:
+        value = float(data)
+    except (ValueError, TypeError):
+        return {"message": "Invalid temperature value"}, 400
+    if not math.isfinite(value):
+        return {"message": "Invalid temperature value"}, 400
+    control_inputs.put('set_temperature', value)
+    mqtt_client.publish(set_temperature_topic, str(value))
+    return {"message": "Temperature set successfully", "set_temperature": value}, 200
+
+def parse_gains(data):
+    # {"Kp", "Ki", "Kd", "windup_guard"} (any subset) as finite floats, or None if invalid
+    if not isinstance(data, dict) or not data or not set(data) <= set(PID_GAINS):
+        return None
+    try:
+        gains = {key: float(value) for key, value in data.items()}
+    except (ValueError, TypeError):
+        return None
+    if not all(math.isfinite(value) for value in gains.values()):
+        return None
+    return gains
+
+def pid_gains_request(method, data=None):
+    if method == 'GET':
+        return {key: getattr(pid, key) for key in PID_GAINS}, 200
+    gains = parse_gains(data)
+    if gains is None:
+        return {"message": "Invalid PID gains, expected a JSON object with %s" % ', '.join(PID_GAINS)}, 400
+    control_inputs.put('pid_gains', gains)
+    return {"message": "PID gains updated", "pid_gains": gains}, 200
+
+def dashboard_context():
+    # Template variables of index.html; without stream the page polls /api/state
+    return dict(stream=False, current_temperature=current_temperature, set_temperature=set_temperature,
+                fan_state="ON" if fan_state else "OFF", cooling_state="ON" if cooling_state else "OFF",
+                heating_state="ON" if heating_state else "OFF", pid_calculation=pid.get_pid_value(),
+                external_temperature=external_temperature, avg_external_temperature=avg_external_temperature)
+
+def hvac_state():
+    return {
+        'fan_state': 'ON' if fan_state else 'OFF',
+        'cooling_state': 'ON' if cooling_state else 'OFF',
+        'heating_state': 'ON' if heating_state else 'OFF'
     }
-    mqtt_client.publish(ac_control_topic, json.dumps(command))
-    print("Published control command:", command)
+
+def history_request(args):
+    # Downsampled min/mean/max per step seconds, default: the last hour per minute
+    try:
+        to = float(args.get('to', time.time()))
+        start = float(args.get('from', to - 3600))
+        step = float(args.get('step', 60))
+        if not all(math.isfinite(value) for value in (to, start, step)):
+            raise ValueError("from, to and step must be finite")
+        if step <= 0:
+            raise ValueError("step must be positive")
+        return history_store.query(start, to, step), 200
+    except ValueError as e:
+        return {"message": "Invalid history query: %s" % e}, 400
+
+def control_stats():
+    return dict(control_loop.stats(), mqtt=mqtt_monitor.stats())
+
+def schedules_state():
+    return {'zones': [schedule_engine.state(zone_id) for zone_id in schedule_engine.zone_ids()]}
+
+def zone_state_request(zone_id):
+    if zone_registry is None or zone_id not in zone_registry.zones:
+        return {"message": "Unknown zone"}, 404
+    return zone_registry.zones[zone_id].state(), 200
 
 @app.route('/set_temperature', methods=['POST'])
 def set_temp():
-    global set_temperature
-    # Set the new set temperature based on the request data
-    data = request.form.get('set_temperature')
-    try:
-        set_temperature = float(data)
-        update_hvac_control()
-        mqtt_client.publish('set_temperature', str(set_temperature))
-        return jsonify({"message": "Temperature set successfully", "set_temperature": set_temperature})
-    except (ValueError, TypeError):
-        return jsonify({"message": "Invalid temperature value"})
+    body, status = set_temperature_request(request.form.get('set_temperature'))
+    return jsonify(body), status
+
+@app.route('/pid_gains', methods=['GET', 'POST'])
+def pid_gains():
+    body, status = pid_gains_request(request.method, request.get_json(silent=True))
+    return jsonify(body), status
 
 @app.route('/')
 def index():
-    # Render the index.html template and pass the current and set temperature values
-    return render_template('index.html', current_temperature=current_temperature, set_temperature=set_temperature,
-                           fan_state="ON" if fan_state else "OFF", cooling_state="ON" if cooling_state else "OFF",
-                           heating_state="ON" if heating_state else "OFF", pid_calculation=pid.get_pid_value(),
-                           external_temperature=external_temperature, avg_external_temperature=avg_external_temperature)
+    return render_template('index.html', **dashboard_context())
 
 @app.route('/get_hvac_state')
 def get_hvac_state():
-    return jsonify({
-        'fan_state': 'ON' if fan_state else 'OFF',
-        'cooling_state': 'ON' if cooling_state else 'OFF',
-        'heating_state': 'ON' if heating_state else 'OFF'
-    })
+    return jsonify(hvac_state())
 
 @app.route('/get_pid_calculation')
 def get_pid_calculation():
-    return jsonify({
-        'pid_calculation': pid.get_pid_value()
-    })
+    return jsonify({'pid_calculation': pid.get_pid_value()})
+
+@app.route('/history')
+def history():
+    body, status = history_request(request.args)
+    return jsonify(body), status
+
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/get_control_stats')
+def get_control_stats():
+    return jsonify(control_stats())
+
+@app.route('/get_current_temperature')
+def get_current_temperature():
+    return jsonify({'current_temperature': current_temperature})
+
+@app.route('/api/state')
+def get_api_state():
+    status, body, headers = api_state_response(request.headers.get('If-None-Match'),
+                                               request.headers.get('Accept-Encoding'))
+    return Response(body, status=status, headers=headers)
+
+@app.route('/api/zones', methods=['GET', 'POST'])
+def api_zones():
+    if request.method == 'POST':
+        body, status = api_setpoints(request.get_json(silent=True))
+        return jsonify(body), status
+    status, body, headers = api_zones_response(request.args.get('ids'), request.headers.get('If-None-Match'),
+                                               request.headers.get('Accept-Encoding'))
+    return Response(body, status=status, headers=headers)
+
+@app.route('/schedules')
+def get_schedules():
+    return jsonify(schedules_state())
+
+@app.route('/schedules/<zone_id>', methods=['GET', 'PUT', 'DELETE'])
+def zone_schedule(zone_id):
+    body, status = schedule_request(request.method, zone_id, request.get_json(silent=True))
+    return jsonify(body), status
+
+@app.route('/schedules/<zone_id>/override', methods=['POST', 'DELETE'])
+def zone_override(zone_id):
+    body, status = schedule_request(request.method, zone_id, request.get_json(silent=True), override=True)
+    return jsonify(body), status
+
+@app.route('/get_zone_state/<zone_id>')
+def get_zone_state(zone_id):
+    body, status = zone_state_request(zone_id)
+    return jsonify(body), status
 
 def mqtt_thread():
-    # Start the MQTT client
+    # Start the MQTT client; the session thread keeps reconnecting until the broker is reachable
     mqtt_client.on_connect = on_connect
+    mqtt_client.on_disconnect = on_disconnect
     mqtt_client.on_message = on_message
-    mqtt_client.connect(mqtt_broker, mqtt_port, 60)
-    mqtt_client.loop_start()
+    mqtt_session.start()
+
+def heartbeat_thread():
+    # Re-send unchanged relay commands so devices that missed one can resync
+    while True:
+        time.sleep(relay_publisher.heartbeat_interval / 2)
+        relay_publisher.heartbeat()
+
+def set_shard_count(count):
+    # The supervisor changed the number of workers: release the zones that now hash to another
+    # shard and take over the ones that hash here, from the newest state in the shard journals
+    global shard_ring, controller_owned
+    subscribed = set(subscription_topics())
+    with data_lock:
+        shard_ring = HashRing(count)
+        was_owned = controller_owned
+        controller_owned = owns_zone(MAIN_ZONE)
+        if was_owned and not controller_owned:
+            deadline_scheduler.cancel('reevaluate')
+            relay_publisher.forget(ac_control_topic)
+            schedule_engine.forget(MAIN_ZONE)
+            # The new owner's /history reads this shard's segments, not its ring
+            history_store.flush()
+        released = zone_registry.rebalance() if zone_registry is not None else []
+        for zone in released:
+            deadline_scheduler.cancel((zone, None))
+            relay_publisher.forget(zone.control_topic)
+            zone_filters.pop(zone, None)
+            schedule_engine.forget(zone.zone_id)
+        if state_journal is not None:
+            state_journal.sync()
+            states = journal_states()
+            restore_state(states, restore_controller=not was_owned)
+            load_schedules(states)
+    topics = set(subscription_topics())
+    if subscribed - topics:
+        mqtt_client.unsubscribe(list(subscribed - topics))
+    if topics - subscribed:
+        mqtt_client.subscribe([(topic, mqtt_qos) for topic in topics - subscribed])
+    log.info("Shard %d of %d: released %d zones, controlling %d zones%s", shard_index, count, len(released),
+             len(zone_registry.zones) if zone_registry is not None else 0,
+             ' and the main controller' if controller_owned else '')
+
+def run_on_controller(function, *args):
+    # Runs function where the controller and MQTT client may be used from another thread
+    # (replaced in asyncio mode, where that is the event loop)
+    return function(*args)
+
+def supervisor_commands():
+    # Worker side of supervisor mode: JSON lines from the supervisor on stdin. End of input
+    # means the supervisor is gone, and so does the worker.
+    for line in sys.stdin:
+        try:
+            command = json.loads(line)
+            if 'shards' in command:
+                run_on_controller(set_shard_count, int(command['shards']))
+                if 'resize' in command and supervisor_ack_fd is not None:
+                    os.write(supervisor_ack_fd, (json.dumps({'released': command['resize']}) + '\n').encode())
+        except (ValueError, TypeError) as e:
+            log.warning("Invalid supervisor command %r: %s", line, e)
+    log.warning("Supervisor gone, exiting")
+    if state_journal is not None:
+        state_journal.sync()
+    os._exit(0)
+
+def forwarded_command(name, value):
+    # Writes received by the web workers, applied like the /set_temperature route
+    if name == 'set_temperature':
+        control_inputs.put('set_temperature', value)
+        mqtt_client.publish(set_temperature_topic, str(value))
 
 def flask_thread():
-    # Start the Flask web API
-    app.run(host='0.0.0.0', port=5000)
+    # Start the Flask web API; with web workers it moves to ADMIN_PORT for history/metrics
+    if web_workers_count:
+        app.run(host='0.0.0.0', port=int(os.environ.get('ADMIN_PORT', 5001)))
+    else:
+        app.run(host='0.0.0.0', port=web_port)
 
 if __name__ == '__main__':
-    # Start MQTT and Flask in separate threads
-    mqtt_thread = threading.Thread(target=mqtt_thread)
-    flask_thread = threading.Thread(target=flask_thread)
+    configure_logging(os.environ.get('LOG_LEVEL', 'INFO'))
+    if supervisor_workers:
+        # Only supervise: the workers are this script with SHARD_INDEX/SHARD_COUNT set
+        from supervisor import Supervisor
+        Supervisor(supervisor_workers, os.path.abspath(__file__), mqtt_client_id, state_journal_path,
+                   int(os.environ.get('SHARD_WEB_PORT', 5100)), zone_ids).run()
+        sys.exit(0)
+    state_journal = open_state_journal()
+    states = journal_states() if state_journal is not None else {}
+    if state_journal is not None:
+        restore_state(states)
+    load_schedules(states)
+
+    if os.environ.get('SERVE_MODE', 'threads') == 'asyncio':
+        # MQTT, HTTP and the control loop on one asyncio event loop
+        import aio_server
+        aio_server.run(sys.modules[__name__], port=web_port)
+    else:
+        # Start MQTT and Flask in separate threads
+        flask_thread = threading.Thread(target=flask_thread)
 
-    mqtt_thread.start()
-    flask_thread.start()
+        if web_workers_count:
+            # Fork the web workers before any thread is started
+            state_snapshot.write(current_temperature, external_temperature, avg_external_temperature,
+                                 set_temperature, pid.get_pid_value(), fan_state, cooling_state, heating_state)
+            web_workers = WebWorkers(state_snapshot, web_workers_count, '0.0.0.0', web_port, app.template_folder,
+                                     app.root_path)
+            web_workers.start()
+            web_workers.forward_commands(forwarded_command)
+            atexit.register(state_snapshot.close)
+        if supervised:
+            threading.Thread(target=supervisor_commands, name='supervisor-commands', daemon=True).start()
+        if state_journal is not None:
+            state_journal.start()
+        control_loop.start()
+        deadline_scheduler.start()
+        if relay_publisher.heartbeat_interval:
+            threading.Thread(target=heartbeat_thread, daemon=True).start()
+        mqtt_thread()
+        flask_thread.start()
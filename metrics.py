@@ -0,0 +1,154 @@
+import bisect
+import math
+
+# Default histogram bucket upper bounds in seconds, 10us .. 1s
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in zip(names, values))
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Metric:
+    # Prometheus metric with optional labels. Updates are plain attribute arithmetic with no
+    # lock: every metric here is only written from one thread (MQTT or control loop).
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        # Read the value at scrape time instead of tracking it on the hot path
+        self.function = function
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, '', self.function()
+            return
+        for values, child in sorted(self.children.items()):
+            for suffix, labels, value in child.samples():
+                yield self.name + suffix, format_labels(self.label_names + labels[0], values + labels[1]), value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, labels, format_value(value)))
+        return '\n'.join(lines)
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield '', ((), ()), self.value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def new_child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def new_child(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.bounds + (math.inf,), self.counts):
+            total += count
+            yield '_bucket', (('le',), (format_value(bound),)), total
+        yield '_sum', ((), ()), self.sum
+        yield '_count', ((), ()), total
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.bounds = tuple(buckets)
+
+    def new_child(self):
+        return HistogramValue(self.bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), function=None):
+        return self.register(Counter(name, help, labels, function))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self.register(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
@@ -0,0 +1,323 @@
+# Minimal MQTT 3.1.1 broker, a local stand-in for EMQX when testing reconnects and load:
+#
+#   python minibroker.py --port 1883
+#
+# Supports CONNECT (persistent sessions with clean_session=0), PUBLISH QoS 0/1 with retained
+# messages, SUBSCRIBE/UNSUBSCRIBE with + and # wildcards (QoS 2 is granted as 1), PINGREQ and
+# DISCONNECT. No authentication (username/password are accepted and ignored), no wills.
+# BrokerThread runs it in the background and can stop and restart it to simulate a node restart.
+import argparse
+import asyncio
+import collections
+import logging
+import struct
+import threading
+
+log = logging.getLogger('minibroker')
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(topic_filter, topic):
+    if topic_filter == topic:
+        return True
+    if '+' not in topic_filter and '#' not in topic_filter:
+        return False
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+    for i, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts) or (part != '+' and part != topic_parts[i]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def packet(packet_type, flags, body):
+    return bytes((packet_type << 4 | flags,)) + encode_length(len(body)) + body
+
+
+def encode_string(text):
+    data = text.encode()
+    return struct.pack('!H', len(data)) + data
+
+
+def publish_packet(topic, payload, qos, retain, mid=None, dup=False):
+    body = encode_string(topic)
+    if qos:
+        body += struct.pack('!H', mid)
+    return packet(PUBLISH, dup << 3 | qos << 1 | retain, body + payload)
+
+
+class Session:
+    def __init__(self, client_id, max_queued):
+        self.client_id = client_id
+        self.subscriptions = {}
+        # QoS 1 messages for a disconnected persistent session, oldest dropped when full
+        self.queue = collections.deque(maxlen=max_queued)
+        # mid -> (topic, payload) waiting for PUBACK
+        self.inflight = {}
+        self.next_mid = 0
+        self.writer = None
+        self.clean = True
+
+    def mid(self):
+        self.next_mid = self.next_mid % 65535 + 1
+        return self.next_mid
+
+    def send(self, topic, payload, qos, retain=False):
+        if self.writer is None:
+            if qos and not self.clean:
+                self.queue.append((topic, payload))
+            return
+        if qos:
+            mid = self.mid()
+            self.inflight[mid] = (topic, payload)
+            self.writer.write(publish_packet(topic, payload, 1, retain, mid))
+        else:
+            self.writer.write(publish_packet(topic, payload, 0, retain))
+
+
+class Broker:
+    def __init__(self, host='127.0.0.1', port=1883, max_queued=10000):
+        self.host = host
+        self.port = port
+        self.max_queued = max_queued
+        self.server = None
+        self.sessions = {}
+        self.retained = {}
+        # topic -> [(session, granted qos)], cleared whenever sessions or subscriptions change
+        self.routes = {}
+        self.received = 0
+        self.delivered = 0
+        self.connections = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        if not self.port:
+            self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self, forget_sessions=False):
+        # Close the listener and every connection, like a broker node going down. Sessions
+        # survive unless forget_sessions, which simulates failing over to a node without them.
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        for writer in list(self.connections):
+            writer.close()
+        self.connections.clear()
+        for session in self.sessions.values():
+            session.writer = None
+        if forget_sessions:
+            self.sessions.clear()
+            self.routes.clear()
+
+    async def read_packet(self, reader):
+        header = await reader.readexactly(1)
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        body = await reader.readexactly(length) if length else b''
+        return header[0] >> 4, header[0] & 0x0f, body
+
+    async def handle(self, reader, writer):
+        self.connections.add(writer)
+        session = None
+        try:
+            packet_type, flags, body = await self.read_packet(reader)
+            if packet_type != CONNECT:
+                return
+            session = self.connect(body, writer)
+            while True:
+                packet_type, flags, body = await self.read_packet(reader)
+                if packet_type == PUBLISH:
+                    self.on_publish(flags, body, writer)
+                elif packet_type == PUBACK:
+                    session.inflight.pop(struct.unpack('!H', body[:2])[0], None)
+                elif packet_type == SUBSCRIBE:
+                    self.on_subscribe(session, body, writer)
+                elif packet_type == UNSUBSCRIBE:
+                    mid = body[:2]
+                    offset = 2
+                    while offset < len(body):
+                        length = struct.unpack_from('!H', body, offset)[0]
+                        session.subscriptions.pop(body[offset + 2:offset + 2 + length].decode(), None)
+                        offset += 2 + length
+                    self.routes.clear()
+                    writer.write(packet(UNSUBACK, 0, mid))
+                elif packet_type == PINGREQ:
+                    writer.write(packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    return
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            if session is not None and session.writer is writer:
+                session.writer = None
+                if session.clean:
+                    self.sessions.pop(session.client_id, None)
+                    self.routes.clear()
+            writer.close()
+
+    def connect(self, body, writer):
+        offset = 2 + struct.unpack_from('!H', body, 0)[0]
+        connect_flags = body[offset + 1]
+        offset += 4
+        length = struct.unpack_from('!H', body, offset)[0]
+        client_id = body[offset + 2:offset + 2 + length].decode() or 'anonymous-%d' % id(writer)
+        clean = bool(connect_flags & 0x02)
+        session = self.sessions.get(client_id)
+        present = session is not None and not clean
+        if session is not None and session.writer is not None:
+            # Session takeover: the old connection is closed
+            session.writer.close()
+        if session is None or clean:
+            session = self.sessions[client_id] = Session(client_id, self.max_queued)
+            self.routes.clear()
+        session.clean = clean
+        session.writer = writer
+        writer.write(packet(CONNACK, 0, bytes((int(present), 0))))
+        if present:
+            for mid, (topic, payload) in session.inflight.items():
+                writer.write(publish_packet(topic, payload, 1, False, mid, dup=True))
+            while session.queue:
+                session.send(*session.queue.popleft(), qos=1)
+        return session
+
+    def on_publish(self, flags, body, writer):
+        qos = flags >> 1 & 0x03
+        retain = flags & 0x01
+        length = struct.unpack_from('!H', body, 0)[0]
+        topic = body[2:2 + length].decode()
+        offset = 2 + length
+        if qos:
+            mid = struct.unpack_from('!H', body, offset)[0]
+            offset += 2
+            writer.write(packet(PUBACK, 0, struct.pack('!H', mid)))
+        payload = body[offset:]
+        self.received += 1
+        if retain:
+            if payload:
+                self.retained[topic] = (payload, min(qos, 1))
+            else:
+                self.retained.pop(topic, None)
+        for session, granted in self.route(topic):
+            session.send(topic, payload, min(qos, granted))
+            self.delivered += 1
+
+    def route(self, topic):
+        # Sessions subscribed to a topic with their highest granted QoS
+        route = self.routes.get(topic)
+        if route is None:
+            route = []
+            for session in self.sessions.values():
+                granted = None
+                for topic_filter, subscription_qos in session.subscriptions.items():
+                    if topic_matches(topic_filter, topic):
+                        granted = max(granted or 0, subscription_qos)
+                if granted is not None:
+                    route.append((session, granted))
+            self.routes[topic] = route
+        return route
+
+    def on_subscribe(self, session, body, writer):
+        mid = body[:2]
+        offset = 2
+        granted = bytearray()
+        filters = []
+        while offset < len(body):
+            length = struct.unpack_from('!H', body, offset)[0]
+            topic_filter = body[offset + 2:offset + 2 + length].decode()
+            qos = min(body[offset + 2 + length], 1)
+            offset += 3 + length
+            session.subscriptions[topic_filter] = qos
+            self.routes.clear()
+            granted.append(qos)
+            filters.append((topic_filter, qos))
+        writer.write(packet(SUBACK, 0, mid + bytes(granted)))
+        # Retained messages: looked up directly for plain topic filters, scanned for wildcards
+        wildcards = [(topic_filter, qos) for topic_filter, qos in filters if '+' in topic_filter or '#' in topic_filter]
+        sent = set()
+        for topic_filter, qos in filters:
+            if topic_filter in self.retained and topic_filter not in sent:
+                payload, retained_qos = self.retained[topic_filter]
+                session.send(topic_filter, payload, min(qos, retained_qos), retain=True)
+                sent.add(topic_filter)
+        if wildcards:
+            for topic, (payload, retained_qos) in self.retained.items():
+                if topic in sent:
+                    continue
+                for topic_filter, qos in wildcards:
+                    if topic_matches(topic_filter, topic):
+                        session.send(topic, payload, min(qos, retained_qos), retain=True)
+                        break
+
+
+class BrokerThread:
+    # The broker on its own event loop thread, controllable from synchronous code
+    def __init__(self, host='127.0.0.1', port=0, max_queued=10000):
+        self.broker = Broker(host, port, max_queued)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='minibroker', daemon=True)
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.broker.port
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def start(self):
+        self.call(self.broker.start())
+        return self
+
+    def stop(self, forget_sessions=False):
+        self.call(self.broker.stop(forget_sessions))
+
+    def close(self):
+        self.stop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Minimal MQTT 3.1.1 broker for local testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    async def serve():
+        broker = Broker(args.host, args.port)
+        await broker.start()
+        log.info("Listening on %s:%s", args.host, broker.port)
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import logging
+import random
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+log = logging.getLogger('hvac')
+
+
+class Backoff:
+    # Exponential backoff with full jitter: the n-th delay is uniform in [0, min(cap, base * 2^n)],
+    # so a fleet of controllers does not reconnect in lockstep after a broker restart
+    def __init__(self, base=1.0, cap=60.0, rng=random.random):
+        self.base = base
+        self.cap = cap
+        self.rng = rng
+        self.attempt = 0
+
+    def next(self):
+        delay = self.rng() * min(self.cap, self.base * 2 ** self.attempt)
+        self.attempt = min(self.attempt + 1, 32)
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+
+class ConnectionMonitor:
+    # Connection state and recovery times (disconnect -> CONNACK), fed from on_connect/on_disconnect
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.connected = False
+        self.connects = 0
+        self.disconnects = 0
+        self.disconnected_at = None
+        self.last_recovery = None
+        self.session_present = False
+
+    def on_connected(self, session_present):
+        # Returns the recovery time in seconds, or None for the first connection
+        self.connected = True
+        self.connects += 1
+        self.session_present = bool(session_present)
+        recovery = None
+        if self.disconnected_at is not None:
+            recovery = self.last_recovery = self.clock() - self.disconnected_at
+            self.disconnected_at = None
+        return recovery
+
+    def on_disconnected(self):
+        if self.connected:
+            self.disconnects += 1
+            self.disconnected_at = self.clock()
+        self.connected = False
+
+    def stats(self):
+        return {
+            'connected': self.connected,
+            'connects': self.connects,
+            'disconnects': self.disconnects,
+            'session_present': self.session_present,
+            'last_recovery_seconds': self.last_recovery,
+            'disconnected_for': None if self.disconnected_at is None else self.clock() - self.disconnected_at,
+        }
+
+
+class MQTTSession(threading.Thread):
+    # Runs the paho network loop in place of loop_start(): connects (the broker may be down at
+    # startup), and after any connection loss reconnects with jittered backoff
+    def __init__(self, client, host, port, keepalive=60, backoff=None):
+        super().__init__(name='mqtt', daemon=True)
+        self.client = client
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.backoff = backoff or Backoff()
+        self.stopping = False
+
+    def run(self):
+        client = self.client
+        while not self.stopping:
+            try:
+                client.connect(self.host, self.port, self.keepalive)
+            except OSError as e:
+                delay = self.backoff.next()
+                log.warning("MQTT connect to %s:%s failed: %s, retrying in %.1f s", self.host, self.port, e, delay)
+                time.sleep(delay)
+                continue
+            while not self.stopping:
+                rc = client.loop(timeout=1.0)
+                if rc != mqtt.MQTT_ERR_SUCCESS:
+                    break
+            if not self.stopping:
+                delay = self.backoff.next()
+                log.warning("MQTT connection lost, reconnecting in %.1f s", delay)
+                time.sleep(delay)
+
+    def stop(self):
+        self.stopping = True
+        self.client.disconnect()
@@ -0,0 +1,57 @@
+import json
+import struct
+
+# Batched sensor payloads, so a gateway can send many readings in one MQTT message:
+#   binary: b'HVB1' followed by little-endian (timestamp, value) float64 pairs
+#   JSON:   an array of [timestamp, value] pairs or of bare values
+BATCH_MAGIC = b'HVB1'
+RECORD = struct.Struct('<dd')
+
+
+def pack_batch(records):
+    # records: iterable of (timestamp, value)
+    return BATCH_MAGIC + b''.join(RECORD.pack(timestamp, value) for timestamp, value in records)
+
+
+def parse_batch(payload):
+    # List of (timestamp or None, value), or None if the payload is a single reading
+    if payload[:4] == BATCH_MAGIC:
+        body = memoryview(payload)[4:]
+        if len(body) % RECORD.size:
+            raise ValueError("truncated batch payload")
+        return list(RECORD.iter_unpack(body))
+    if payload[:1] != b'[':
+        return None
+    records = []
+    for item in json.loads(payload):
+        if isinstance(item, list):
+            timestamp, value = item
+            records.append((float(timestamp), float(value)))
+        else:
+            records.append((None, float(item)))
+    return records
+
+
+def parse_reading(payload, parser):
+    # Returns (value to use, number of readings in the payload). A batch yields its
+    # latest reading: by timestamp when there are timestamps, else the last one.
+    batch = parse_batch(payload)
+    if batch is None:
+        return parser(payload), 1
+    if not batch:
+        raise ValueError("empty batch payload")
+    if batch[0][0] is None:
+        return batch[-1][1], len(batch)
+    return max(batch, key=lambda record: record[0])[1], len(batch)
+
+
+def parse_values(payload, parser):
+    # Every reading in the payload, oldest first (for filters that need each sample)
+    batch = parse_batch(payload)
+    if batch is None:
+        return [parser(payload)]
+    if not batch:
+        raise ValueError("empty batch payload")
+    if batch[0][0] is not None:
+        batch.sort(key=lambda record: record[0])
+    return [value for timestamp, value in batch]
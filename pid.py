@@ -0,0 +1,80 @@
+import time
+
+class PID:
+    __slots__ = ('Kp', 'Ki', 'Kd', 'sample_time', 'current_time', 'last_time', 'SetPoint', 'PTerm', 'ITerm',
+                 'DTerm', 'last_error', 'int_error', 'windup_guard', 'output', 'clock')
+
+    def __init__(self, P=0.1, I=0.0, D=0.0, clock=time.time):
+        # clock returns the current time in seconds; simulations pass their own
+        self.clock = clock
+        self.Kp = P
+        self.Ki = I
+        self.Kd = D
+        self.sample_time = 0.00
+        self.current_time = clock()
+        self.last_time = self.current_time
+        self.clear()
+
+    def clear(self):
+        self.SetPoint = 0.0
+        self.PTerm = 0.0
+        self.ITerm = 0.0
+        self.DTerm = 0.0
+        self.last_error = 0.0
+        # Windup Guard
+        self.int_error = 0.0
+        self.windup_guard = 20.0
+        self.output = 0.0
+
+    def update(self, feedback_value):
+        error = self.SetPoint - feedback_value
+        self.current_time = self.clock()
+        delta_time = self.current_time - self.last_time
+        delta_error = error - self.last_error
+        if (delta_time >= self.sample_time):
+            self.PTerm = self.Kp * error
+            self.ITerm += error * delta_time
+            if (self.ITerm < -self.windup_guard):
+                self.ITerm = -self.windup_guard
+            elif (self.ITerm > self.windup_guard):
+                self.ITerm = self.windup_guard
+            self.DTerm = 0.0
+            if delta_time > 0:
+                self.DTerm = delta_error / delta_time
+            # Remember last time and last error for next calculation
+            self.last_time = self.current_time
+            self.last_error = error
+            self.output = self.PTerm + (self.Ki * self.ITerm) + (self.Kd * self.DTerm)
+
+    def get_pid_value(self):
+        return self.output
+
+    def get_state(self):
+        return {
+            "Kp": self.Kp,
+            "Ki": self.Ki,
+            "Kd": self.Kd,
+            "windup_guard": self.windup_guard,
+            "SetPoint": self.SetPoint,
+            "PTerm": self.PTerm,
+            "ITerm": self.ITerm,
+            "DTerm": self.DTerm,
+            "last_time": self.last_time,
+            "last_error": self.last_error,
+            "output": self.output
+        }
+
+    def load_state(self, state):
+        # Restores a get_state() dict; the next update measures its interval from now rather
+        # than from the saved last_time so downtime does not pile up in the integral
+        self.Kp = state.get("Kp", self.Kp)
+        self.Ki = state.get("Ki", self.Ki)
+        self.Kd = state.get("Kd", self.Kd)
+        self.windup_guard = state.get("windup_guard", self.windup_guard)
+        self.SetPoint = state.get("SetPoint", 0.0)
+        self.PTerm = state.get("PTerm", 0.0)
+        self.ITerm = state.get("ITerm", 0.0)
+        self.DTerm = state.get("DTerm", 0.0)
+        self.last_error = state.get("last_error", 0.0)
+        self.output = state.get("output", 0.0)
+        self.last_time = self.current_time = self.clock()
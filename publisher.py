@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+
+# Relay control command constants
+COOLING_ON = "cooling_on"
+COOLING_OFF = "cooling_off"
+HEATING_ON = "heating_on"
+HEATING_OFF = "heating_off"
+FAN_ON = "fan_on"
+FAN_OFF = "fan_off"
+
+# (fan, cooling, heating) -> serialized command, for all 8 relay combinations
+RELAY_PAYLOADS = {
+    (fan, cooling, heating): json.dumps({
+        "fan": FAN_ON if fan else FAN_OFF,
+        "cooling": COOLING_ON if cooling else COOLING_OFF,
+        "heating": HEATING_ON if heating else HEATING_OFF
+    })
+    for fan in (False, True) for cooling in (False, True) for heating in (False, True)
+}
+
+
+class RelayPublisher:
+    # Publishes a relay command only when the relay state of a topic changes, or when the
+    # last publish is older than the heartbeat so devices that missed it can resync.
+    # While the broker is unreachable commands are held back, one (the latest) per topic, and
+    # sent first when the connection is back instead of piling up in the client's queue.
+    def __init__(self, client, qos=0, retain=True, heartbeat=60.0, connected=True):
+        self.client = client
+        self.qos = qos
+        self.retain = retain
+        self.heartbeat_interval = heartbeat
+        self.lock = threading.Lock()
+        # topic -> [relay state, time of last publish]
+        self.published = {}
+        self.connected = connected
+        # topic -> latest relay state commanded while disconnected
+        self.pending = {}
+        self.buffered = 0
+        self.publishes = 0
+        self.suppressed = 0
+        self.transitions = 0
+
+    def publish(self, topic, fan, cooling, heating, now=None):
+        # Returns True if a message was sent
+        if now is None:
+            now = time.time()
+        state = (fan, cooling, heating)
+        with self.lock:
+            last = self.published.get(topic)
+            if last is not None and last[0] == state and (
+                    not self.heartbeat_interval or now - last[1] < self.heartbeat_interval):
+                self.suppressed += 1
+                return False
+            if last is None or last[0] != state:
+                self.transitions += 1
+            self.published[topic] = [state, now]
+            if not self.connected:
+                self.pending[topic] = state
+                self.buffered += 1
+                return False
+            self.publishes += 1
+        self.client.publish(topic, RELAY_PAYLOADS[state], self.qos, self.retain)
+        return True
+
+    def heartbeat(self, now=None):
+        # Re-send every command that has not been published for a heartbeat interval
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if not self.connected:
+                return 0
+            due = [(topic, last[0]) for topic, last in self.published.items()
+                   if now - last[1] >= self.heartbeat_interval]
+            for topic, state in due:
+                self.published[topic][1] = now
+            self.publishes += len(due)
+        for topic, state in due:
+            self.client.publish(topic, RELAY_PAYLOADS[state], self.qos, self.retain)
+        return len(due)
+
+    def forget(self, topic):
+        # Stop publishing (and heartbeating) a topic, e.g. a zone handed to another worker
+        with self.lock:
+            self.published.pop(topic, None)
+            self.pending.pop(topic, None)
+
+    def disconnected(self):
+        with self.lock:
+            self.connected = False
+
+    def resync(self):
+        # Re-send the current command of every topic after (re)connecting to the broker:
+        # the commands held back while disconnected first, then all the others
+        with self.lock:
+            self.connected = True
+            current = list(self.pending.items())
+            current.extend((topic, last[0]) for topic, last in self.published.items() if topic not in self.pending)
+            self.pending.clear()
+            now = time.time()
+            for topic, state in current:
+                self.published[topic][1] = now
+            self.publishes += len(current)
+        for topic, state in current:
+            self.client.publish(topic, RELAY_PAYLOADS[state], self.qos, self.retain)
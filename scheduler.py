@@ -0,0 +1,97 @@
+import heapq
+import logging
+import threading
+import time
+
+log = logging.getLogger('hvac')
+
+
+class DeadlineScheduler(threading.Thread):
+    # One thread for the timers of every zone: a heap of [deadline, sequence, key, callback, args]
+    # ordered by deadline. Each key has at most one live timer; scheduling it again cancels the
+    # old entry, which stays in the heap marked dead until it reaches the top (or a compaction).
+    def __init__(self, clock=time.time):
+        super().__init__(name='deadlines', daemon=True)
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.heap = []
+        self.entries = {}
+        self.sequence = 0
+        self.dead = 0
+        self.fired = 0
+
+    def schedule(self, key, deadline, callback, *args):
+        with self.condition:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] == deadline:
+                    return
+                self._kill(entry)
+            self.sequence += 1
+            entry = [deadline, self.sequence, key, callback, args]
+            self.entries[key] = entry
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                self.condition.notify()
+
+    def cancel(self, key):
+        with self.condition:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self._kill(entry)
+
+    def _kill(self, entry):
+        del self.entries[entry[2]]
+        entry[3] = None
+        self.dead += 1
+        if self.dead > 64 and self.dead > len(self.heap) // 2:
+            self.heap = [entry for entry in self.heap if entry[3] is not None]
+            heapq.heapify(self.heap)
+            self.dead = 0
+
+    def next_deadline(self):
+        with self.condition:
+            self._drop_dead()
+            return self.heap[0][0] if self.heap else None
+
+    def _drop_dead(self):
+        heap = self.heap
+        while heap and heap[0][3] is None:
+            heapq.heappop(heap)
+            self.dead -= 1
+
+    def pop_due(self, now):
+        # Remove and return (callback, args) of every timer due at now
+        due = []
+        with self.condition:
+            heap = self.heap
+            while heap and heap[0][0] <= now:
+                entry = heapq.heappop(heap)
+                if entry[3] is None:
+                    self.dead -= 1
+                    continue
+                del self.entries[entry[2]]
+                due.append((entry[3], entry[4]))
+        return due
+
+    def run(self):
+        while True:
+            with self.condition:
+                self._drop_dead()
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                remaining = self.heap[0][0] - self.clock()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+            for callback, args in self.pop_due(self.clock()):
+                self.fired += 1
+                try:
+                    callback(*args)
+                except Exception:
+                    log.exception("Scheduled callback failed")
+
+    def stats(self):
+        with self.condition:
+            return {'timers': len(self.entries), 'heap_size': len(self.heap), 'fired': self.fired}
@@ -0,0 +1,319 @@
+import bisect
+import math
+import threading
+import time
+
+DAY = 86400
+WEEK = 7 * DAY
+DAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+DAY_GROUPS = {'daily': range(7), 'weekdays': range(5), 'weekends': (5, 6)}
+OVERRIDE_MODES = ('hold', 'away')
+
+# How often the pre-heat/pre-cool start is re-estimated while a transition is within max_lead
+LEAD_RECHECK = 300.0
+
+
+def parse_days(value):
+    # "mon,wed,fri", "mon-fri", "weekdays", "weekends", "daily" or a list of day names/numbers (0 = Monday)
+    if isinstance(value, str):
+        value = value.lower()
+        if value in DAY_GROUPS:
+            return list(DAY_GROUPS[value])
+        days = []
+        for part in value.split(','):
+            part = part.strip()
+            if '-' in part:
+                first, last = (DAY_NAMES.index(name) for name in part.split('-'))
+                days.extend(range(first, last + 1))
+            else:
+                days.append(DAY_NAMES.index(part))
+        return days
+    return [DAY_NAMES.index(day.lower()) if isinstance(day, str) else int(day) % 7 for day in value]
+
+
+def parse_time(text):
+    # "HH:MM" -> seconds after midnight
+    hours, minutes = text.split(':')
+    seconds = int(hours) * 3600 + int(minutes) * 60
+    if not 0 <= seconds < DAY:
+        raise ValueError("time out of range: %s" % text)
+    return seconds
+
+
+def finite(value, name):
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError("%s must be a finite number" % name)
+    return value
+
+
+def week_offset(now):
+    # Seconds since Monday 00:00 local time. Transitions are planned one at a time, so a DST
+    # change only shifts the transition that is pending when it happens.
+    local = time.localtime(now)
+    return local.tm_wday * DAY + local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec + now % 1
+
+
+class WeeklySchedule:
+    # {"blocks": [{"days": "weekdays", "start": "06:30", "set_temperature": 70}, ...],
+    #  "away_temperature": 62, "preheat": true}
+    # Every block lasts until the next block starts, wrapping around the week.
+    __slots__ = ('config', 'offsets', 'setpoints', 'away_temperature', 'preheat')
+
+    def __init__(self, config):
+        if not isinstance(config, dict):
+            raise ValueError("a schedule must be a JSON object")
+        blocks = config.get('blocks')
+        if not isinstance(blocks, list) or not blocks:
+            raise ValueError("a schedule needs a non-empty list of blocks")
+        transitions = {}
+        try:
+            for block in blocks:
+                setpoint = finite(block['set_temperature'], 'set_temperature')
+                start = parse_time(block['start'])
+                for day in parse_days(block.get('days', 'daily')):
+                    transitions[day * DAY + start] = setpoint
+            self.away_temperature = finite(config['away_temperature'], 'away_temperature') \
+                if 'away_temperature' in config else None
+        except (KeyError, TypeError, AttributeError, IndexError) as e:
+            raise ValueError("invalid schedule block: %r" % (e,))
+        if not transitions:
+            raise ValueError("a schedule needs at least one block on at least one day")
+        self.config = config
+        self.offsets = sorted(transitions)
+        self.setpoints = [transitions[offset] for offset in self.offsets]
+        self.preheat = bool(config.get('preheat', False))
+
+    def setpoint_at(self, offset):
+        return self.setpoints[bisect.bisect_right(self.offsets, offset) - 1]
+
+    def next_transition(self, offset):
+        # (seconds until the next transition, its setpoint)
+        i = bisect.bisect_right(self.offsets, offset)
+        if i == len(self.offsets):
+            return self.offsets[0] + WEEK - offset, self.setpoints[0]
+        return self.offsets[i] - offset, self.setpoints[i]
+
+
+class RecoveryRate:
+    # Learns how fast a zone moves with the heating or cooling on (degrees per second),
+    # measured over runs of at least min_interval seconds and smoothed with an EMA
+    __slots__ = ('heating_rate', 'cooling_rate', 'mode', 'start_temperature', 'start_time', 'min_interval', 'alpha')
+
+    def __init__(self, heating_rate=0.0, cooling_rate=0.0, min_interval=600.0, alpha=0.3):
+        self.heating_rate = heating_rate
+        self.cooling_rate = cooling_rate
+        self.min_interval = min_interval
+        self.alpha = alpha
+        self.mode = 0
+        self.start_temperature = 0.0
+        self.start_time = 0.0
+
+    def observe(self, temperature, heating, cooling, now):
+        # Returns True when a rate was updated
+        mode = 1 if heating else -1 if cooling else 0
+        if mode != self.mode:
+            self.mode, self.start_temperature, self.start_time = mode, temperature, now
+            return False
+        elapsed = now - self.start_time
+        if mode == 0 or elapsed < self.min_interval:
+            return False
+        rate = (temperature - self.start_temperature) * mode / elapsed
+        if rate > 0:
+            if mode > 0:
+                self.heating_rate = rate if not self.heating_rate else \
+                    self.heating_rate + self.alpha * (rate - self.heating_rate)
+            else:
+                self.cooling_rate = rate if not self.cooling_rate else \
+                    self.cooling_rate + self.alpha * (rate - self.cooling_rate)
+        self.start_temperature, self.start_time = temperature, now
+        return rate > 0
+
+    def lead_time(self, temperature, setpoint, max_lead):
+        # Seconds needed to get from temperature to setpoint, 0 if unknown
+        if temperature is None:
+            return 0.0
+        delta = setpoint - temperature
+        rate = self.heating_rate if delta > 0 else self.cooling_rate
+        if not rate or not delta:
+            return 0.0
+        return min(abs(delta) / rate, max_lead)
+
+
+class ScheduleEngine:
+    # Weekly setpoint schedules and away/hold overrides for any number of zones. Each zone has at
+    # most one pending timer in the shared DeadlineScheduler (its next transition, override end
+    # or pre-heat check), so idle schedules cost nothing between transitions.
+    #   apply(zone_id, set_temperature)  hands a new setpoint to the controller
+    #   temperature(zone_id)             current temperature, for pre-heat/pre-cool
+    def __init__(self, scheduler, apply, temperature, clock=time.time, max_lead=7200.0):
+        self.scheduler = scheduler
+        self.apply = apply
+        self.temperature = temperature
+        self.clock = clock
+        self.max_lead = max_lead
+        self.lock = threading.RLock()
+        self.schedules = {}
+        self.overrides = {}
+        self.recovery = {}
+        # Last setpoint handed to apply() and the reason, per zone
+        self.active = {}
+        self.journal = None
+
+    def set_schedule(self, zone_id, config):
+        schedule = WeeklySchedule(config)
+        with self.lock:
+            previous = self.schedules.get(zone_id)
+            active = self.active.pop(zone_id, None)
+            self.schedules[zone_id] = schedule
+            try:
+                self._plan(zone_id)
+            except Exception:
+                # Keep the schedule that was there before
+                if previous is None:
+                    del self.schedules[zone_id]
+                else:
+                    self.schedules[zone_id] = previous
+                if active is not None:
+                    self.active[zone_id] = active
+                raise
+            self._record(zone_id)
+
+    def remove_schedule(self, zone_id):
+        with self.lock:
+            self.schedules.pop(zone_id, None)
+            self.overrides.pop(zone_id, None)
+            self.active.pop(zone_id, None)
+            self.scheduler.cancel(('schedule', zone_id))
+            self._record(zone_id)
+
+    def forget(self, zone_id):
+        # Drop a zone from this engine without recording it, when another worker takes it over
+        with self.lock:
+            self.schedules.pop(zone_id, None)
+            self.overrides.pop(zone_id, None)
+            self.recovery.pop(zone_id, None)
+            self.active.pop(zone_id, None)
+            self.scheduler.cancel(('schedule', zone_id))
+
+    def set_override(self, zone_id, mode, set_temperature=None, until=None):
+        # hold: keep set_temperature until `until` (epoch seconds, None = until cleared)
+        # away: the schedule's away_temperature (or set_temperature) until `until`
+        if mode not in OVERRIDE_MODES:
+            raise ValueError("override mode must be one of %s" % ', '.join(OVERRIDE_MODES))
+        with self.lock:
+            schedule = self.schedules.get(zone_id)
+            if set_temperature is None and mode == 'away' and schedule is not None:
+                set_temperature = schedule.away_temperature
+            if set_temperature is None:
+                raise ValueError("set_temperature is required")
+            self.overrides[zone_id] = {'mode': mode, 'set_temperature': finite(set_temperature, 'set_temperature'),
+                                       'until': None if until is None else finite(until, 'until')}
+            self._plan(zone_id)
+            self._record(zone_id)
+
+    def clear_override(self, zone_id):
+        with self.lock:
+            if self.overrides.pop(zone_id, None) is not None:
+                self._plan(zone_id)
+                self._record(zone_id)
+
+    def observe(self, zone_id, temperature, heating, cooling, now):
+        # Called after every evaluation; only scheduled zones learn a recovery rate
+        recovery = self.recovery.get(zone_id)
+        if recovery is None:
+            if zone_id not in self.schedules:
+                return
+            recovery = self.recovery[zone_id] = RecoveryRate()
+        if recovery.observe(temperature, heating, cooling, now):
+            self._record(zone_id)
+
+    def _plan(self, zone_id):
+        # Apply the setpoint that is due now and schedule the next wake-up of this zone
+        with self.lock:
+            now = self.clock()
+            override = self.overrides.get(zone_id)
+            if override is not None and override['until'] is not None and override['until'] <= now:
+                del self.overrides[zone_id]
+                self._record(zone_id)
+                override = None
+            schedule = self.schedules.get(zone_id)
+            wake = None
+            if override is not None:
+                target, reason = override['set_temperature'], override['mode']
+                wake = override['until']
+            elif schedule is not None:
+                offset = week_offset(now)
+                target, reason = schedule.setpoint_at(offset), 'schedule'
+                delay, next_setpoint = schedule.next_transition(offset)
+                wake = now + delay
+                recovery = self.recovery.get(zone_id)
+                if schedule.preheat and recovery is not None and next_setpoint != target:
+                    if delay > self.max_lead:
+                        wake = now + delay - self.max_lead
+                    else:
+                        lead = recovery.lead_time(self.temperature(zone_id), next_setpoint, self.max_lead)
+                        if delay <= lead:
+                            target, reason = next_setpoint, 'preheat' if next_setpoint > target else 'precool'
+                        else:
+                            wake = min(now + delay - lead, now + LEAD_RECHECK)
+            else:
+                self.active.pop(zone_id, None)
+                return
+            if self.active.get(zone_id, (None,))[0] != target:
+                self.active[zone_id] = (target, reason)
+                self.apply(zone_id, target)
+            else:
+                self.active[zone_id] = (target, reason)
+            if wake is None:
+                self.scheduler.cancel(('schedule', zone_id))
+            else:
+                self.scheduler.schedule(('schedule', zone_id), wake, self._plan, zone_id)
+
+    def state(self, zone_id):
+        with self.lock:
+            schedule = self.schedules.get(zone_id)
+            active = self.active.get(zone_id)
+            recovery = self.recovery.get(zone_id)
+            entry = self.scheduler.entries.get(('schedule', zone_id))
+            return {
+                'zone_id': zone_id,
+                'schedule': schedule.config if schedule is not None else None,
+                'override': self.overrides.get(zone_id),
+                'set_temperature': active[0] if active else None,
+                'reason': active[1] if active else None,
+                'next_wake': entry[0] if entry else None,
+                'heating_rate_per_hour': recovery.heating_rate * 3600 if recovery else None,
+                'cooling_rate_per_hour': recovery.cooling_rate * 3600 if recovery else None,
+            }
+
+    def zone_ids(self):
+        with self.lock:
+            return sorted(set(self.schedules) | set(self.overrides), key=str)
+
+    def get_state(self, zone_id):
+        # What the journal keeps of a zone's schedule
+        schedule = self.schedules.get(zone_id)
+        recovery = self.recovery.get(zone_id)
+        return {
+            'schedule': schedule.config if schedule is not None else None,
+            'override': self.overrides.get(zone_id),
+            'heating_rate': recovery.heating_rate if recovery else 0.0,
+            'cooling_rate': recovery.cooling_rate if recovery else 0.0,
+        }
+
+    def load_state(self, zone_id, state):
+        with self.lock:
+            if state.get('schedule'):
+                self.schedules[zone_id] = WeeklySchedule(state['schedule'])
+            else:
+                self.schedules.pop(zone_id, None)
+            if state.get('override'):
+                self.overrides[zone_id] = state['override']
+            if state.get('heating_rate') or state.get('cooling_rate'):
+                self.recovery[zone_id] = RecoveryRate(state.get('heating_rate', 0.0), state.get('cooling_rate', 0.0))
+            self._plan(zone_id)
+
+    def _record(self, zone_id):
+        if self.journal is not None:
+            self.journal.record('schedule/%s' % zone_id, self.get_state(zone_id))
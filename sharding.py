@@ -0,0 +1,40 @@
+import bisect
+import hashlib
+
+
+def ring_point(key):
+    # Stable across processes and Python versions, unlike hash()
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    # Consistent hashing of zone ids onto shards 0..count-1. Every shard owns `replicas` points
+    # on a 64-bit ring and a zone belongs to the shard of the first point at or after its own
+    # hash. Going from N to N+1 shards only moves the zones that land on the new shard's points
+    # (about 1/(N+1) of them), and going back moves only those zones again.
+    def __init__(self, count, replicas=128):
+        if count < 1:
+            raise ValueError("a hash ring needs at least one shard")
+        self.count = count
+        points = sorted((ring_point('shard-%d-%d' % (shard, replica)), shard)
+                        for shard in range(count) for replica in range(replicas))
+        self.points = [point for point, shard in points]
+        self.shards = [shard for point, shard in points]
+        # zone id -> shard, zone ids are few and looked up on every message
+        self.cache = {}
+
+    def shard_for(self, zone_id):
+        shard = self.cache.get(zone_id)
+        if shard is None:
+            if self.count == 1:
+                shard = 0
+            else:
+                i = bisect.bisect_left(self.points, ring_point(zone_id))
+                shard = self.shards[i % len(self.points)]
+            self.cache[zone_id] = shard
+        return shard
+
+
+def moved_zones(old, new, zone_ids):
+    # Zones assigned to a different shard by the new ring
+    return [zone_id for zone_id in zone_ids if old.shard_for(zone_id) != new.shard_for(zone_id)]
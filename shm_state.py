@@ -0,0 +1,65 @@
+import struct
+import time
+from multiprocessing import shared_memory
+
+# Fixed layout of the controller state snapshot:
+# sequence, version, current/external/average external/set temperature, PID output,
+# time of the last update, fan/cooling/heating relay states
+SNAPSHOT = struct.Struct('<QQdddddd???')
+SEQUENCE = struct.Struct('<Q')
+SNAPSHOT_FIELDS = ('version', 'current_temperature', 'external_temperature', 'avg_external_temperature',
+                   'set_temperature', 'pid_calculation', 'updated', 'fan_state', 'cooling_state', 'heating_state')
+
+
+class SnapshotWriter:
+    # Single writer side of a seqlock: the sequence is odd while a write is in progress,
+    # so readers can detect and retry torn reads without ever blocking the controller
+    def __init__(self, name=None):
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=SNAPSHOT.size)
+        self.name = self.shm.name
+        self.sequence = 0
+        self.version = 0
+        SNAPSHOT.pack_into(self.shm.buf, 0, 0, 0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, False, False, False)
+
+    def write(self, current_temperature, external_temperature, avg_external_temperature, set_temperature,
+              pid_output, fan, cooling, heating):
+        buf = self.shm.buf
+        self.version += 1
+        self.sequence += 1
+        SEQUENCE.pack_into(buf, 0, self.sequence)
+        SNAPSHOT.pack_into(buf, 0, self.sequence, self.version, current_temperature, external_temperature,
+                           avg_external_temperature, set_temperature, pid_output, time.time(),
+                           bool(fan), bool(cooling), bool(heating))
+        self.sequence += 1
+        SEQUENCE.pack_into(buf, 0, self.sequence)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SnapshotReader:
+    # Attach by name from any process, or pass the writer's SharedMemory to a forked child
+    def __init__(self, name=None, shm=None):
+        self.shm = shm if shm is not None else shared_memory.SharedMemory(name=name)
+
+    def read_raw(self):
+        # Tuple in SNAPSHOT_FIELDS order, retried until it was not torn by a concurrent write
+        buf = self.shm.buf
+        while True:
+            before = SEQUENCE.unpack_from(buf, 0)[0]
+            if before & 1:
+                time.sleep(0)
+                continue
+            values = SNAPSHOT.unpack_from(buf, 0)
+            if values[0] == before and SEQUENCE.unpack_from(buf, 0)[0] == before:
+                return values[1:]
+
+    def read(self):
+        return dict(zip(SNAPSHOT_FIELDS, self.read_raw()))
+
+    def version(self):
+        return self.read_raw()[0]
+
+    def close(self):
+        self.shm.close()
@@ -0,0 +1,169 @@
+# Faster-than-real-time simulation of a zone controller against a thermal model of a house.
+#
+#   python simulate.py --days 7
+#   python simulate.py --days 7 --kp 0.1,0.3,1.0 --ki 0,0.001 --workers 8
+import argparse
+import itertools
+import json
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from zones import Zone
+
+DAY = 86400.0
+
+# Every scenario key and its default; a scenario is a plain dict overriding some of them
+DEFAULT_SCENARIO = {
+    'name': 'default',
+    'days': 7.0,
+    # Controller
+    'kp': 0.1,
+    'ki': 0.0,
+    'kd': 0.0,
+    'windup_guard': 20.0,
+    'set_temperature': 70.0,
+    'sample_period': 60.0,  # seconds between sensor readings / control evaluations
+    # House, temperatures in the same unit as the setpoint
+    'initial_temperature': 70.0,
+    'envelope_time_constant': 8 * 3600.0,  # seconds for the indoor/outdoor gap to shrink by 1/e
+    'heating_rate': 6.0 / 3600,  # degrees per second with the heat on
+    'cooling_rate': 5.0 / 3600,  # degrees per second with the cooling on
+    'internal_gain': 0.5 / 3600,  # people, appliances
+    'step': 10.0,  # integration step in seconds
+    # Outdoor temperature: mean + amplitude * sine with the peak at peak_hour
+    'outdoor_mean': 85.0,
+    'outdoor_amplitude': 10.0,
+    'outdoor_peak_hour': 15.0,
+    'outdoor_trend': 0.0,  # degrees per day
+}
+
+
+class SimClock:
+    # Injected into the control core instead of time.time
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def outdoor_temperature(scenario, t):
+    phase = 2 * math.pi * (t - scenario['outdoor_peak_hour'] * 3600) / DAY
+    return scenario['outdoor_mean'] + scenario['outdoor_amplitude'] * math.cos(phase) + \
+        scenario['outdoor_trend'] * t / DAY
+
+
+def simulate(scenario):
+    # Run one scenario and return its comfort and equipment metrics
+    s = dict(DEFAULT_SCENARIO)
+    s.update(scenario)
+    clock = SimClock()
+    zone = Zone(s['name'], None, set_temperature=s['set_temperature'], clock=clock)
+    zone.pid.Kp, zone.pid.Ki, zone.pid.Kd = s['kp'], s['ki'], s['kd']
+    zone.pid.windup_guard = s['windup_guard']
+    zone.avg_external_temperature = s['outdoor_mean']
+
+    duration = s['days'] * DAY
+    step = s['step']
+    steps_per_sample = max(1, int(round(s['sample_period'] / step)))
+    leak = step / s['envelope_time_constant']
+    heat = s['heating_rate'] * step
+    cool = s['cooling_rate'] * step
+    gain = s['internal_gain'] * step
+    temperature = s['initial_temperature']
+
+    samples = 0
+    abs_error = 0.0
+    squared_error = 0.0
+    max_error = 0.0
+    cycles = {'fan': 0, 'cooling': 0, 'heating': 0}
+    runtime = {'fan': 0.0, 'cooling': 0.0, 'heating': 0.0}
+    fan = cooling = heating = False
+
+    for i in range(int(duration / step)):
+        t = i * step
+        clock.now = t
+        outdoor = outdoor_temperature(s, t)
+        if i % steps_per_sample == 0:
+            zone.current_temperature = temperature
+            zone.external_temperature = outdoor
+            zone.update_hvac_control()
+            cycles['fan'] += zone.fan_state and not fan
+            cycles['cooling'] += zone.cooling_state and not cooling
+            cycles['heating'] += zone.heating_state and not heating
+            fan, cooling, heating = zone.fan_state, zone.cooling_state, zone.heating_state
+            error = temperature - zone.set_temperature
+            abs_error += abs(error)
+            squared_error += error * error
+            max_error = max(max_error, abs(error))
+            samples += 1
+        runtime['fan'] += step * fan
+        runtime['cooling'] += step * cooling
+        runtime['heating'] += step * heating
+        temperature += (outdoor - temperature) * leak + gain + heat * heating - cool * cooling
+
+    return {
+        'name': s['name'],
+        'scenario': scenario,
+        'mean_abs_error': abs_error / samples,
+        'rms_error': math.sqrt(squared_error / samples),
+        'max_error': max_error,
+        'cycles': cycles,
+        'runtime_hours': {relay: seconds / 3600 for relay, seconds in runtime.items()},
+        'final_temperature': temperature,
+    }
+
+
+def sweep(scenarios, workers=None):
+    # Run scenarios in parallel, one per process; results come back in input order
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(simulate, scenarios, chunksize=max(1, len(scenarios) // (4 * (workers or 4)))))
+
+
+def parse_values(text):
+    return [float(value) for value in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate the HVAC controller against a thermal house model')
+    parser.add_argument('--days', type=float, default=7.0)
+    parser.add_argument('--kp', type=parse_values, default=[DEFAULT_SCENARIO['kp']], help='comma separated list')
+    parser.add_argument('--ki', type=parse_values, default=[DEFAULT_SCENARIO['ki']], help='comma separated list')
+    parser.add_argument('--kd', type=parse_values, default=[DEFAULT_SCENARIO['kd']], help='comma separated list')
+    parser.add_argument('--set-temperature', type=float, default=DEFAULT_SCENARIO['set_temperature'])
+    parser.add_argument('--outdoor-mean', type=parse_values, default=[DEFAULT_SCENARIO['outdoor_mean']],
+                        help='comma separated list')
+    parser.add_argument('--workers', type=int, default=None, help='process pool size (default: CPU count)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    scenarios = []
+    for kp, ki, kd, outdoor_mean in itertools.product(args.kp, args.ki, args.kd, args.outdoor_mean):
+        scenarios.append({
+            'name': 'kp=%g ki=%g kd=%g outdoor=%g' % (kp, ki, kd, outdoor_mean),
+            'days': args.days, 'kp': kp, 'ki': ki, 'kd': kd,
+            'set_temperature': args.set_temperature, 'outdoor_mean': outdoor_mean,
+        })
+
+    started = time.perf_counter()
+    if len(scenarios) == 1:
+        results = [simulate(scenarios[0])]
+    else:
+        results = sweep(scenarios, args.workers)
+    elapsed = time.perf_counter() - started
+    simulated = args.days * DAY * len(scenarios)
+
+    for result in results:
+        print('%-40s mae=%.2f rms=%.2f max=%.2f cycles=%s runtime_h=%s' % (
+            result['name'], result['mean_abs_error'], result['rms_error'], result['max_error'],
+            result['cycles'], {k: round(v, 1) for k, v in result['runtime_hours'].items()}))
+    print('%d scenario(s), %.1f simulated days in %.2f s (%.0fx real time)' % (
+        len(scenarios), simulated / DAY, elapsed, simulated / elapsed))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+import json
+import threading
+
+
+class StateBroadcaster:
+    # Fan-out of state changes to Server-Sent Events clients (served by aio_server's /stream).
+    # Publishers hand over the full state, clients receive only the keys that changed since
+    # the last event.
+    def __init__(self, keepalive=15.0):
+        self.keepalive = keepalive
+        self.version = 0
+        self.state = {}
+        # Serialized once per change, shared by every client
+        self.state_payload = '{}'
+        self.delta_payload = '{}'
+        self.lock = threading.Lock()
+
+    def publish(self, state):
+        with self.lock:
+            delta = {key: value for key, value in state.items() if self.state.get(key) != value}
+            if not delta:
+                return False
+            self.state = dict(state)
+            self.state_payload = json.dumps(self.state)
+            self.delta_payload = json.dumps(delta)
+            self.version += 1
+            return True
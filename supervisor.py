@@ -0,0 +1,229 @@
+# Supervisor mode (SUPERVISOR_WORKERS=N python main.py): N controller worker processes, each
+# running main.py for the zones that hash to its shard (sharding.HashRing) with its own MQTT
+# session and state journal. Workers that exit are restarted with backoff and resume their
+# zones from the shard journals. SIGTTIN adds a worker and SIGTTOU removes one; only the zones
+# that hash to a different shard move. The supervisor talks to its workers through JSON lines
+# on their stdin, and a worker exits when its stdin closes, so none outlive the supervisor.
+# Workers answer on a pipe of their own (SUPERVISOR_ACK_FD). Each shard writes its history to
+# HISTORY_DIR/shard-<n> and reads all of them.
+import json
+import logging
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+
+from mqtt_session import Backoff
+from sharding import HashRing, moved_zones
+
+log = logging.getLogger('hvac')
+
+# A worker that ran this long before exiting is restarted without delay
+STABLE_SECONDS = 60
+
+# How long a resize waits for the existing workers to release the moved zones; a worker that
+# does not answer in time is restarted with the new shard count instead
+RELEASE_TIMEOUT = 30
+
+
+class Worker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.started = 0
+        self.restarts = 0
+        self.restart_at = None
+        self.backoff = Backoff(base=1.0, cap=60.0)
+        # Read end of the worker's acknowledgement pipe and any partial line read from it
+        self.ack_fd = None
+        self.ack_buffer = b''
+
+
+class Supervisor:
+    def __init__(self, count, script, client_id, journal_path, web_port, zone_ids=()):
+        self.count = count
+        self.script = script
+        self.client_id = client_id
+        self.journal_path = journal_path
+        self.web_port = web_port
+        self.zone_ids = list(zone_ids)
+        self.workers = {}
+        self.stopping = False
+        self.resizes = 0
+        # Count requested by a signal handler, applied by the run loop
+        self.requested = count
+
+    def worker_env(self, index):
+        env = dict(os.environ)
+        env.update({
+            'SUPERVISOR_WORKERS': '0',
+            'SHARD_INDEX': str(index),
+            'SHARD_COUNT': str(self.count),
+            # One persistent MQTT session per shard, kept across restarts of its worker
+            'MQTT_CLIENT_ID': '%s-shard%d' % (self.client_id, index),
+            'STATE_JOURNAL': '%s.shard%d' % (self.journal_path, index) if self.journal_path else '',
+            'SHARD_JOURNALS': '%s.shard*' % self.journal_path if self.journal_path else '',
+            'WEB_PORT': str(self.web_port + index),
+            'WEB_WORKERS': '0',
+        })
+        history_dir = os.environ.get('HISTORY_DIR')
+        if history_dir:
+            # Shards must not share segment files; queries merge all of them
+            env['HISTORY_DIR'] = os.path.join(history_dir, 'shard-%d' % index)
+            env['SHARD_HISTORY_DIRS'] = os.path.join(history_dir, 'shard-*')
+        return env
+
+    def spawn(self, worker):
+        self.close_ack(worker)
+        read_fd, write_fd = os.pipe()
+        env = self.worker_env(worker.index)
+        env['SUPERVISOR_ACK_FD'] = str(write_fd)
+        try:
+            worker.process = subprocess.Popen([sys.executable, self.script], env=env, stdin=subprocess.PIPE,
+                                              pass_fds=(write_fd,))
+        except OSError:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        worker.ack_fd = read_fd
+        worker.started = time.time()
+        worker.restart_at = None
+        log.info("Started worker %d/%d (pid %d, web port %d)", worker.index, self.count, worker.process.pid,
+                 self.web_port + worker.index)
+
+    def send(self, worker, message):
+        if worker.process is None or worker.process.poll() is not None:
+            return
+        try:
+            worker.process.stdin.write((json.dumps(message) + '\n').encode())
+            worker.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            pass  # Exiting, check() restarts it with the current shard count
+
+    def close_ack(self, worker):
+        if worker.ack_fd is not None:
+            os.close(worker.ack_fd)
+            worker.ack_fd = None
+            worker.ack_buffer = b''
+
+    def wait_released(self, workers, resize, timeout=RELEASE_TIMEOUT):
+        # Wait until every worker acknowledged the resize command (or exited); restart the others
+        waiting = {worker.ack_fd: worker for worker in workers
+                   if worker.ack_fd is not None and worker.process.poll() is None}
+        deadline = time.time() + timeout
+        while waiting:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            ready, _, _ = select.select(list(waiting), [], [], remaining)
+            for fd in ready:
+                worker = waiting[fd]
+                data = os.read(fd, 4096)
+                if not data:
+                    # Exited: it controls nothing, check() restarts it with the new shard count
+                    del waiting[fd]
+                    continue
+                *lines, worker.ack_buffer = (worker.ack_buffer + data).split(b'\n')
+                for line in lines:
+                    try:
+                        released = json.loads(line).get('released')
+                    except (ValueError, AttributeError):
+                        continue
+                    if released == resize:
+                        del waiting[fd]
+                        break
+        for worker in waiting.values():
+            log.warning("Worker %d did not release its moved zones within %.0f s, restarting it",
+                        worker.index, timeout)
+            self.terminate(worker)
+
+    def terminate(self, worker, timeout=10):
+        process = worker.process
+        if process is None or process.poll() is not None:
+            return
+        process.terminate()
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def start(self):
+        for index in range(self.count):
+            self.workers[index] = worker = Worker(index)
+            self.spawn(worker)
+
+    def resize(self, count):
+        # Growing: the existing workers acknowledge releasing the moved zones before the new ones
+        # start (or are restarted with the new count if they do not).
+        # Shrinking: the removed workers stop before the others take their zones over.
+        if count < 1 or count == self.count:
+            return
+        old = self.count
+        if self.zone_ids:
+            moved = moved_zones(HashRing(old), HashRing(count), self.zone_ids)
+            log.info("Resizing from %d to %d workers, %d of %d zones move", old, count, len(moved),
+                     len(self.zone_ids))
+        else:
+            log.info("Resizing from %d to %d workers", old, count)
+        self.count = count
+        self.resizes += 1
+        if count > old:
+            for worker in self.workers.values():
+                self.send(worker, {'shards': count, 'resize': self.resizes})
+            self.wait_released(list(self.workers.values()), self.resizes)
+            for index in range(old, count):
+                self.workers[index] = worker = Worker(index)
+                self.spawn(worker)
+        else:
+            for index in range(count, old):
+                worker = self.workers.pop(index)
+                self.terminate(worker)
+                self.close_ack(worker)
+            for worker in self.workers.values():
+                self.send(worker, {'shards': count, 'resize': self.resizes})
+
+    def check(self):
+        # Restart workers that exited, with jittered backoff when they keep failing
+        now = time.time()
+        for worker in self.workers.values():
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    worker.restarts += 1
+                    self.spawn(worker)
+                continue
+            code = worker.process.poll()
+            if code is None:
+                continue
+            if now - worker.started >= STABLE_SECONDS:
+                worker.backoff.reset()
+            delay = worker.backoff.next()
+            worker.restart_at = now + delay
+            log.warning("Worker %d exited with code %s, restarting in %.1f s", worker.index, code, delay)
+
+    def run(self):
+        def stop(signum, frame):
+            self.stopping = True
+
+        def grow(signum, frame):
+            self.requested += 1
+
+        def shrink(signum, frame):
+            self.requested = max(1, self.requested - 1)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTTIN, grow)
+        signal.signal(signal.SIGTTOU, shrink)
+        self.start()
+        while not self.stopping:
+            if self.requested != self.count:
+                self.resize(self.requested)
+            self.check()
+            time.sleep(0.5)
+        log.info("Stopping %d workers", len(self.workers))
+        for worker in self.workers.values():
+            self.terminate(worker)
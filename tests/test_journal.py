@@ -0,0 +1,90 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from journal import StateJournal, merge_journals, read_journal
+
+
+def test_asyncio_mode_keeps_journal_compacted(tmp_path):
+    # asyncio mode never calls start(); AsyncController.journal_sync has to compact
+    aio_server = pytest.importorskip('aio_server')
+    path = str(tmp_path / 'state.journal')
+    journal = StateJournal(path, fsync_interval=0.01, compact_bytes=2000)
+    core = SimpleNamespace(state_journal=journal)
+
+    async def drive():
+        controller = aio_server.AsyncController(core)
+        task = asyncio.create_task(controller.journal_sync())
+        for i in range(2000):
+            journal.record('zone/%d' % (i % 5), {'value': i})
+            if i % 50 == 0:
+                await asyncio.sleep(0.02)
+        await asyncio.sleep(0.1)
+        task.cancel()
+
+    asyncio.run(drive())
+    journal.close()
+    assert os.path.getsize(path) <= 2000
+    latest, _ = read_journal(path)
+    assert latest == {'zone/%d' % k: {'value': 1995 + k} for k in range(5)}
+
+
+def test_replay_keeps_latest_state_and_skips_torn_line(tmp_path):
+    path = str(tmp_path / 'state.journal')
+    journal = StateJournal(path)
+    journal.record('controller', {'set_temperature': 70})
+    journal.record('zone/a', {'set_temperature': 68})
+    journal.record('controller', {'set_temperature': 72})
+    journal.close()
+    # A crash in the middle of a write leaves a partial last line
+    with open(path, 'ab') as f:
+        f.write(b'{"k":"zone/a","s":{"set_temp')
+
+    journal = StateJournal(path)
+    assert journal.get('controller') == {'set_temperature': 72}
+    assert journal.get('zone/a') == {'set_temperature': 68}
+    assert journal.get('zone/b') is None
+    journal.close()
+
+
+def test_compact_rewrites_latest_state_only(tmp_path):
+    path = str(tmp_path / 'state.journal')
+    journal = StateJournal(path, compact_bytes=0)
+    for i in range(100):
+        journal.record('zone/%d' % (i % 3), {'value': i})
+    before = os.path.getsize(path)
+    journal.maintain()
+    with open(path, 'rb') as f:
+        assert len(f.readlines()) == 3
+    assert os.path.getsize(path) < before
+    # Appends after the rename go to the new file
+    journal.record('zone/0', {'value': 100})
+    journal.close()
+    latest, saved = read_journal(path)
+    assert latest == {'zone/0': {'value': 100}, 'zone/1': {'value': 97}, 'zone/2': {'value': 98}}
+    assert all(saved.values())
+
+
+def test_compaction_waits_for_growth(tmp_path):
+    path = str(tmp_path / 'state.journal')
+    journal = StateJournal(path, compact_bytes=0)
+    for i in range(10):
+        journal.record('zone/%d' % i, {'value': i})
+    journal.maintain()
+    compacted = os.path.getsize(path)
+    # Not due again until the file has doubled since the last compaction
+    journal.record('zone/0', {'value': 10})
+    journal.maintain()
+    assert os.path.getsize(path) > compacted
+    journal.close()
+
+
+def test_merge_journals_newest_record_wins(tmp_path):
+    first, second = str(tmp_path / 'a.journal'), str(tmp_path / 'b.journal')
+    with open(first, 'w') as f:
+        f.write('{"k":"zone/a","s":1,"t":10}\n{"k":"zone/b","s":1,"t":30}\n')
+    with open(second, 'w') as f:
+        f.write('{"k":"zone/a","s":2,"t":20}\n{"k":"zone/b","s":2,"t":5}\n{"k":"zone/c","s":2}\n')
+    assert merge_journals([first, second, str(tmp_path / 'missing')]) == {'zone/a': 2, 'zone/b': 1, 'zone/c': 2}
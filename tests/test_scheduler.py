@@ -0,0 +1,46 @@
+import threading
+
+from scheduler import DeadlineScheduler
+
+
+def test_pop_due_in_deadline_order():
+    scheduler = DeadlineScheduler()
+    scheduler.schedule('b', 20, print, 'b')
+    scheduler.schedule('a', 10, print, 'a')
+    scheduler.schedule('c', 30, print, 'c')
+    assert scheduler.next_deadline() == 10
+    assert scheduler.pop_due(25) == [(print, ('a',)), (print, ('b',))]
+    assert scheduler.next_deadline() == 30
+    assert scheduler.stats()['timers'] == 1
+
+
+def test_reschedule_replaces_timer_of_same_key():
+    scheduler = DeadlineScheduler()
+    scheduler.schedule('zone', 10, print, 'first')
+    scheduler.schedule('zone', 50, print, 'second')
+    assert scheduler.next_deadline() == 50
+    assert scheduler.pop_due(40) == []
+    assert scheduler.pop_due(50) == [(print, ('second',))]
+    assert scheduler.next_deadline() is None
+
+
+def test_cancel_and_dead_entry_compaction():
+    scheduler = DeadlineScheduler()
+    for i in range(200):
+        scheduler.schedule(i, i, print)
+    for i in range(150):
+        scheduler.cancel(i)
+    scheduler.cancel('unknown')
+    # Cancelled entries are dropped from the heap once they are the majority
+    assert len(scheduler.heap) < 200
+    assert scheduler.next_deadline() == 150
+    assert len(scheduler.pop_due(1000)) == 50
+
+
+def test_thread_fires_callbacks():
+    scheduler = DeadlineScheduler()
+    fired = threading.Event()
+    scheduler.start()
+    scheduler.schedule('zone', scheduler.clock() + 0.05, fired.set)
+    assert fired.wait(5)
+    assert scheduler.stats()['fired'] == 1
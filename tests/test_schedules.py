@@ -0,0 +1,92 @@
+import pytest
+
+from scheduler import DeadlineScheduler
+from schedules import WEEK, ScheduleEngine, WeeklySchedule, parse_days
+
+SCHEDULE = {'blocks': [{'days': 'weekdays', 'start': '06:30', 'set_temperature': 70},
+                       {'days': 'daily', 'start': '22:00', 'set_temperature': 64}],
+            'away_temperature': 60}
+
+
+def engine(apply=None, now=0.0):
+    applied = []
+    engine = ScheduleEngine(DeadlineScheduler(), apply or (lambda zone_id, value: applied.append((zone_id, value))),
+                            lambda zone_id: None, clock=lambda: now)
+    return engine, applied
+
+
+def test_parse_days():
+    assert parse_days('mon-wed,fri') == [0, 1, 2, 4]
+    assert parse_days('weekends') == [5, 6]
+    assert parse_days(['Sun', 1]) == [6, 1]
+
+
+def test_transitions_wrap_around_the_week():
+    schedule = WeeklySchedule(SCHEDULE)
+    assert schedule.setpoint_at(6 * 3600) == 64  # Monday 06:00, still Sunday's 22:00 block
+    assert schedule.setpoint_at(7 * 3600) == 70
+    sunday_night = WEEK - 3600
+    assert schedule.setpoint_at(sunday_night) == 64
+    assert schedule.next_transition(sunday_night) == (3600 + 6.5 * 3600, 70)
+
+
+@pytest.mark.parametrize('config', [
+    None,
+    {},
+    {'blocks': []},
+    {'blocks': [{'days': [], 'start': '06:00', 'set_temperature': 70}]},
+    {'blocks': [{'start': '06:00', 'set_temperature': float('nan')}]},
+    {'blocks': [{'start': '06:00', 'set_temperature': 'inf'}]},
+    {'blocks': [{'start': '25:00', 'set_temperature': 70}]},
+    {'blocks': [{'start': '06:00'}]},
+    {'blocks': [{'days': 'someday', 'start': '06:00', 'set_temperature': 70}]},
+    {'blocks': [{'start': '06:00', 'set_temperature': 70}], 'away_temperature': float('nan')},
+])
+def test_invalid_schedules_are_rejected(config):
+    with pytest.raises(ValueError):
+        WeeklySchedule(config)
+
+
+def test_set_schedule_applies_setpoint_and_plans_next_transition():
+    schedules, applied = engine()
+    schedules.set_schedule('a', SCHEDULE)
+    state = schedules.state('a')
+    assert applied == [('a', state['set_temperature'])]
+    assert state['reason'] == 'schedule'
+    assert state['next_wake'] is not None
+
+
+def test_failed_set_schedule_keeps_previous_schedule():
+    schedules, applied = engine()
+    schedules.set_schedule('a', SCHEDULE)
+
+    def failing(zone_id, value):
+        raise RuntimeError("controller unavailable")
+    schedules.apply = failing
+    replacement = {'blocks': [{'start': '00:00', 'set_temperature': 50}]}
+    with pytest.raises(RuntimeError):
+        schedules.set_schedule('a', replacement)
+    assert schedules.state('a')['schedule'] is SCHEDULE
+    assert schedules.state('a')['set_temperature'] == applied[0][1]
+
+    with pytest.raises(RuntimeError):
+        schedules.set_schedule('b', replacement)
+    assert 'b' not in schedules.zone_ids()
+
+
+def test_override_validation():
+    schedules, applied = engine()
+    with pytest.raises(ValueError):
+        schedules.set_override('a', 'vacation', 60)
+    with pytest.raises(ValueError):
+        schedules.set_override('a', 'hold')
+    with pytest.raises(ValueError):
+        schedules.set_override('a', 'hold', float('nan'))
+    with pytest.raises(ValueError):
+        schedules.set_override('a', 'hold', 60, until=float('inf'))
+    assert applied == []
+
+    schedules.set_schedule('a', SCHEDULE)
+    schedules.set_override('a', 'away', until=3600)
+    assert applied[-1] == ('a', 60)
+    assert schedules.state('a')['reason'] == 'away'
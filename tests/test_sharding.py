@@ -0,0 +1,29 @@
+import pytest
+
+from sharding import HashRing, moved_zones
+
+ZONES = ['zone-%d' % i for i in range(5000)]
+
+
+def test_assignment_is_stable_and_covers_every_shard():
+    ring = HashRing(4)
+    shards = [ring.shard_for(zone_id) for zone_id in ZONES]
+    assert set(shards) == {0, 1, 2, 3}
+    assert shards == [HashRing(4).shard_for(zone_id) for zone_id in ZONES]
+    assert all(HashRing(1).shard_for(zone_id) == 0 for zone_id in ZONES[:10])
+
+
+@pytest.mark.parametrize('count', [1, 2, 4, 7])
+def test_adding_a_shard_moves_about_one_in_n_plus_one(count):
+    old, new = HashRing(count), HashRing(count + 1)
+    moved = moved_zones(old, new, ZONES)
+    # Only zones that now belong to the new shard move
+    assert all(new.shard_for(zone_id) == count for zone_id in moved)
+    assert abs(len(moved) / len(ZONES) - 1 / (count + 1)) < 0.1
+    # Removing it again moves exactly the same zones back
+    assert moved_zones(new, old, ZONES) == moved
+
+
+def test_ring_needs_a_shard():
+    with pytest.raises(ValueError):
+        HashRing(0)
@@ -0,0 +1,134 @@
+# Multi-process web serving (WEB_WORKERS=N): the controller process publishes its state to a
+# shared-memory snapshot and N forked worker processes serve the read-only API from it on a
+# shared listening socket. Writes are forwarded to the controller over a queue, so there is
+# still exactly one PID.
+import logging
+import math
+import multiprocessing
+import socket
+import threading
+
+from flask import Flask, Response, jsonify, render_template, request
+from werkzeug.serving import make_server
+
+from http_cache import encode, etag_for, etag_matches, not_modified
+from shm_state import SnapshotReader
+
+log = logging.getLogger('hvac')
+
+
+def on_off(value):
+    return 'ON' if value else 'OFF'
+
+
+def create_worker_app(reader, commands, template_folder, root_path):
+    app = Flask(__name__, template_folder=template_folder, root_path=root_path)
+
+    @app.route('/set_temperature', methods=['POST'])
+    def set_temp():
+        data = request.form.get('set_temperature')
+        try:
+            value = float(data)
+        except (ValueError, TypeError):
+            return jsonify({"message": "Invalid temperature value"}), 400
+        if not math.isfinite(value):
+            return jsonify({"message": "Invalid temperature value"}), 400
+        commands.put(('set_temperature', value))
+        return jsonify({"message": "Temperature set successfully", "set_temperature": value})
+
+    @app.route('/')
+    def index():
+        state = reader.read()
+        return render_template('index.html', current_temperature=state['current_temperature'],
+                               set_temperature=state['set_temperature'], fan_state=on_off(state['fan_state']),
+                               cooling_state=on_off(state['cooling_state']),
+                               heating_state=on_off(state['heating_state']),
+                               pid_calculation=state['pid_calculation'],
+                               external_temperature=state['external_temperature'],
+                               avg_external_temperature=state['avg_external_temperature'])
+
+    @app.route('/get_hvac_state')
+    def get_hvac_state():
+        state = reader.read()
+        return jsonify({
+            'fan_state': on_off(state['fan_state']),
+            'cooling_state': on_off(state['cooling_state']),
+            'heating_state': on_off(state['heating_state'])
+        })
+
+    @app.route('/get_pid_calculation')
+    def get_pid_calculation():
+        return jsonify({
+            'pid_calculation': reader.read()['pid_calculation']
+        })
+
+    @app.route('/get_current_temperature')
+    def get_current_temperature():
+        return jsonify({
+            'current_temperature': reader.read()['current_temperature']
+        })
+
+    @app.route('/api/state')
+    def api_state():
+        # Same document as the controller's /api/state, without zones (those are on the admin port)
+        version = reader.version()
+        etag = etag_for(version)
+        if etag_matches(etag, request.headers.get('If-None-Match')):
+            status, body, headers = not_modified(etag)
+        else:
+            state = reader.read()
+            controller = {key: on_off(value) if key.endswith('_state') else value
+                          for key, value in state.items() if key not in ('version', 'updated')}
+            status, body, headers = encode({'version': state['version'], 'controller': controller, 'zones': []},
+                                           request.headers.get('Accept-Encoding'), etag_for(state['version']))
+        return Response(body, status=status, headers=headers)
+
+    return app
+
+
+def worker_main(shm, commands, listener, template_folder, root_path):
+    reader = SnapshotReader(shm=shm)
+    app = create_worker_app(reader, commands, template_folder, root_path)
+    host, port = listener.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True, fd=listener.fileno())
+    server.serve_forever()
+
+
+class WebWorkers:
+    # Owns the listening socket, the worker processes and the command queue
+    def __init__(self, snapshot, count, host, port, template_folder, root_path):
+        self.snapshot = snapshot
+        self.count = count
+        self.context = multiprocessing.get_context('fork')
+        self.commands = self.context.Queue()
+        self.listener = socket.create_server((host, port), backlog=128)
+        self.listener.set_inheritable(True)
+        self.template_folder = template_folder
+        self.root_path = root_path
+        self.processes = []
+
+    def start(self):
+        # Must run before the controller starts any threads: the workers are forked
+        for i in range(self.count):
+            process = self.context.Process(target=worker_main, name='web-worker-%d' % i, daemon=True,
+                                           args=(self.snapshot.shm, self.commands, self.listener,
+                                                 self.template_folder, self.root_path))
+            process.start()
+            self.processes.append(process)
+        log.info("Started %d web workers on %s", self.count, self.listener.getsockname())
+
+    def forward_commands(self, handle):
+        # Controller side: apply (name, value) commands sent by the workers
+        def run():
+            while True:
+                try:
+                    name, value = self.commands.get()
+                except (EOFError, OSError):
+                    return
+                try:
+                    handle(name, value)
+                except Exception:
+                    log.exception("Forwarded command %s failed", name)
+        thread = threading.Thread(target=run, name='web-commands', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,248 @@
+import json
+import time
+
+from pid import PID
+
+# Minimum time in seconds a relay is held on once switched on
+MIN_RUN_TIME = 300
+
+
+def hold_expiry(fan_state, cooling_state, heating_state, fan_start_time, cooling_start_time, heating_start_time):
+    # The hold keeps every relay on while any relay that is on is within MIN_RUN_TIME of its
+    # start, so it ends MIN_RUN_TIME after the latest start. None if every relay is off.
+    latest = None
+    for on, started in ((fan_state, fan_start_time), (cooling_state, cooling_start_time),
+                        (heating_state, heating_start_time)):
+        if on and (latest is None or started > latest):
+            latest = started
+    return None if latest is None else latest + MIN_RUN_TIME
+
+
+def next_deadline(now, hold, lockouts):
+    # Earliest future time at which an evaluation with unchanged inputs could change the relays:
+    # the end of the hold or of a minimum off time lockout. None if there is none.
+    deadline = hold if hold is not None and hold > now else None
+    for end in lockouts:
+        if end > now and (deadline is None or end < deadline):
+            deadline = end
+    return deadline
+
+
+def relay_decision(pid_value, current, setpoint, external, avg_external, fan, cooling, heating, fan_start,
+                   cooling_start, heating_start, cooling_stop, heating_stop, min_off_time, now):
+    # The heating/cooling/fan rules of every controller: the single zone controller in main.py,
+    # Zone and batch_pid.BatchController. Only &, | and ^ are used, so the arguments may be
+    # scalars (one zone) or NumPy arrays (a fleet). Returns (heat, cool, fan_only, fan, cooling,
+    # heating): which rule fired, then the new relay states.
+    # Thresholds based on a percentage of the average external temperature
+    threshold_percentage = 0.15
+    cooling_threshold = avg_external * (1 - threshold_percentage)
+    heating_threshold = avg_external * (1 + threshold_percentage)
+    # Anti-short-cycle lockouts after cooling/heating stopped
+    heating_locked = (heating ^ True) & (now - heating_stop < min_off_time)
+    cooling_locked = (cooling ^ True) & (now - cooling_stop < min_off_time)
+
+    heat = (pid_value > 0.25) & (external < heating_threshold) & (current < setpoint) & (heating_locked ^ True)
+    cool = (heat ^ True) & (pid_value < -0.25) & (external > cooling_threshold) & (current > setpoint) & \
+        (cooling_locked ^ True)
+    fan_only = ((heat | cool) ^ True) & (abs(pid_value) > .5)
+    # Otherwise every relay keeps its state while any relay that is on is within MIN_RUN_TIME
+    hold = ((heat | cool | fan_only) ^ True) & ((fan & (now - fan_start < MIN_RUN_TIME)) |
+                                                (cooling & (now - cooling_start < MIN_RUN_TIME)) |
+                                                (heating & (now - heating_start < MIN_RUN_TIME)))
+    return (heat, cool, fan_only, heat | cool | fan_only | (hold & fan), cool | (hold & cooling),
+            heat | (hold & heating))
+
+
+def parse_temperature(payload):
+    # The temperature topic carries a JSON number, the others a bare float
+    return float(json.loads(payload))
+
+
+# Per zone topic suffix -> (Zone attribute, payload parser)
+ZONE_TOPICS = {
+    'temperature': ('current_temperature', parse_temperature),
+    'external_temperature': ('external_temperature', float),
+    'average_temperature': ('avg_external_temperature', float),
+    'set_temperature': ('set_temperature', float),
+}
+
+
+class Zone:
+    __slots__ = ('zone_id', 'control_topic', 'pid', 'current_temperature', 'external_temperature',
+                 'avg_external_temperature', 'set_temperature', 'fan_state', 'cooling_state', 'heating_state',
+                 'fan_start_time', 'cooling_start_time', 'heating_start_time', 'cooling_stop_time',
+                 'heating_stop_time', 'min_off_time', 'clock')
+
+    def __init__(self, zone_id, control_topic, set_temperature=70, clock=time.time, min_off_time=0):
+        self.zone_id = zone_id
+        self.control_topic = control_topic
+        self.clock = clock
+        # Anti-short-cycle: cooling/heating stay off at least min_off_time seconds once stopped
+        self.min_off_time = min_off_time
+        self.pid = PID(clock=clock)
+        self.current_temperature = 0.0
+        self.external_temperature = 0.0
+        self.avg_external_temperature = 0.0
+        self.set_temperature = set_temperature
+        self.fan_state = False
+        self.cooling_state = False
+        self.heating_state = False
+        self.fan_start_time = 0
+        self.cooling_start_time = 0
+        self.heating_start_time = 0
+        self.cooling_stop_time = 0
+        self.heating_stop_time = 0
+
+    def update_hvac_control(self):
+        # Same decision rules as update_hvac_control() in main.py, applied to this zone only
+        pid = self.pid
+        pid.SetPoint = self.set_temperature
+        pid.update(self.current_temperature)
+        now = self.clock()
+        cooling, heating = self.cooling_state, self.heating_state
+        heat, cool, fan_only, self.fan_state, self.cooling_state, self.heating_state = relay_decision(
+            pid.get_pid_value(), self.current_temperature, self.set_temperature, self.external_temperature,
+            self.avg_external_temperature, self.fan_state, cooling, heating, self.fan_start_time,
+            self.cooling_start_time, self.heating_start_time, self.cooling_stop_time, self.heating_stop_time,
+            self.min_off_time, now)
+        if heat:
+            self.heating_start_time = now
+        if cool:
+            self.cooling_start_time = now
+        if cool or fan_only:
+            self.fan_start_time = now
+        if cooling and not self.cooling_state:
+            self.cooling_stop_time = now
+        if heating and not self.heating_state:
+            self.heating_stop_time = now
+
+    def next_deadline(self):
+        # When this zone needs to be evaluated again even if no new reading arrives
+        hold = hold_expiry(self.fan_state, self.cooling_state, self.heating_state, self.fan_start_time,
+                           self.cooling_start_time, self.heating_start_time)
+        lockouts = (self.cooling_stop_time + self.min_off_time, self.heating_stop_time + self.min_off_time) \
+            if self.min_off_time else ()
+        return next_deadline(self.clock(), hold, lockouts)
+
+    def get_state(self):
+        # Everything needed to resume this zone after a restart
+        return {
+            'pid': self.pid.get_state(),
+            'set_temperature': self.set_temperature,
+            'fan_state': self.fan_state,
+            'cooling_state': self.cooling_state,
+            'heating_state': self.heating_state,
+            'fan_start_time': self.fan_start_time,
+            'cooling_start_time': self.cooling_start_time,
+            'heating_start_time': self.heating_start_time,
+            'cooling_stop_time': self.cooling_stop_time,
+            'heating_stop_time': self.heating_stop_time
+        }
+
+    def load_state(self, state):
+        self.pid.load_state(state.get('pid', {}))
+        self.set_temperature = state.get('set_temperature', self.set_temperature)
+        self.fan_state = state.get('fan_state', False)
+        self.cooling_state = state.get('cooling_state', False)
+        self.heating_state = state.get('heating_state', False)
+        self.fan_start_time = state.get('fan_start_time', 0)
+        self.cooling_start_time = state.get('cooling_start_time', 0)
+        self.heating_start_time = state.get('heating_start_time', 0)
+        self.cooling_stop_time = state.get('cooling_stop_time', 0)
+        self.heating_stop_time = state.get('heating_stop_time', 0)
+
+    def state(self):
+        return {
+            'zone_id': self.zone_id,
+            'current_temperature': self.current_temperature,
+            'external_temperature': self.external_temperature,
+            'avg_external_temperature': self.avg_external_temperature,
+            'set_temperature': self.set_temperature,
+            'pid_calculation': self.pid.get_pid_value(),
+            'fan_state': 'ON' if self.fan_state else 'OFF',
+            'cooling_state': 'ON' if self.cooling_state else 'OFF',
+            'heating_state': 'ON' if self.heating_state else 'OFF'
+        }
+
+
+class ZoneRegistry:
+    # Zones live under <prefix>/<zone_id>/<suffix>, e.g. hvac/livingroom/temperature.
+    # Relay commands for a zone go to <prefix>/<zone_id>/<control_suffix>.
+    # owns(zone_id) restricts the registry to some zones (one shard of a supervisor); messages
+    # of the other zones are ignored. With zone_ids known up front only their topics are
+    # subscribed to, otherwise the whole prefix.
+    def __init__(self, prefix, control_suffix='control', clock=time.time, min_off_time=0, owns=None, zone_ids=()):
+        self.prefix = prefix.rstrip('/')
+        self.clock = clock
+        self.min_off_time = min_off_time
+        self.control_suffix = control_suffix
+        self.owns = owns
+        self.zone_ids = list(zone_ids)
+        self.zones = {}
+        # Exact topic -> (zone, attribute, parser), or None for a zone of another shard,
+        # filled on first sight of a topic
+        self.routes = {}
+        # Messages ignored because their zone belongs to another shard
+        self.foreign = 0
+
+    def subscriptions(self):
+        # Zones with several temperature sensors publish to <prefix>/<zone_id>/temperature/<sensor>
+        if not self.zone_ids:
+            return ['%s/+/%s' % (self.prefix, suffix) for suffix in ZONE_TOPICS] + \
+                   ['%s/+/temperature/+' % self.prefix]
+        topics = []
+        for zone_id in self.zone_ids:
+            if self.owns is None or self.owns(zone_id):
+                topics.extend('%s/%s/%s' % (self.prefix, zone_id, suffix) for suffix in ZONE_TOPICS)
+                topics.append('%s/%s/temperature/+' % (self.prefix, zone_id))
+        return topics
+
+    def rebalance(self):
+        # After owns() changed: forget the cached routes, remove and return the zones not owned anymore
+        self.routes.clear()
+        if self.owns is None:
+            return []
+        released = [zone for zone_id, zone in self.zones.items() if not self.owns(zone_id)]
+        for zone in released:
+            del self.zones[zone.zone_id]
+        return released
+
+    def get_zone(self, zone_id):
+        zone = self.zones.get(zone_id)
+        if zone is None:
+            zone = Zone(zone_id, '%s/%s/%s' % (self.prefix, zone_id, self.control_suffix), clock=self.clock,
+                        min_off_time=self.min_off_time)
+            self.zones[zone_id] = zone
+        return zone
+
+    def route(self, topic):
+        route = self.routes.get(topic, False)
+        if route is not False:
+            if route is None:
+                self.foreign += 1
+            return route
+        parts = topic.split('/')
+        prefix_parts = self.prefix.count('/') + 1
+        if len(parts) not in (prefix_parts + 2, prefix_parts + 3) or '/'.join(parts[:prefix_parts]) != self.prefix:
+            return None
+        zone_id, suffix = parts[prefix_parts], parts[prefix_parts + 1]
+        if suffix not in ZONE_TOPICS or (len(parts) == prefix_parts + 3 and suffix != 'temperature'):
+            return None
+        if self.owns is not None and not self.owns(zone_id):
+            self.routes[topic] = None
+            self.foreign += 1
+            return None
+        attribute, parser = ZONE_TOPICS[suffix]
+        route = (self.get_zone(zone_id), attribute, parser)
+        self.routes[topic] = route
+        return route
+
+    def handle_message(self, topic, payload):
+        # Returns the updated zone, or None if the topic is not a zone topic
+        route = self.route(topic)
+        if route is None:
+            return None
+        zone, attribute, parser = route
+        setattr(zone, attribute, parser(payload))
+        return zone